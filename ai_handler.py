@@ -1,61 +1,440 @@
-# ai_handler.py：AI逻辑（API调用、Markdown处理）
+# ai_handler.py：AI逻辑（API调用、Markdown处理），不依赖PyQt，可在无界面环境使用
 import re
-from PyQt5.QtCore import QThread, pyqtSignal
-from openai import OpenAI
+import html
+import time
+import random
+import threading
+from itertools import chain
+from functools import lru_cache
+import markdown
+import pybase64
 import config  # 导入全局变量（使用全局client）
+from cache_handler import fingerprint, perceptual_cache, response_cache
+from image_handler import ImageAsset, prepare_image, frame_differ, DIFF_CROP, DIFF_UNCHANGED
+from router_handler import model_router
+from trace_handler import tracer
+
+
+DIFF_CROP_HINT = "\n（图片只包含屏幕上与上一张截图相比发生变化的区域）"  # 只上传变化区域时附加在问题后
 
 
 # -------------------------- Markdown格式处理工具 --------------------------
+CODE_BLOCK_PATTERN = re.compile(r"```(\w*)\n(.*?)```", re.DOTALL)
+BLOCK_BREAK_PATTERN = re.compile(r"\n\s*\n")  # 空行：Markdown块之间的分隔
+MARKDOWN_EXTENSIONS = ["fenced_code", "tables", "sane_lists"]
+_markdown_local = threading.local()  # Markdown实例非线程安全，每个线程复用各自的实例
+
+
+def _render_code_block(match):
+    lang = match.group(1).strip()
+    code_content = match.group(2).strip()
+    lang_label = f"<div class='code-language'>{lang.capitalize()} 代码</div>" if lang else "<div class='code-language'>代码块</div>"
+    code_escaped = html.escape(code_content, quote=False).replace("\n", "<br>").replace(" ", "&nbsp;")
+    return f"{lang_label}<div class='code-block'>{code_escaped}</div>"
+
+
 def format_markdown_with_code(md_text):
     """处理Markdown中的代码块，添加样式"""
-    code_pattern = r"```(\w*)\n(.*?)```"
-    def replace_code(match):
-        lang = match.group(1).strip()
-        code_content = match.group(2).strip()
-        lang_label = f"<div class='code-language'>{lang.capitalize()} 代码</div>" if lang else "<div class='code-language'>代码块</div>"
-        code_escaped = code_content.replace("<", "&lt;").replace(">", "&gt;").replace("\n", "<br>").replace(" ", "&nbsp;")
-        return f"{lang_label}<div class='code-block'>{code_escaped}</div>"
-    return re.sub(code_pattern, replace_code, md_text, flags=re.DOTALL | re.IGNORECASE)
-
-
-# -------------------------- AI调用线程 --------------------------
-class ApiThread(QThread):
-    """独立线程调用AI接口，避免阻塞UI"""
-    result_signal = pyqtSignal(str, str)  # 信号：(推理过程, 回答内容)
-
-    def __init__(self, base64_image, question):
-        super().__init__()
-        self.base64_image = base64_image  # 图片Base64编码
-        self.question = question          # 用户问题
+    return CODE_BLOCK_PATTERN.sub(_render_code_block, md_text)
+
+
+def _markdown_instance():
+    md = getattr(_markdown_local, "md", None)
+    if md is None:
+        md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+        _markdown_local.md = md
+    return md
+
+
+@lru_cache(maxsize=config.RENDER_CACHE_SIZE)
+def render_markdown(md_text):
+    """
+    把AI回答渲染为HTML：代码块沿用format_markdown_with_code的样式，其余部分交给Markdown（表格、列表等）。
+    结果按文本缓存（LRU），同一段文本只渲染一次。
+    """
+    md = _markdown_instance()
+    parts = []
+    last_end = 0
+    for match in CODE_BLOCK_PATTERN.finditer(md_text):
+        text = md_text[last_end:match.start()]
+        if text.strip():
+            parts.append(md.reset().convert(text))
+        parts.append(_render_code_block(match))
+        last_end = match.end()
+    text = md_text[last_end:]
+    if text.strip():
+        parts.append(md.reset().convert(text))
+    # QTextEdit不支持表格边框CSS，改用HTML属性
+    return "".join(parts).replace("<table>", "<table border='1' cellspacing='0' cellpadding='4'>")
+
+
+class StreamRenderer:
+    """
+    流式回答的增量渲染：已完整的Markdown块（空行分隔且不在未闭合的代码块内）只渲染一次并提交，
+    每次只重新渲染末尾未完成的块。
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.committed_len = 0  # 已提交渲染的文本长度
+
+    def feed(self, delta):
+        self.text += delta
+
+    def render(self):
+        """返回 (新提交的HTML, 末尾未完成块的HTML)"""
+        pending = self.text[self.committed_len:]
+        split_at = 0
+        for match in BLOCK_BREAK_PATTERN.finditer(pending):
+            # 代码围栏数量为偶数才说明分隔处不在代码块内部
+            if pending.count("```", 0, match.start()) % 2 == 0:
+                split_at = match.end()
+        committed_html = ""
+        if split_at:
+            committed_html = render_markdown(pending[:split_at])
+            self.committed_len += split_at
+        tail = self.text[self.committed_len:]
+        if tail.count("```") % 2:
+            tail += "\n```"  # 未闭合的代码块临时补全，输出过程中也按代码样式显示
+        return committed_html, render_markdown(tail) if tail.strip() else ""
+
+
+# -------------------------- 错误分类 --------------------------
+class CircuitOpenError(Exception):
+    """熔断器打开期间直接拒绝请求"""
+
+
+def classify_error(error):
+    """把调用异常归类，返回 (错误类型, 界面显示的中文说明, 是否值得重试)"""
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open", "服务异常熔断中", False
+    import openai  # 出错时客户端早已创建，此处不会产生额外的导入耗时
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout", "请求超时", True
+    if isinstance(error, openai.APIConnectionError):
+        return "network", "网络连接失败", True
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit", "请求过于频繁（限流）", True
+    if isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+        return "auth", "API Key无效或无权限", False
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code >= 500:
+            return "server", f"服务端错误（{error.status_code}）", True
+        return "bad_request", f"请求被拒绝（{error.status_code}）", False
+    return "unknown", "未知错误", False
+
+
+# -------------------------- 熔断器 --------------------------
+class CircuitBreaker:
+    """
+    连续失败达到阈值后打开熔断，期间请求直接失败；冷却时间过后放行一个试探请求（半开），
+    成功则恢复，失败则重新打开。
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.half_open_trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.half_open_trial:
+                raise CircuitOpenError(f"连续失败{self.failures}次，{self.reset_timeout}秒内暂停请求")
+            self.half_open_trial = True  # 半开：只放行一个试探请求
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.half_open_trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.half_open_trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.half_open_trial = False
+
+
+circuit_breaker = CircuitBreaker(config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_RESET_TIMEOUT)
+
+
+def retry_delay(attempt, error=None):
+    """第attempt次重试前的等待时间：带随机抖动的指数退避，429优先使用Retry-After"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), config.API_RETRY_MAX_DELAY)
+            except ValueError:
+                pass
+    return random.uniform(0, min(config.API_RETRY_MAX_DELAY, config.API_RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def call_with_retry(func, can_retry=lambda: True):
+    """
+    经熔断器调用func，可重试的错误（超时、网络、429、5xx）按指数退避重试。
+    can_retry返回False时（如流式输出已开始）不再重试，避免重复输出。
+    """
+    attempt = 0
+    while True:
+        circuit_breaker.before_call()
+        try:
+            result = func()
+        except Exception as e:
+            kind, label, retryable = classify_error(e)
+            if kind not in ("auth", "bad_request", "unknown"):
+                circuit_breaker.record_failure()
+            if not retryable or attempt >= config.API_MAX_RETRIES or not can_retry():
+                raise
+            delay = retry_delay(attempt, e)
+            attempt += 1
+            print(f"[AI] {label}，{delay:.1f}秒后第{attempt}次重试：{str(e)}")
+            time.sleep(delay)
+            continue
+        circuit_breaker.record_success()
+        return result
+
+
+# -------------------------- 图片分析流程 --------------------------
+def build_messages(upload_data, mime_type, question, base64_image=None):
+    """Base64编码预处理后的图片（已有编码结果时直接使用）并构造请求消息，使用实际的MIME类型"""
+    if base64_image is None:
+        base64_image = pybase64.b64encode(upload_data).decode("ascii")
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}},
+                {"type": "text", "text": question}
+            ],
+        }
+    ]
+
+
+class ImageAnalyzer:
+    """
+    单张截图的完整分析流程（不依赖界面，界面的ApiThread和headless模式共用）：
+    回答缓存 → 近似截图去重 → 变化区域提取 → 预处理 → 调用模型（流式/非流式）→ 写入缓存。
+    流式增量通过回调输出，run()返回结果字典（含各阶段耗时）。
+    """
+
+    def __init__(self, image, question, on_reasoning=None, on_answer=None, on_answer_html=None, trace_id=None,
+                 diff_key=None):
+        # 图片：ImageAsset（界面传入，哈希和Base64编码与其他任务共用）或原始数据
+        self.asset = image if isinstance(image, ImageAsset) else ImageAsset(image)
+        self.image_data = self.asset.data
+        self.diff_key = diff_key      # 变化区域提取按该键（发送端）区分上一张截图，None=不提取（手动发送、批量分析）
+        self.crop = None              # 实际上传的区域（只上传变化区域时为 (左, 上, 右, 下)）
+        self.diff_frame = None        # 变化区域比较用的缩小图，分析成功后记为该发送端的比较基准
+        self.question = question      # 用户问题
+        self.trace_id = trace_id      # 追踪ID（非空时各阶段耗时写入追踪记录）
+        self.on_reasoning = on_reasoning      # 推理过程增量回调 (文本)
+        self.on_answer = on_answer            # 回答增量回调 (文本)
+        self.on_answer_html = on_answer_html  # 回答增量渲染回调 (新提交的HTML, 末尾块HTML)
+        self.ttft = None                      # 首字延迟（秒，流式模式下记录）
+        self.model = None                     # 实际返回结果的模型（对冲/快速模型回退后可能不是主模型）
+        self.render_time = 0.0                # Markdown渲染累计耗时（秒）
 
     def run(self):
+        """返回 {"reasoning", "answer", "source"(cache/dedup/unchanged/model/error), "error", "latencies", "model", "crop"}"""
+        result = self._run()
+        if self.trace_id:
+            latencies = dict(result["latencies"])
+            latencies["analysis"] = latencies.pop("total")
+            tracer.record_many(self.trace_id, latencies, source=result["source"])
+        tracer.count("analysis", source=result["source"])
+        return result
+
+    def _run(self):
+        latencies = {}
+        start_time = time.perf_counter()
+
+        # 持久化回答缓存：相同图片+问题+主模型直接返回
+        cache_key = None
+        if config.RESPONSE_CACHE_ENABLED:
+            cache_key = response_cache.make_key(self.asset.sha256, self.question, model_router.primary.model)
+            cached = response_cache.get(cache_key)
+            if cached:
+                reasoning, answer = cached
+                latencies["total"] = time.perf_counter() - start_time
+                return self._result(f"命中回答缓存，直接返回已保存的回答。{reasoning}", answer, "cache", latencies)
+
+        # 近似截图去重：命中则直接复用历史回答
+        image_print = self._fingerprint()
+        if image_print is not None:
+            cached = perceptual_cache.lookup(*image_print, self.question)
+            if cached:
+                reasoning, answer, distance = cached
+                latencies["total"] = time.perf_counter() - start_time
+                return self._result(f"与近期截图几乎相同（差异{distance}位），复用上次回答。{reasoning}",
+                                    answer, "dedup", latencies)
+
+        try:
+            # 变化区域提取：与同一发送端上一张已发送的截图比较，没有明显变化时跳过
+            question = self.question
+            if config.DIFF_ENABLED and self.diff_key is not None:
+                stage_start = time.perf_counter()
+                kind, self.crop, ratio = self._diff()
+                latencies["diff"] = time.perf_counter() - stage_start
+                if kind == DIFF_UNCHANGED:
+                    latencies["total"] = time.perf_counter() - start_time
+                    return self._result(f"与上一张截图相比没有明显变化（变化像素{ratio:.3%}）。",
+                                        "与上一张截图相比没有明显变化，已跳过分析。", "unchanged", latencies)
+                if kind == DIFF_CROP:
+                    question += DIFF_CROP_HINT
+
+            stage_start = time.perf_counter()
+            upload_data, mime_type = prepare_image(self.image_data, crop=self.crop)
+            latencies["preprocess"] = time.perf_counter() - stage_start
+            stage_start = time.perf_counter()
+            # 原图直接上传时复用图片资源的Base64编码（同一张图片再次发送不重复编码）
+            messages = build_messages(upload_data, mime_type, question,
+                                      self.asset.base64() if upload_data is self.image_data else None)
+            del upload_data
+            latencies["base64"] = time.perf_counter() - stage_start
+
+            stage_start = time.perf_counter()
+            if config.STREAM_ENABLED:
+                # 已经输出内容后出错不再重试，避免重复输出
+                reasoning, answer = call_with_retry(lambda: self._stream_completion(messages),
+                                                    can_retry=lambda: self.ttft is None)
+                latencies["ttft"] = self.ttft
+            else:
+                # 由模型路由选择模型（快速模型优先、对冲请求、故障切换）
+                route, completion = call_with_retry(lambda: model_router.complete(messages))
+                self.model = route.model
+                message = completion.choices[0].message
+                reasoning = getattr(message, "reasoning_content", None) or "模型不支持推理过程输出"
+                answer = message.content
+            latencies["model"] = time.perf_counter() - stage_start - self.render_time
+
+            if answer:
+                render_start = time.perf_counter()
+                render_markdown(answer)  # 在当前工作线程预先渲染，界面线程取用时直接命中缓存
+                self.render_time += time.perf_counter() - render_start
+                latencies["render"] = self.render_time
+                if self.diff_frame is not None:
+                    frame_differ.commit(self.diff_key, *self.diff_frame)
+                # 缓存按整张截图查找，只上传变化区域得到的回答不写入
+                if image_print is not None and self.crop is None:
+                    perceptual_cache.store(*image_print, self.question, reasoning, answer)
+                if cache_key is not None and self.crop is None:
+                    # 按实际给出回答的模型写入，快速模型/备用路由的回答不会被当作主模型的回答命中
+                    response_cache.put(response_cache.make_key(self.asset.sha256, self.question, self.model),
+                                       self.model, reasoning, answer)
+            latencies["total"] = time.perf_counter() - start_time
+            return self._result(reasoning, answer or "", "model", latencies)
+        except Exception as e:
+            # 错误信息（含错误分类）放在推理过程中返回
+            kind, label, _ = classify_error(e)
+            tracer.count("api_error", kind=kind)
+            latencies["total"] = time.perf_counter() - start_time
+            return self._result(f"调用失败（{label}）：{str(e)}", "", "error", latencies, error=f"{label}：{str(e)}")
+
+    def _result(self, reasoning, answer, source, latencies, error=None):
+        return {"reasoning": reasoning, "answer": answer, "source": source, "error": error, "latencies": latencies,
+                "model": self.model, "crop": self.crop}
+
+    def _stream_completion(self, messages):
+        """流式调用：逐块回调推理/回答增量，并记录首字延迟。返回 (推理过程, 回答内容)"""
+        start_time = time.perf_counter()
+        # 路由在首个内容块到达后才确定胜出的请求，已读取的数据块随后一并处理
+        route, stream, first_chunks, chunks = model_router.open_stream(messages)
+        self.model = route.model
+        reasoning_parts, answer_parts = [], []
+        renderer = StreamRenderer() if self.on_answer_html else None
+        last_render = 0.0
+        try:
+            for chunk in chain(first_chunks, chunks):
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                reasoning_delta = getattr(delta, "reasoning_content", None)
+                answer_delta = delta.content
+                if (reasoning_delta or answer_delta) and self.ttft is None:
+                    self.ttft = time.perf_counter() - start_time
+                    print(f"[AI] 首字延迟：{self.ttft:.2f}秒（模型：{route.model}）")
+                if reasoning_delta:
+                    reasoning_parts.append(reasoning_delta)
+                    if self.on_reasoning:
+                        self.on_reasoning(reasoning_delta)
+                if answer_delta:
+                    answer_parts.append(answer_delta)
+                    if self.on_answer:
+                        self.on_answer(answer_delta)
+                    if renderer:
+                        # Markdown渲染在当前工作线程完成，并按间隔节流，界面线程只负责插入HTML
+                        renderer.feed(answer_delta)
+                        now = time.perf_counter()
+                        if now - last_render >= config.STREAM_RENDER_INTERVAL:
+                            last_render = now
+                            rendered = renderer.render()
+                            self.render_time += time.perf_counter() - now
+                            self.on_answer_html(*rendered)
+        finally:
+            stream.close()
+        print(f"[AI] 流式输出完成，总耗时：{time.perf_counter() - start_time:.2f}秒")
+        return "".join(reasoning_parts) or "模型不支持推理过程输出", "".join(answer_parts)
+
+    def _diff(self):
+        """比较变化区域，图片无法解码时按整图发送。返回 (比较结果, 裁剪区域, 变化像素占比)"""
         try:
-            # 使用全局配置的OpenAI客户端
-            completion = config.client.chat.completions.create(
-                model="doubao-seed-1-6-251015",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{self.base64_image}"}},
-                            {"type": "text", "text": self.question}
-                        ],
-                    }
-                ]
-            )
-            reasoning = "模型不支持推理过程输出"  # 若模型支持可修改
-            answer = completion.choices[0].message.content
-            self.result_signal.emit(reasoning, answer)
+            kind, box, ratio, self.diff_frame = frame_differ.compare(self.diff_key, self.image_data)
         except Exception as e:
-            # 错误信息通过信号传递给UI
-            self.result_signal.emit(f"调用失败：{str(e)}", "")
+            print(f"[变化区域] 比较失败，发送整张截图：{str(e)}")
+            return None, None, 1.0
+        tracer.count("frame_diff", result=kind)
+        if kind == DIFF_CROP:
+            print(f"[变化区域] 变化像素{ratio:.2%}，只上传区域{box}")
+        return kind, box, ratio
+
+    def _fingerprint(self):
+        """计算截图的去重指纹 (dHash, 缩小灰度图)（去重关闭或图片无法解码时返回None）"""
+        if not config.DEDUP_ENABLED:
+            return None
+        try:
+            return fingerprint(self.image_data, config.DEDUP_HASH_SIZE, config.DEDUP_COMPARE_EDGE)
+        except Exception:
+            return None
 
 
 # -------------------------- 初始化AI客户端 --------------------------
 def init_ai_client(api_key):
-    """初始化OpenAI客户端，赋值给全局变量"""
+    """
+    初始化OpenAI客户端（共享连接池、显式超时，重试由call_with_retry负责），赋值给全局变量。
+    openai/httpx导入较慢（约0.4秒），推迟到这里导入，启动时可放到后台线程与窗口创建并行。
+    """
+    import httpx
+    from openai import OpenAI
+
+    timeout = httpx.Timeout(config.API_READ_TIMEOUT, connect=config.API_CONNECT_TIMEOUT)
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=config.API_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=config.API_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=config.API_KEEPALIVE_EXPIRY
+        ),
+        timeout=timeout
+    )
     config.client = OpenAI(
-        base_url="https://ark.cn-beijing.volces.com/api/v3",
-        api_key=api_key
+        base_url=config.API_BASE_URL,
+        api_key=api_key,
+        http_client=http_client,
+        timeout=timeout,
+        max_retries=0
     )
     return config.client
\ No newline at end of file
@@ -0,0 +1,320 @@
+# run_benchmark.py：端到端基准测试（合成发送端 → ImageServer → 目录监控 → AI分析 → Markdown渲染）
+#
+# 在同一进程内启动接收服务、目录监控和模拟模型服务，统计各阶段延迟的 p50/p95/p99、吞吐量和内存峰值，
+# 结果以JSON输出，可用 --baseline 与之前保存的结果比较，p95变慢超过容差时返回非零退出码。
+#
+#   python benchmarks/run_benchmark.py --count 50 --rate 10 -o bench.json
+#   python benchmarks/run_benchmark.py --count 50 --rate 10 --baseline bench.json
+import io
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import config  # noqa: E402
+from ai_handler import init_ai_client, ImageAnalyzer  # noqa: E402
+from image_server import ImageServer, STATUS_OK  # noqa: E402
+from sender import make_images, send_v2, send_legacy  # noqa: E402
+from stub_model import start_stub_server  # noqa: E402
+
+STAGES = ("receive", "detect", "preprocess", "encode", "model", "ttft", "render", "end_to_end")
+DEFAULT_TOLERANCE = 0.2  # 与基线比较时允许的p95变慢比例
+
+
+# -------------------------- 统计工具 --------------------------
+def percentile(sorted_values, p):
+    """最近秩法百分位数（sorted_values 需已排序）"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(values):
+    """秒 → 毫秒的延迟分布摘要"""
+    values = sorted(v * 1000 for v in values if v is not None)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(values[-1], 3),
+    }
+
+
+def peak_rss_mb():
+    """进程内存峰值（MB），平台不支持时返回None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux单位为KB，macOS为字节
+        return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / 1024 / 1024, 1)
+    except ImportError:
+        return None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# -------------------------- 基准测试 --------------------------
+class PipelineBenchmark:
+    """记录每张图片在各阶段的时间点（均为 time.perf_counter）"""
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.sent = {}      # 文件名 -> 开始发送时间
+        self.acked = {}     # 文件名 -> 收到确认时间
+        self.detected = {}  # 文件名 -> 被监控发现（或进程内回调）的时间
+        self.detect_latency = {}  # 文件名 -> 文件写完（修改时间）到被监控发现的耗时（秒）
+        self.results = {}   # 文件名 -> 分析结果
+        self.done_time = {}
+        self.names = {}     # 序号 -> 文件名
+        self.failed_sends = 0
+        self.all_done = threading.Event()
+        self.analysis_pool = ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="bench-ai")
+
+    # ---- 发送端回调 ----
+    def on_sent(self, seq, name):
+        with self.lock:
+            self.names[seq] = name
+            self.sent[name] = time.perf_counter()
+
+    def on_ack(self, seq, status):
+        now = time.perf_counter()
+        with self.lock:
+            name = self.names.get(seq)
+            if status == STATUS_OK:
+                self.acked[name] = now
+            else:
+                self.failed_sends += 1
+                self._check_done()
+
+    # ---- 接收端回调 ----
+    def on_detected(self, path):
+        """目录监控发现新图片（或进程内模式收到图片），读取后交给分析线程池"""
+        name = os.path.basename(path)
+        now = time.perf_counter()
+        try:
+            # 与追踪记录一致：从文件写完（重命名前的最后修改时间）算起，不依赖发送端何时读到确认
+            latency = max(0.0, time.time() - os.stat(path).st_mtime)
+        except OSError:
+            latency = None
+        with self.lock:
+            if name in self.detected:
+                return
+            self.detected[name] = now
+            self.detect_latency[name] = latency
+        self.analysis_pool.submit(self._analyze, name, path)
+
+    def on_image(self, filename, image_data, meta):
+        with self.lock:
+            self.detected[filename] = time.perf_counter()
+        self.analysis_pool.submit(self._analyze, filename, None, image_data)
+
+    def _analyze(self, name, path, image_data=None):
+        if image_data is None:
+            with open(path, "rb") as f:
+                image_data = f.read()
+        result = ImageAnalyzer(image_data, self.args.question, on_answer_html=lambda committed, tail: None).run()
+        with self.lock:
+            self.results[name] = result
+            self.done_time[name] = time.perf_counter()
+            self._check_done()
+
+    def _check_done(self):
+        if len(self.results) + self.failed_sends >= self.args.count:
+            self.all_done.set()
+
+    # ---- 汇总 ----
+    def report(self, wall_time, total_bytes):
+        stage_values = {stage: [] for stage in STAGES}
+        errors = 0
+        for name, result in self.results.items():
+            latencies = result["latencies"]
+            if result["error"]:
+                errors += 1
+            if name in self.acked:
+                stage_values["receive"].append(self.acked[name] - self.sent[name])
+            if self.args.mode == "monitor":
+                stage_values["detect"].append(self.detect_latency.get(name))
+            stage_values["preprocess"].append(latencies.get("preprocess"))
+            stage_values["encode"].append(latencies.get("base64"))
+            stage_values["model"].append(latencies.get("model"))
+            stage_values["ttft"].append(latencies.get("ttft"))
+            stage_values["render"].append(latencies.get("render"))
+            stage_values["end_to_end"].append(self.done_time[name] - self.sent[name])
+
+        completed = len(self.results)
+        return {
+            "benchmark": "pipeline",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {key: getattr(self.args, key) for key in
+                       ("mode", "protocol", "count", "rate", "width", "height", "format", "noise", "workers",
+                        "stream", "ttft", "tokens", "token_interval")},
+            "completed": completed,
+            "errors": errors,
+            "failed_sends": self.failed_sends,
+            "wall_time_s": round(wall_time, 3),
+            "throughput": {
+                "images_per_s": round(completed / wall_time, 3) if wall_time else None,
+                "mb_per_s": round(total_bytes / 1024 / 1024 / wall_time, 3) if wall_time else None,
+            },
+            "peak_rss_mb": peak_rss_mb(),
+            "stages_ms": {stage: summarize(values) for stage, values in stage_values.items()},
+        }
+
+
+def run(args):
+    """执行一次基准测试，返回结果字典"""
+    # 关闭缓存，保证每张图片都完整走一遍流程
+    config.RESPONSE_CACHE_ENABLED = False
+    config.DEDUP_ENABLED = False
+    config.STREAM_ENABLED = args.stream
+
+    stub = None
+    if args.model_url:
+        config.API_BASE_URL = args.model_url
+    else:
+        stub = start_stub_server(ttft=args.ttft, tokens=args.tokens, token_interval=args.token_interval)
+        config.API_BASE_URL = stub.base_url
+    init_ai_client(os.environ.get("ARK_API_KEY", "benchmark"))
+
+    bench = PipelineBenchmark(args)
+    save_dir = tempfile.mkdtemp(prefix="bench-screenshots-")
+    port = free_port()
+    server = ImageServer(save_dir=save_dir, port=port, max_workers=config.RECEIVER_MAX_WORKERS,
+                         max_connections=config.RECEIVER_MAX_CONNECTIONS,
+                         on_image=bench.on_image if args.mode == "inprocess" else None, persist=False)
+    threading.Thread(target=server.start, daemon=True).start()
+    if not server.ready.wait(5):
+        raise RuntimeError("接收服务启动失败")
+
+    observer = file_handler = None
+    if args.mode == "monitor":
+        from watchdog.observers import Observer
+        from monitor_handler import ImageFileHandler
+        observer = Observer()
+        file_handler = ImageFileHandler(bench.on_detected)
+        observer.schedule(file_handler, save_dir, recursive=False)
+        observer.start()
+
+    images = make_images(args.count, args.width, args.height, args.format, args.noise)
+    total_bytes = sum(len(data) for data in images)
+    send = send_v2 if args.protocol == "v2" else send_legacy
+    print(f"[基准测试] 发送{args.count}张 {args.width}x{args.height} {args.format}"
+          f"（共{total_bytes / 1024 / 1024:.1f}MB），模式：{args.mode}，协议：{args.protocol}", file=sys.stderr)
+
+    start_time = time.perf_counter()
+    try:
+        send("127.0.0.1", port, images, args.rate, args.format, on_sent=bench.on_sent, on_ack=bench.on_ack)
+        if not bench.all_done.wait(args.timeout):
+            print(f"[基准测试] 等待超时，仅完成{len(bench.results)}张", file=sys.stderr)
+        wall_time = time.perf_counter() - start_time
+    finally:
+        if observer:
+            observer.stop()
+            observer.join()
+            file_handler.stop()
+        server.stop()
+        bench.analysis_pool.shutdown(wait=False)
+        if stub:
+            stub.shutdown()
+        shutil.rmtree(save_dir, ignore_errors=True)
+    return bench.report(wall_time, total_bytes)
+
+
+def compare(result, baseline, tolerance):
+    """比较各阶段p95，返回变慢超过容差的阶段列表"""
+    regressions = []
+    for stage, current in result["stages_ms"].items():
+        previous = baseline.get("stages_ms", {}).get(stage, {})
+        if current.get("p95") is None or not previous.get("p95"):
+            continue
+        ratio = current["p95"] / previous["p95"]
+        if ratio > 1 + tolerance:
+            regressions.append(f"{stage}: p95 {previous['p95']:.1f}ms → {current['p95']:.1f}ms（+{(ratio - 1):.0%}）")
+    return regressions
+
+
+def print_summary(result):
+    print(f"[基准测试] 完成{result['completed']}张，出错{result['errors']}张，耗时{result['wall_time_s']}秒，"
+          f"吞吐{result['throughput']['images_per_s']}张/秒，内存峰值{result['peak_rss_mb']}MB", file=sys.stderr)
+    print(f"{'阶段':<12}{'p50':>10}{'p95':>10}{'p99':>10}  (ms)", file=sys.stderr)
+    for stage, stats in result["stages_ms"].items():
+        if stats["count"]:
+            print(f"{stage:<12}{stats['p50']:>10.1f}{stats['p95']:>10.1f}{stats['p99']:>10.1f}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="截图分析端到端基准测试")
+    parser.add_argument("--mode", choices=("monitor", "inprocess"), default="monitor",
+                        help="monitor=落盘+目录监控（subprocess模式的路径），inprocess=进程内直接回调")
+    parser.add_argument("--protocol", choices=("v2", "legacy"), default="v2")
+    parser.add_argument("--count", type=int, default=30, help="发送图片数量")
+    parser.add_argument("--rate", type=float, default=10, help="发送速率（张/秒，0=不限速）")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--format", choices=("PNG", "JPEG"), default="PNG")
+    parser.add_argument("--noise", action="store_true", help="使用随机噪声图片（几乎不可压缩）")
+    parser.add_argument("--workers", type=int, default=config.MAX_CONCURRENT_JOBS, help="并发分析数")
+    parser.add_argument("--question", default="请分析这张截图的内容。")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="使用非流式调用")
+    parser.add_argument("--model-url", default=None, help="使用已有的模型接口地址，不启动内置模拟服务")
+    parser.add_argument("--ttft", type=float, default=0.2, help="模拟服务首字延迟（秒）")
+    parser.add_argument("--tokens", type=int, default=40, help="模拟服务回答分段数")
+    parser.add_argument("--token-interval", type=float, default=0.005, help="模拟服务分段间隔（秒）")
+    parser.add_argument("--timeout", type=float, default=300, help="等待全部分析完成的最长时间（秒）")
+    parser.add_argument("--output", "-o", default=None, help="结果JSON文件（默认输出到标准输出）")
+    parser.add_argument("--baseline", default=None, help="基线结果JSON，p95变慢超过容差时退出码为1")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="允许的p95变慢比例")
+    parser.add_argument("--verbose", action="store_true", help="显示接收服务和AI调用的日志")
+    args = parser.parse_args()
+
+    # 接收服务和AI调用的日志打印到标准输出，默认屏蔽以免混入JSON结果
+    log_target = sys.stderr if args.verbose else io.StringIO()
+    with contextlib.redirect_stdout(log_target):
+        result = run(args)
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    print_summary(result)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("[基准测试] 性能回退：\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+        print("[基准测试] 与基线相比无明显回退", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
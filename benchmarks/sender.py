@@ -0,0 +1,166 @@
+# sender.py：合成截图发送端（按 image_server.py 的传输协议发送指定尺寸、速率的图片）
+#
+# 单独使用：python benchmarks/sender.py --port 7893 --count 50 --width 1920 --height 1080 --rate 5
+import io
+import os
+import sys
+import time
+import random
+import socket
+import struct
+import argparse
+import threading
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_server import (PROTOCOL_MAGIC, PROTOCOL_VERSION, FRAME_HEADER, FRAME_ACK,  # noqa: E402
+                          FRAME_FILE, FRAME_BYE, STATUS_OK)
+
+CONTENT_TYPE_CODES = {"PNG": 1, "JPEG": 2}
+
+
+# -------------------------- 合成截图 --------------------------
+def make_image(width, height, fmt="PNG", noise=False, seed=None):
+    """
+    生成一张合成截图：默认为纯色背景+随机色块（压缩率接近真实截图），
+    noise=True 时为随机噪声（几乎不可压缩，用于测试大文件传输）
+    """
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    if noise:
+        image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    else:
+        image = Image.new("RGB", (width, height), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(40):
+            x, y = rng.randrange(width), rng.randrange(height)
+            draw.rectangle((x, y, x + rng.randrange(20, 400), y + rng.randrange(8, 120)),
+                           fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    buffer = io.BytesIO()
+    image.save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def make_images(count, width, height, fmt="PNG", noise=False, variants=8):
+    """生成 count 张图片（最多 variants 种不同内容循环使用，避免生成耗时影响发送速率）"""
+    pool = [make_image(width, height, fmt, noise, seed=i) for i in range(min(count, variants))]
+    return [pool[i % len(pool)] for i in range(count)]
+
+
+# -------------------------- 发送 --------------------------
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("服务端关闭了连接")
+        data += chunk
+    return data
+
+
+def _pace(start_time, index, rate):
+    """按目标速率（张/秒）等待到第 index 张的发送时间，rate<=0 表示不限速"""
+    if rate > 0:
+        delay = start_time + index / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def send_v2(host, port, images, rate=0.0, fmt="PNG", prefix="bench", on_sent=None, on_ack=None):
+    """
+    v2协议：一条长连接流水线发送所有图片，后台线程按序号接收确认。
+    on_sent(序号, 文件名) 在开始发送该帧时调用，on_ack(序号, 状态码) 在收到确认时调用。
+    返回 (成功数, 失败数)
+    """
+    ext = ".jpg" if fmt == "JPEG" else ".png"
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION]))
+    reply = _recv_exact(sock, len(PROTOCOL_MAGIC) + 1)
+    if reply[-1] != PROTOCOL_VERSION:
+        sock.close()
+        raise ConnectionError(f"服务端不支持v2协议：{reply!r}")
+
+    counts = {"ok": 0, "failed": 0}
+
+    def read_acks():
+        for _ in range(len(images)):
+            seq, status = FRAME_ACK.unpack(_recv_exact(sock, FRAME_ACK.size))
+            counts["ok" if status == STATUS_OK else "failed"] += 1
+            if on_ack:
+                on_ack(seq, status)
+
+    ack_thread = threading.Thread(target=read_acks, daemon=True)
+    ack_thread.start()
+    start_time = time.perf_counter()
+    try:
+        for seq, data in enumerate(images):
+            _pace(start_time, seq, rate)
+            name = f"{prefix}-{seq:06d}{ext}"
+            if on_sent:
+                on_sent(seq, name)
+            name_bytes = name.encode("utf-8")
+            header = FRAME_HEADER.pack(FRAME_FILE, CONTENT_TYPE_CODES.get(fmt, 0), len(name_bytes),
+                                       seq, len(data), zlib.crc32(data))
+            sock.sendall(header + name_bytes)
+            sock.sendall(data)
+        ack_thread.join()
+        sock.sendall(FRAME_HEADER.pack(FRAME_BYE, 0, 0, 0, 0, 0))
+    finally:
+        sock.close()
+    return counts["ok"], counts["failed"]
+
+
+def send_legacy(host, port, images, rate=0.0, fmt="PNG", prefix="bench", on_sent=None, on_ack=None):
+    """旧版协议：每张图片一个连接，服务端关闭连接即视为接收完成。返回 (成功数, 失败数)"""
+    ext = ".jpg" if fmt == "JPEG" else ".png"
+    ok = failed = 0
+    start_time = time.perf_counter()
+    for seq, data in enumerate(images):
+        _pace(start_time, seq, rate)
+        name = f"{prefix}-{seq:06d}{ext}"
+        if on_sent:
+            on_sent(seq, name)
+        name_bytes = name.encode("utf-8")
+        try:
+            with socket.create_connection((host, port)) as sock:
+                sock.sendall(struct.pack("!I", len(name_bytes)) + name_bytes + struct.pack("!I", len(data)))
+                sock.sendall(data)
+                sock.shutdown(socket.SHUT_WR)
+                sock.recv(1)  # 等待服务端处理完毕并关闭连接
+            ok += 1
+            status = STATUS_OK
+        except OSError:
+            failed += 1
+            status = -1
+        if on_ack:
+            on_ack(seq, status)
+    return ok, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合成截图发送端")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7893)
+    parser.add_argument("--count", type=int, default=20, help="发送图片数量")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--format", choices=sorted(CONTENT_TYPE_CODES), default="PNG")
+    parser.add_argument("--noise", action="store_true", help="使用随机噪声图片（几乎不可压缩）")
+    parser.add_argument("--rate", type=float, default=0, help="发送速率（张/秒，0=不限速）")
+    parser.add_argument("--protocol", choices=("v2", "legacy"), default="v2")
+    args = parser.parse_args()
+
+    images = make_images(args.count, args.width, args.height, args.format, args.noise)
+    total_bytes = sum(len(data) for data in images)
+    send = send_v2 if args.protocol == "v2" else send_legacy
+    start_time = time.perf_counter()
+    ok, failed = send(args.host, args.port, images, args.rate, args.format)
+    elapsed = time.perf_counter() - start_time
+    print(f"[发送端] 成功{ok}张，失败{failed}张，共{total_bytes / 1024 / 1024:.1f}MB，"
+          f"耗时{elapsed:.2f}秒（{ok / elapsed:.1f}张/秒，{total_bytes / 1024 / 1024 / elapsed:.1f}MB/秒）")
+
+
+if __name__ == "__main__":
+    main()
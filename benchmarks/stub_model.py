@@ -0,0 +1,133 @@
+# stub_model.py：本地兼容OpenAI接口的模拟模型服务（可配置延迟、流式输出），供基准测试使用
+#
+# 单独使用：python benchmarks/stub_model.py --port 18080 --ttft 0.3 --tokens 60
+# 然后设置环境变量 ARK_BASE_URL=http://127.0.0.1:18080/v1 启动程序
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 模拟回答：包含标题、列表和代码块，让Markdown渲染阶段有真实的工作量
+SAMPLE_ANSWER = (
+    "## 分析结果\n\n截图中是一个代码编辑器窗口，需要完成以下步骤：\n\n"
+    "1. 打开设置页面\n2. 修改配置项\n3. 保存并重启\n\n"
+    "```python\nimport config\n\nconfig.MAX_CONCURRENT_JOBS = 4\nprint(config.MAX_CONCURRENT_JOBS)\n```\n\n"
+    "| 参数 | 说明 |\n| --- | --- |\n| 并发数 | 同时进行的请求数 |\n\n完成后重新运行程序即可。"
+)
+SAMPLE_REASONING = "先识别截图中的窗口和文字，再根据问题整理操作步骤。"
+
+
+def split_tokens(text, count):
+    """把文本切成约 count 段，模拟逐token输出"""
+    size = max(1, len(text) // max(1, count))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class StubModelServer(ThreadingHTTPServer):
+    """模拟 /v1/chat/completions：ttft=首字延迟，tokens=回答分段数，token_interval=分段间隔，error_rate=返回503的比例"""
+    daemon_threads = True
+
+    def __init__(self, address, ttft=0.3, tokens=40, token_interval=0.01, error_rate=0.0):
+        super().__init__(address, StubModelHandler)
+        self.ttft = ttft
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.error_rate = error_rate
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def next_request(self):
+        with self._lock:
+            self.request_count += 1
+            return self.request_count
+
+
+class StubModelHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        server = self.server
+        number = server.next_request()
+        if int(number * server.error_rate) != int((number - 1) * server.error_rate):  # 均匀地按比例出错
+            self._send_json(503, {"error": {"message": "模拟服务繁忙", "type": "overloaded"}})
+            return
+
+        model = body.get("model", "stub")
+        time.sleep(server.ttft)
+        if body.get("stream"):
+            self._stream(model)
+        else:
+            time.sleep(server.token_interval * server.tokens)
+            self._send_json(200, {
+                "id": f"stub-{number}", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {
+                    "role": "assistant", "content": SAMPLE_ANSWER, "reasoning_content": SAMPLE_REASONING}}],
+            })
+
+    def _stream(self, model):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def chunk(delta):
+            return json.dumps({"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                               "model": model, "choices": [{"index": 0, "delta": delta}]})
+
+        send_event(chunk({"reasoning_content": SAMPLE_REASONING}))
+        for token in split_tokens(SAMPLE_ANSWER, self.server.tokens):
+            time.sleep(self.server.token_interval)
+            send_event(chunk({"content": token}))
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_stub_server(port=0, **options):
+    """在后台线程启动模拟服务（port=0 自动分配端口），返回服务对象"""
+    server = StubModelServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="兼容OpenAI接口的模拟模型服务")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--ttft", type=float, default=0.3, help="首字延迟（秒）")
+    parser.add_argument("--tokens", type=int, default=40, help="回答分段数")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="分段输出间隔（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回503的请求比例（0~1）")
+    args = parser.parse_args()
+
+    server = StubModelServer(("127.0.0.1", args.port), ttft=args.ttft, tokens=args.tokens,
+                             token_interval=args.token_interval, error_rate=args.error_rate)
+    print(f"[模拟模型] 已启动：{server.base_url}（按Ctrl+C停止）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
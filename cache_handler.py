@@ -0,0 +1,202 @@
+# cache_handler.py：分析结果缓存（近似截图去重、持久化回答缓存）
+import io
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageChops
+import config  # 导入全局配置
+
+
+# -------------------------- 感知哈希 --------------------------
+def dhash(image_data, hash_size=16):
+    """计算图片的差值哈希（dHash），返回 hash_size*hash_size 位整数"""
+    with Image.open(io.BytesIO(image_data)) as img:
+        # JPEG可直接按缩小尺寸解码，大图省去大部分解码开销
+        img.draft("L", (hash_size * 16, hash_size * 16))
+        return _dhash_bits(img.convert("L"), hash_size)
+
+
+def fingerprint(image_data, hash_size=16, compare_edge=512):
+    """近似截图去重用的指纹：(dHash, 缩小灰度图)，图片只解码一次；灰度图用于命中后的逐像素确认"""
+    with Image.open(io.BytesIO(image_data)) as img:
+        scale = min(1.0, compare_edge / max(img.size))
+        target = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img.draft("L", target)
+        small = img.convert("L")
+    if small.size != target:
+        small = small.resize(target, Image.BILINEAR, reducing_gap=2.0)
+    return _dhash_bits(small, hash_size), small
+
+
+def _dhash_bits(gray, hash_size):
+    small = gray.resize((hash_size + 1, hash_size), Image.BILINEAR, reducing_gap=2.0)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+# -------------------------- 近似截图去重缓存 --------------------------
+class PerceptualCache:
+    """
+    保存最近截图的指纹及其AI回答（LRU）。同一问题下dHash汉明距离不超过阈值的截图只是候选，
+    还要逐像素比较缩小灰度图（ImageChops，在C层完成）：灰度差值超过 pixel_threshold 的像素不超过
+    max_changed_pixels 才视为重复截图。版式相同、只有文字不同的截图dHash可能完全相同，由这一步排除。
+    """
+
+    def __init__(self, max_entries=64, threshold=16, pixel_threshold=24, max_changed_pixels=0):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.max_changed_pixels = max_changed_pixels
+        self._entries = OrderedDict()  # (图片哈希, 问题) -> (缩小灰度图, 推理过程, 回答内容)
+        self._lock = threading.Lock()  # 多个AI线程可能同时读写
+        # 像素差值 -> 0/255 的查找表：超过阈值的视为不同（过滤压缩噪声）
+        self._table = [255 if value > pixel_threshold else 0 for value in range(256)]
+
+    def lookup(self, image_hash, small, question):
+        """查找近似截图的历史回答，命中返回 (推理过程, 回答内容, 汉明距离)，否则返回None"""
+        with self._lock:
+            candidates = []
+            for key, entry in self._entries.items():
+                if key[1] != question:
+                    continue
+                distance = hamming_distance(key[0], image_hash)
+                if distance <= self.threshold:
+                    candidates.append((distance, key, entry))
+            candidates.sort(key=lambda item: item[0])
+            for distance, key, (cached_small, reasoning, answer) in candidates:
+                if self._same_pixels(cached_small, small):
+                    self._entries.move_to_end(key)
+                    return reasoning, answer, distance
+            return None
+
+    def _same_pixels(self, a, b):
+        if a.size != b.size:
+            return False
+        changed = ImageChops.difference(a, b).point(self._table)
+        return changed.histogram()[255] <= self.max_changed_pixels
+
+    def store(self, image_hash, small, question, reasoning, answer):
+        with self._lock:
+            key = (image_hash, question)
+            self._entries[key] = (small, reasoning, answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# -------------------------- 持久化回答缓存 --------------------------
+class ResponseCache:
+    """
+    以 图片内容+问题+模型 的哈希为键的SQLite回答缓存，重启后依然有效。
+    支持过期时间（TTL）和条目数上限（按最近访问时间淘汰），每个线程使用独立连接，WAL模式下可并发读取。
+    """
+
+    EVICT_EVERY = 32  # 每写入多少条执行一次淘汰
+
+    def __init__(self, db_path, ttl=7 * 24 * 3600, max_entries=5000):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+
+    @staticmethod
+    def make_key(image_sha256, question, model):
+        """回答缓存键：图片内容哈希（ImageAsset.sha256）+ 问题 + 模型"""
+        digest = hashlib.sha256(image_sha256.encode("ascii"))
+        digest.update(b"\0" + question.encode("utf-8") + b"\0" + model.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, reasoning TEXT, answer TEXT, "
+                "created_at REAL, last_access REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """命中返回 (推理过程, 回答内容)，未命中或已过期返回None"""
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute("SELECT reasoning, answer, created_at FROM responses WHERE key=?", (key,)).fetchone()
+        if row is None or now - row[2] > self.ttl:
+            if row is not None:
+                conn.execute("DELETE FROM responses WHERE key=?", (key,))
+                conn.commit()
+            self._count(False)
+            return None
+        conn.execute("UPDATE responses SET last_access=? WHERE key=?", (now, key))
+        conn.commit()
+        self._count(True)
+        return row[0], row[1]
+
+    def put(self, key, model, reasoning, answer):
+        conn = self._conn()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, reasoning, answer, created_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, reasoning, answer, now, now)
+        )
+        conn.commit()
+        with self._stats_lock:
+            self._puts += 1
+            need_evict = self._puts % self.EVICT_EVERY == 0
+        if need_evict:
+            self.evict()
+
+    def evict(self):
+        """删除过期条目，并按最近访问时间淘汰超出上限的条目"""
+        conn = self._conn()
+        conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        conn.commit()
+
+    def stats(self):
+        """返回命中/未命中次数和当前条目数"""
+        entries = self._conn().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        with self._stats_lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+# 全局共用的缓存实例
+perceptual_cache = PerceptualCache(config.DEDUP_CACHE_SIZE, config.DEDUP_HAMMING_THRESHOLD,
+                                   config.DEDUP_PIXEL_THRESHOLD, config.DEDUP_MAX_CHANGED_PIXELS)
+response_cache = ResponseCache(config.RESPONSE_CACHE_PATH, config.RESPONSE_CACHE_TTL, config.RESPONSE_CACHE_MAX_ENTRIES)
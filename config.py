@@ -6,7 +6,89 @@ DEFAULT_API_KEY = "cbb4f72b-7880-4e53-995c-3ae71df8c313"
 DEFAULT_SERVER_PORT = 7893  # 客户端/服务端通信端口
 DEFAULT_MONITOR_DIR = "received_screenshots"  # 截图保存/监控目录
 DEFAULT_CLEAR_INTERVAL = 180  # 自动清屏间隔（秒，默认3分钟）
+HISTORY_MAX_BLOCKS = 3000  # 对话区最多保留的文本块数，超出时按整条消息删除最早的内容（正在流式输出的消息保留）
 WAIT_SECONDS_AFTER_ANALYSIS = 30  # AI分析后等待间隔（秒）
+MAX_CONCURRENT_JOBS = 3  # 同时进行的AI分析请求数
+JOB_QUEUE_SIZE = 10  # 等待分析的截图队列上限（超出时丢弃最早的截图）
+RECEIVER_MAX_WORKERS = 8  # 截图接收服务同时接收数据的连接数上限（v2长连接帧间空闲时不占用）
+RECEIVER_MAX_CONNECTIONS = 64  # 截图接收服务同时保持的连接数上限（含帧间空闲的v2长连接）
+RECEIVER_READ_TIMEOUT = 15  # 截图接收服务单连接读超时（秒）
+RECEIVER_MAX_IMAGE_BYTES = 64 * 1024 * 1024  # 单张截图大小上限（字节），超出直接拒绝
+RECEIVER_MAX_INFLIGHT_BYTES = 256 * 1024 * 1024  # 所有连接正在接收的数据总量上限（字节，0=不限），超出时新截图等待或被拒绝
+RECEIVER_CLIENT_RATE = 0  # 单个客户端（按IP）上传速率上限（字节/秒，0=不限），超出时放慢接收
+# 截图接收模式："subprocess"=独立后台进程+目录监控；"inprocess"=在界面进程内接收，图片数据直接交给AI分析
+RECEIVER_MODE = "subprocess"
+# 后台接收服务的工作进程数：>=1 时由监管进程启动并自动重启工作进程，多个工作进程以SO_REUSEPORT共享端口
+# （Windows不支持SO_REUSEPORT，固定为1个）；0=不使用监管进程，单进程运行
+RECEIVER_PROCESSES = 1
+RECEIVER_PERSIST = True  # inprocess模式下是否在后台异步保存截图到监控目录
+RECEIVER_LOG_LEVEL = "INFO"  # 截图接收服务日志级别（DEBUG会记录连接和接收进度）
+RECEIVER_LOG_BUFFER = 500  # 界面保留的接收服务日志条数（在「接收日志」窗口查看）
+STORE_ENABLED = True  # 截图库：按内容哈希命名分目录保存截图，建立索引（接收时间、发送端、分析状态）并定期淘汰
+STORE_MAX_BYTES = 2 * 1024 ** 3  # 截图库容量上限（字节，超出后按最近访问时间淘汰，0=不限）
+STORE_MAX_AGE = 30 * 24 * 3600  # 截图保留时间（秒，默认30天，0=不限）
+STORE_RECOMPRESS_AGE = 24 * 3600  # PNG/BMP截图超过该时间后在后台重新压缩为无损WebP并归档（秒，0=不压缩）
+STORE_MAINTENANCE_INTERVAL = 60  # 截图库淘汰/重新压缩的执行间隔（秒）
+# 近似截图去重：与最近截图几乎相同时直接复用上次回答，不再调用AI（默认关闭：只有文字不同的截图一旦被误判，
+# 会直接得到另一道题的回答）
+DEDUP_ENABLED = False
+DEDUP_HASH_SIZE = 16  # dHash边长（16=256位哈希），汉明距离不超过阈值的截图再逐像素确认
+DEDUP_HAMMING_THRESHOLD = 16  # dHash汉明距离阈值（256位哈希，越小越严格，0=仅哈希完全相同）
+DEDUP_COMPARE_EDGE = 512  # 逐像素确认时把截图缩小到的最长边（像素）
+DEDUP_PIXEL_THRESHOLD = 24  # 灰度差值超过该值的像素视为不同（0~255，过滤压缩噪声）
+DEDUP_MAX_CHANGED_PIXELS = 0  # 缩小图中不同像素不超过该数量才视为重复截图（0=不能有任何可见差异）
+DEDUP_CACHE_SIZE = 64  # 去重缓存保留的最近截图数量
+DIFF_ENABLED = False  # 变化区域提取：自动分析的新截图与同一发送端上一张分析成功的截图比较，只上传变化区域，无明显变化时跳过
+DIFF_COMPARE_EDGE = 1024  # 比较时把截图缩小到的最长边（像素）
+DIFF_PIXEL_THRESHOLD = 24  # 灰度差值超过该值的像素视为变化（0~255，过滤压缩噪声）
+DIFF_MIN_CHANGED_RATIO = 0.00005  # 变化像素占比低于该值视为没有明显变化（默认约为比较图中30个像素）
+DIFF_MARGIN = 48  # 裁剪区域在变化范围外保留的边距（像素）
+DIFF_MAX_CROP_RATIO = 0.6  # 变化区域超过整图面积的该比例时仍发送整张截图
+RESPONSE_CACHE_ENABLED = True  # 持久化回答缓存：相同图片+问题+模型直接返回已保存的回答（重启后有效）
+RESPONSE_CACHE_PATH = "response_cache.sqlite3"  # 回答缓存数据库文件
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # 回答缓存有效期（秒，默认7天）
+RESPONSE_CACHE_MAX_ENTRIES = 5000  # 回答缓存最多保留的条目数
+MODEL_NAME = "doubao-seed-1-6-251015"  # 图片分析使用的模型
+# 模型路由：按优先级排列，每项 {"name", "model", "base_url", "api_key", "timeout"}，除model外均可省略
+# （省略base_url/api_key时使用全局接口设置，timeout为该路由单次请求超时秒数）；为空时只使用 MODEL_NAME
+MODEL_ROUTES = []
+FAST_MODEL_ROUTE = None  # 快速模型（格式同上，timeout未设置时使用 HEDGE_INITIAL_DELAY）：先请求快速模型，超时或失败后再走 MODEL_ROUTES
+HEDGE_ENABLED = True  # 对冲请求：主路由超过近期P95耗时仍未返回时再发一个请求，先返回者胜出（落败的流式请求关闭连接，非流式请求执行完后丢弃结果）
+HEDGE_PERCENTILE = 95  # 对冲等待时间取主路由近期耗时（流式为首字时间）的分位数
+HEDGE_MIN_SAMPLES = 20  # 耗时样本不足该数量时使用 HEDGE_INITIAL_DELAY
+HEDGE_INITIAL_DELAY = 10  # 样本不足时的对冲等待时间（秒）
+HEDGE_MIN_DELAY = 1  # 对冲等待时间下限（秒）
+HEDGE_MAX_DELAY = 30  # 对冲等待时间上限（秒）
+HEDGE_WINDOW = 200  # 每个路由保留的最近耗时样本数
+STREAM_ENABLED = True  # 流式输出：边生成边显示推理过程和回答
+STREAM_RENDER_INTERVAL = 0.1  # 流式输出时Markdown增量渲染的最短间隔（秒）
+RENDER_CACHE_SIZE = 256  # Markdown渲染结果缓存条数
+TRACE_ENABLED = True  # 分阶段耗时追踪：写入滚动JSONL追踪文件
+TRACE_DIR = "traces"  # 追踪文件目录（每个进程一个 trace-<进程>.jsonl）
+TRACE_MAX_BYTES = 10 * 1024 * 1024  # 单个追踪文件大小上限（超出后滚动）
+TRACE_BACKUP_COUNT = 3  # 保留的历史追踪文件数
+METRICS_PORT = 9464  # Prometheus格式指标接口端口（仅监听本机，0=关闭；后台接收服务的工作进程依次使用该端口+1、+2…）
+# -------------------------- AI接口连接参数 --------------------------
+# 接口地址，可用环境变量 ARK_BASE_URL 指向本地兼容OpenAI的测试服务
+API_BASE_URL = os.environ.get("ARK_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
+API_CONNECT_TIMEOUT = 5  # 建立连接超时（秒）
+API_READ_TIMEOUT = 120  # 读取响应超时（秒，流式模式下为两次数据之间的最长间隔）
+API_MAX_RETRIES = 2  # 超时/网络错误/429/5xx 的最大重试次数
+API_RETRY_BASE_DELAY = 0.5  # 重试退避基准时间（秒，按2的指数增长并加随机抖动）
+API_RETRY_MAX_DELAY = 8  # 单次重试最长等待（秒）
+API_POOL_MAX_CONNECTIONS = 20  # 连接池最大连接数
+API_POOL_MAX_KEEPALIVE = 10  # 连接池保持的空闲长连接数
+API_KEEPALIVE_EXPIRY = 60  # 空闲长连接保留时间（秒）
+CIRCUIT_FAILURE_THRESHOLD = 5  # 连续失败多少次后熔断
+CIRCUIT_RESET_TIMEOUT = 30  # 熔断持续时间（秒），之后放行一个试探请求
+# -------------------------- 图片预处理（上传前） --------------------------
+PREPROCESS_ENABLED = True  # 是否在上传前缩放并重新编码截图
+IMAGE_MAX_EDGE = 2048  # 最长边上限（像素，None=不限制）
+IMAGE_MAX_PIXELS = 4_000_000  # 总像素上限（None=不限制）
+IMAGE_GRAYSCALE = False  # 是否转为灰度图（纯文字截图可开启以进一步减小体积）
+IMAGE_FORMAT = "JPEG"  # 重新编码格式：JPEG / WEBP / PNG
+IMAGE_QUALITY = 85  # 编码质量（JPEG/WEBP）
+IMAGE_MAX_BYTES = 1_500_000  # 单张图片上传体积预算（字节，None=不限制）
 # -------------------------- Markdown样式（全局共用） --------------------------
 MARKDOWN_CSS = """
 <style>
@@ -32,7 +114,9 @@ MARKDOWN_CSS = """
 # -------------------------- 全局变量（跨模块共用） --------------------------
 # 初始化时赋值，后续被主程序修改
 client = None  # OpenAI客户端实例
+api_key = DEFAULT_API_KEY
 SERVER_PORT = DEFAULT_SERVER_PORT
 MONITOR_DIR = DEFAULT_MONITOR_DIR
 CLEAR_INTERVAL = DEFAULT_CLEAR_INTERVAL
-image_server_process = None  # 后台截图接收服务进程
\ No newline at end of file
+image_server_process = None  # 后台截图接收服务进程
+SERVER_READY_TIMEOUT = 10  # 等待后台截图接收服务就绪（端口监听成功）的最长时间（秒）
\ No newline at end of file
@@ -0,0 +1,210 @@
+# headless.py：无界面批量分析模式（不依赖PyQt，可在无显示器的服务器上运行）
+#
+# 用法：
+#   python headless.py received_screenshots -o results.jsonl            # 分析目录下已有的全部截图
+#   python headless.py received_screenshots --watch -o results.jsonl    # 分析完已有截图后继续监控新截图
+# 每张截图输出一行JSON：path, sha256, question, answer, reasoning, source, error, latencies
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import config
+from ai_handler import init_ai_client, ImageAnalyzer
+from image_handler import ImageAsset
+from store_handler import ARCHIVE_DIR
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+DEFAULT_QUESTION = "请分析这张截图的内容。"
+STABLE_CHECK_INTERVAL = 0.2  # 监控模式下判断文件写入完成的轮询间隔（秒）
+STABLE_CHECK_TIMEOUT = 10.0  # 文件大小持续变化超过该时间则放弃
+SUBMITTED_MAX_ENTRIES = 4096  # 记住的已提交截图路径数（监控模式下长期运行，超出时忘记最早提交的路径）
+
+
+# -------------------------- 结果输出 --------------------------
+class JsonlWriter:
+    """线程安全的JSONL输出（每条结果写完立即flush，中途中断也不丢已完成的结果）"""
+
+    def __init__(self, path=None):
+        self.file = open(path, "a", encoding="utf-8") if path else sys.stdout
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+# -------------------------- 批量分析 --------------------------
+class BatchAnalyzer:
+    """用线程池并发分析截图，结果写入JSONL"""
+
+    def __init__(self, question, writer, workers=config.MAX_CONCURRENT_JOBS):
+        self.question = question
+        self.writer = writer
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="headless")
+        self.lock = threading.Lock()
+        self.submitted = OrderedDict()  # 已提交的截图路径（监控模式下避免重复分析，按提交顺序淘汰）
+        self.done = 0
+        self.failed = 0
+
+    def submit(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.submitted:
+                return None
+            self.submitted[path] = None
+            if len(self.submitted) > SUBMITTED_MAX_ENTRIES:
+                self.submitted.popitem(last=False)
+        return self.executor.submit(self._analyze, path)
+
+    def _analyze(self, path):
+        try:
+            asset = ImageAsset.from_file(path)
+        except OSError as e:
+            print(f"[批量分析] 读取失败：{path}（{e}）", file=sys.stderr)
+            return
+        result = ImageAnalyzer(asset, self.question).run()
+        record = {
+            "path": path,
+            "sha256": asset.sha256,
+            "question": self.question,
+            "answer": result["answer"],
+            "reasoning": result["reasoning"],
+            "source": result["source"],
+            "model": result["model"],
+            "error": result["error"],
+            "latencies": {k: round(v, 4) for k, v in result["latencies"].items() if v is not None},
+        }
+        self.writer.write(record)
+        with self.lock:
+            self.done += 1
+            if result["error"]:
+                self.failed += 1
+        status = "失败" if result["error"] else result["source"]
+        print(f"[批量分析] {os.path.basename(path)}：{status}，耗时{result['latencies']['total']:.2f}秒",
+              file=sys.stderr)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def list_images(directory):
+    """按修改时间顺序列出目录（含截图库的哈希分片子目录，不含归档目录）下的截图文件"""
+    paths = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and not (root == directory and d == ARCHIVE_DIR)]
+        paths += [os.path.join(root, name) for name in names
+                  if name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith(".")]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def wait_until_stable(path):
+    """等待文件大小不再变化（写入完成），超时返回False"""
+    deadline = time.monotonic() + STABLE_CHECK_TIMEOUT
+    last_size = -1
+    while time.monotonic() < deadline:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+        if size > 0 and size == last_size:
+            return True
+        last_size = size
+        time.sleep(STABLE_CHECK_INTERVAL)
+    return False
+
+
+# -------------------------- 目录监控 --------------------------
+def watch_directory(directory, batch):
+    """监控目录中的新截图并提交分析，Ctrl+C退出"""
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+
+    # 等待写入完成的有界线程池：大量截图同时出现时排队等待，不会为每个事件各起一个线程
+    stable_pool = ThreadPoolExecutor(max_workers=max(1, config.MAX_CONCURRENT_JOBS), thread_name_prefix="headless-stable")
+    waiting = set()  # 尚未完成的等待任务，退出时取消还没开始的
+
+    class NewImageHandler(FileSystemEventHandler):
+        def on_created(self, event):
+            # 直接写入的文件需要等待写入完成，放到分析线程池外的等待线程池中，不阻塞监控线程
+            if not event.is_directory and event.src_path.lower().endswith(IMAGE_EXTENSIONS):
+                future = stable_pool.submit(self._submit_when_stable, event.src_path)
+                waiting.add(future)
+                future.add_done_callback(waiting.discard)
+
+        def on_moved(self, event):
+            # 接收服务先写临时文件再原子重命名，重命名完成即文件完整
+            if not event.is_directory and event.dest_path.lower().endswith(IMAGE_EXTENSIONS):
+                batch.submit(event.dest_path)
+
+        @staticmethod
+        def _submit_when_stable(path):
+            if os.path.basename(path).startswith("."):
+                return
+            if wait_until_stable(path):
+                batch.submit(path)
+
+    observer = Observer()
+    observer.schedule(NewImageHandler(), directory, recursive=True)
+    observer.start()
+    print(f"[批量分析] 正在监控目录：{os.path.abspath(directory)}（Ctrl+C退出）", file=sys.stderr)
+    try:
+        while observer.is_alive():
+            observer.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        observer.join()
+        for future in list(waiting):
+            future.cancel()  # 尚未开始等待的文件不再提交（只有正在执行的会等待完成）
+        stable_pool.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="无界面批量截图分析（结果输出为JSONL）")
+    parser.add_argument("directory", nargs="?", default=config.DEFAULT_MONITOR_DIR, help="截图目录")
+    parser.add_argument("--watch", action="store_true", help="分析完已有截图后继续监控目录中的新截图")
+    parser.add_argument("--question", "-q", default=DEFAULT_QUESTION, help="向AI提出的问题")
+    parser.add_argument("--workers", "-j", type=int, default=config.MAX_CONCURRENT_JOBS, help="同时进行的AI分析请求数")
+    parser.add_argument("--output", "-o", default=None, help="结果JSONL文件（追加写入，默认输出到标准输出）")
+    parser.add_argument("--api-key", default=os.environ.get("ARK_API_KEY") or config.DEFAULT_API_KEY,
+                        help="API Key（默认读取环境变量 ARK_API_KEY）")
+    parser.add_argument("--no-stream", action="store_true", help="关闭流式调用")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print(f"❌ 目录不存在：{args.directory}", file=sys.stderr)
+        sys.exit(1)
+    if args.no_stream:
+        config.STREAM_ENABLED = False
+
+    init_ai_client(args.api_key)
+    writer = JsonlWriter(args.output)
+    batch = BatchAnalyzer(args.question, writer, workers=args.workers)
+    start_time = time.perf_counter()
+    try:
+        for path in list_images(args.directory):
+            batch.submit(path)
+        if args.watch:
+            watch_directory(args.directory, batch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batch.shutdown()
+        writer.close()
+    print(f"[批量分析] 完成{batch.done}张（失败{batch.failed}张），总耗时{time.perf_counter() - start_time:.2f}秒",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+# image_handler.py：图片资源与预处理（缩放、重新编码、控制上传体积、变化区域提取）
+import io
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+import pybase64
+from PIL import Image, ImageChops
+import config  # 导入全局配置
+
+# 文件头 -> MIME类型
+MIME_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"BM", "image/bmp"),
+    (b"GIF8", "image/gif"),
+)
+PIL_FORMAT_MIME = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+MIN_QUALITY = 40  # 按体积预算降低质量时的下限，低于此值改为缩小尺寸
+
+
+def detect_mime(image_data):
+    """按文件头识别图片MIME类型，无法识别时按PNG处理"""
+    if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, mime in MIME_SIGNATURES:
+        if image_data.startswith(signature):
+            return mime
+    return "image/png"
+
+
+class ImageAsset:
+    """
+    一张截图在内存中只保留一份原始数据，内容哈希、Base64编码和界面缩略图都由这份数据得到：
+    - sha256：创建时计算或由接收服务传入（回答缓存和批量分析结果共用）；
+    - base64()：首次调用时用pybase64（SIMD加速）编码并缓存，原图直接上传时复用；
+    - make_thumbnail()：用QImageReader按显示尺寸直接解码为QImage（JPEG缩小解码），在工作线程调用，
+      界面线程只需转换为QPixmap显示。
+    """
+
+    def __init__(self, data, path="", sha256=None):
+        self.data = data      # 图片原始数据
+        self.path = path      # 图片路径（仅用于显示，进程内接收的图片为保存路径）
+        self.sha256 = sha256 or hashlib.sha256(data).hexdigest()  # 接收服务已计算过时直接传入
+        self.thumbnail = None  # 缩略图（QImage），由 make_thumbnail() 生成
+        self._base64 = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "rb") as f:
+            return cls(f.read(), path)
+
+    def base64(self):
+        """原始数据的Base64编码（只编码一次）"""
+        with self._lock:
+            if self._base64 is None:
+                self._base64 = pybase64.b64encode(self.data).decode("ascii")
+            return self._base64
+
+    def make_thumbnail(self, width, height):
+        """解码不超过 width×height 的缩略图（保持宽高比、不放大），无法解码时返回None"""
+        # 只有界面使用缩略图，推迟导入，无界面环境（headless）不依赖PyQt
+        from PyQt5.QtCore import QBuffer, QByteArray, QIODevice, QSize, Qt
+        from PyQt5.QtGui import QImageReader
+        buffer = QBuffer()
+        buffer.setData(QByteArray(self.data))
+        buffer.open(QIODevice.ReadOnly)
+        reader = QImageReader(buffer)
+        size = reader.size()
+        if size.isValid() and (size.width() > width or size.height() > height):
+            reader.setScaledSize(size.scaled(QSize(width, height), Qt.KeepAspectRatio))
+        image = reader.read()
+        self.thumbnail = None if image.isNull() else image
+        return self.thumbnail
+
+
+def _target_scale(width, height, max_edge, max_pixels):
+    scale = 1.0
+    if max_edge:
+        scale = min(scale, max_edge / max(width, height))
+    if max_pixels:
+        scale = min(scale, math.sqrt(max_pixels / (width * height)))
+    return scale
+
+
+def _encode(img, fmt, quality):
+    buffer = io.BytesIO()
+    if fmt == "PNG":
+        img.save(buffer, fmt, optimize=True)
+    else:
+        img.save(buffer, fmt, quality=quality)
+    return buffer.getvalue()
+
+
+def preprocess_image(image_data, max_edge=None, max_pixels=None, grayscale=False,
+                     fmt="JPEG", quality=85, max_bytes=None, crop=None):
+    """
+    解码图片并按限制缩放（最长边/总像素）、可选转灰度、重新编码为指定格式，
+    超出体积预算时依次降低质量、缩小尺寸。crop为 (左, 上, 右, 下) 时只保留该区域。
+    返回：(图片数据, MIME类型)
+    """
+    fmt = fmt.upper()
+    with Image.open(io.BytesIO(image_data)) as img:
+        width, height = img.size
+        scale = _target_scale(width, height, max_edge, max_pixels)
+        if crop is None:
+            # JPEG可按目标尺寸直接缩小解码（裁剪时缩放比例按裁剪区域计算，不能按整图缩小解码）
+            img.draft("L" if grayscale else "RGB", (max(1, int(width * scale)), max(1, int(height * scale))))
+        img.load()
+        original_mime = PIL_FORMAT_MIME.get(img.format) if crop is None else None
+        if crop is not None:
+            img = img.crop(crop)
+
+        # 无需缩放/转换且原图已是可直接上传的格式和大小，原样发送
+        if (scale >= 1 and not grayscale and original_mime
+                and (not max_bytes or len(image_data) <= max_bytes)
+                and img.format in ("JPEG", "WEBP")):
+            return image_data, original_mime
+
+        # 统一颜色模式（JPEG不支持透明通道，透明区域以白色填充）
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, "white")
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        img = img.convert("L") if grayscale else img.convert("RGB") if img.mode != "RGB" else img
+
+        width, height = img.size
+        scale = _target_scale(width, height, max_edge, max_pixels)
+        while True:
+            if scale < 1:
+                resized = img.resize((max(1, int(width * scale)), max(1, int(height * scale))),
+                                     Image.LANCZOS, reducing_gap=3.0)
+            else:
+                resized = img
+            current_quality = quality
+            encoded = _encode(resized, fmt, current_quality)
+            while max_bytes and len(encoded) > max_bytes and fmt != "PNG" and current_quality - 10 >= MIN_QUALITY:
+                current_quality -= 10
+                encoded = _encode(resized, fmt, current_quality)
+            if not max_bytes or len(encoded) <= max_bytes or min(resized.size) <= 64:
+                break
+            scale = min(scale, 1.0) * 0.75
+
+    # 重新编码反而更大（如纯色小图）且原图格式可用时，保留原图
+    if original_mime and scale >= 1 and not grayscale and len(encoded) >= len(image_data):
+        return image_data, original_mime
+    return encoded, PIL_FORMAT_MIME[fmt]
+
+
+def prepare_image(image_data, crop=None):
+    """
+    按全局配置预处理待上传的图片，关闭预处理或解码失败时原样上传（crop指定的区域仍会裁剪）。
+    返回：(图片数据, MIME类型)
+    """
+    if config.PREPROCESS_ENABLED or crop is not None:
+        try:
+            if not config.PREPROCESS_ENABLED:
+                return preprocess_image(image_data, fmt="PNG", crop=crop)
+            return preprocess_image(
+                image_data,
+                max_edge=config.IMAGE_MAX_EDGE,
+                max_pixels=config.IMAGE_MAX_PIXELS,
+                grayscale=config.IMAGE_GRAYSCALE,
+                fmt=config.IMAGE_FORMAT,
+                quality=config.IMAGE_QUALITY,
+                max_bytes=config.IMAGE_MAX_BYTES,
+                crop=crop
+            )
+        except Exception as e:
+            print(f"[图片预处理] 处理失败，使用原图上传：{str(e)}")
+    return image_data, detect_mime(image_data)
+
+
+# -------------------------- 变化区域提取（与上一张截图比较） --------------------------
+DIFF_FULL = "full"            # 没有可比较的上一张截图，或变化范围过大：发送整张截图
+DIFF_CROP = "crop"            # 只发送变化区域
+DIFF_UNCHANGED = "unchanged"  # 没有明显变化：跳过
+
+
+class FrameDiffer:
+    """
+    按发送端保存上一张已发送截图的缩小灰度图，新截图与之逐像素比较（ImageChops，在C层完成）：
+    变化像素占比低于 min_changed_ratio 视为无变化；否则取变化像素的包围盒，向外扩展 margin 像素后裁剪，
+    包围盒超过整图 max_crop_ratio 时仍发送整图。compare() 只做判断，模型成功返回后由调用方 commit()
+    把该截图记为下次比较的基准：发送失败的截图重发时不会被误判为无变化，未发送的细小变化会累积。
+    """
+
+    def __init__(self, compare_edge=1024, pixel_threshold=24, min_changed_ratio=0.00005,
+                 margin=48, max_crop_ratio=0.6, max_senders=64):
+        self.compare_edge = compare_edge
+        self.pixel_threshold = pixel_threshold
+        self.min_changed_ratio = min_changed_ratio
+        self.margin = margin
+        self.max_crop_ratio = max_crop_ratio
+        self.max_senders = max_senders
+        self._frames = OrderedDict()  # 发送端 -> (原图尺寸, 缩小灰度图)
+        self._lock = threading.Lock()  # 多个AI线程可能同时比较
+        # 像素差值 -> 0/255 的查找表：超过阈值的视为变化（过滤JPEG压缩噪声）
+        self._table = [255 if value > pixel_threshold else 0 for value in range(256)]
+
+    def _thumbnail(self, image_data):
+        with Image.open(io.BytesIO(image_data)) as img:
+            size = img.size
+            scale = min(1.0, self.compare_edge / max(size))
+            target = (max(1, int(size[0] * scale)), max(1, int(size[1] * scale)))
+            img.draft("L", target)
+            small = img.convert("L")
+        if small.size != target:
+            small = small.resize(target, Image.BILINEAR, reducing_gap=2.0)
+        return size, small
+
+    def compare(self, key, image_data):
+        """
+        返回 (DIFF_FULL/DIFF_CROP/DIFF_UNCHANGED, 裁剪区域(左, 上, 右, 下)或None, 变化像素占比,
+        (原图尺寸, 缩小灰度图))，最后一项供分析成功后传给 commit()
+        """
+        size, small = self._thumbnail(image_data)
+        with self._lock:
+            previous = self._frames.get(key)
+        kind, box, ratio = DIFF_FULL, None, 1.0
+        if previous is not None and previous[0] == size:
+            changed = ImageChops.difference(previous[1], small).point(self._table)
+            bbox = changed.getbbox()
+            ratio = changed.histogram()[255] / (small.width * small.height) if bbox else 0.0
+            if bbox is None or ratio < self.min_changed_ratio:
+                kind = DIFF_UNCHANGED
+            else:
+                # 包围盒换算回原图坐标并加边距（保留周围的上下文）
+                sx, sy = size[0] / small.width, size[1] / small.height
+                box = (max(0, int(bbox[0] * sx) - self.margin), max(0, int(bbox[1] * sy) - self.margin),
+                       min(size[0], math.ceil(bbox[2] * sx) + self.margin),
+                       min(size[1], math.ceil(bbox[3] * sy) + self.margin))
+                if (box[2] - box[0]) * (box[3] - box[1]) <= self.max_crop_ratio * size[0] * size[1]:
+                    kind = DIFF_CROP
+                else:
+                    box = None
+        return kind, box, ratio, (size, small)
+
+    def commit(self, key, size, small):
+        """把已成功分析的截图记为该发送端下次比较的基准"""
+        with self._lock:
+            self._frames[key] = (size, small)
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.max_senders:
+                self._frames.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+
+frame_differ = FrameDiffer(config.DIFF_COMPARE_EDGE, config.DIFF_PIXEL_THRESHOLD, config.DIFF_MIN_CHANGED_RATIO,
+                           config.DIFF_MARGIN, config.DIFF_MAX_CROP_RATIO)
@@ -1,122 +1,652 @@
-# image_server.py：独立截图接收服务（无需修改）
+# image_server.py：独立截图接收服务
+"""
+支持两种传输协议：
+
+1. 旧版协议（一连接一文件）：
+   [4字节文件名长度][文件名(UTF-8)][4字节图片大小][图片数据]，发送完毕后由服务端关闭连接。
+
+2. v2协议（长连接、多帧、逐帧确认）：
+   握手：客户端发送 PROTOCOL_MAGIC + 1字节版本号，服务端回复 PROTOCOL_MAGIC + 接受的版本号（0表示不支持）。
+   数据帧：FRAME_HEADER（帧类型、内容类型、文件名长度、序号、数据大小、CRC32）+ 文件名 + 数据。
+   每个文件帧/心跳帧处理完成后，服务端回复 FRAME_ACK（序号、状态码），客户端可连续发送多帧（流水线），
+   按序号匹配确认；发送 FRAME_BYE 帧或直接关闭连接即结束会话。
+
+所有整数均为网络字节序。旧版协议首4字节为文件名长度，不会与魔数冲突（魔数按长度解析约1GB）。
+
+准入控制：图片大小和文件名长度超过上限、或所有连接正在接收的数据总量超过上限（等待片刻仍无空闲）时，
+v2协议回复 STATUS_TOO_LARGE / STATUS_BUSY 后关闭连接，旧版协议直接关闭连接；
+单个客户端（按IP）的上传速率超过上限时放慢读取，由TCP流量控制让发送端减速。
+客户端文件名只取最后一段并去掉路径分隔符、控制字符等，不会写到保存目录之外。
+"""
 import socket
 import os
+import sys
 import struct
 import argparse
-from typing import Tuple
+import logging
+import threading
+import tempfile
+import time
+import re
+import zlib
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+from trace_handler import tracer, new_trace_id, file_trace_id, start_metrics_server
+from log_handler import get_logger, setup_receiver_logging
+from store_handler import ScreenshotStore
+
+log = get_logger()
+
+# -------------------------- 并发与超时参数 --------------------------
+DEFAULT_MAX_WORKERS = 8        # 同时处理（正在接收数据）的连接数上限，v2长连接帧间空闲时不占用
+DEFAULT_MAX_CONNECTIONS = 64   # 同时保持的客户端连接数上限（含帧间空闲的v2长连接）
+DEFAULT_READ_TIMEOUT = 15.0    # 单连接读超时（秒），防止半开连接长期占用处理槽位
+DEFAULT_BACKLOG = 128          # 监听队列长度，应对突发连接
+RECV_CHUNK_SIZE = 1024 * 1024  # 单次recv_into读取的最大字节数（每个处理线程复用一块该大小的缓冲区）
+PROGRESS_STEP = 0.25           # 接收进度日志步长（每完成25%记录一次）
+PROGRESS_INTERVAL = 1.0        # 同一传输两条进度日志的最短间隔（秒），小文件不会产生进度日志
+DEFAULT_IDLE_TIMEOUT = 120.0   # v2长连接两帧之间允许的最长空闲时间（秒）
+DEFAULT_MAINTENANCE_INTERVAL = 60.0  # 截图库淘汰/重新压缩的执行间隔（秒）
+
+# -------------------------- 准入控制参数 --------------------------
+DEFAULT_MAX_IMAGE_BYTES = 64 * 1024 * 1024      # 单张图片大小上限（字节）
+DEFAULT_MAX_FILENAME_BYTES = 1024               # 文件名长度上限（字节）
+DEFAULT_MAX_INFLIGHT_BYTES = 256 * 1024 * 1024  # 所有连接正在接收的图片总字节数上限（0=不限）
+DEFAULT_CLIENT_RATE = 0                         # 单个客户端（按IP）上传速率上限（字节/秒，0=不限）
+ADMISSION_WAIT = 5.0                            # 在途字节数超限时等待空闲的最长时间（秒），超时回复繁忙
+MAX_SAVED_NAME_CHARS = 120                      # 保存的文件名最多保留的字符数（含扩展名）
+RATE_BUCKETS_MAX = 1024                         # 限速记录的客户端数上限（超出时清理空闲的客户端）
+
+# -------------------------- v2协议定义 --------------------------
+PROTOCOL_MAGIC = b"DBSV"
+PROTOCOL_VERSION = 2
+SUPPORTED_VERSIONS = (2,)
+FRAME_HEADER = struct.Struct("!BBHIII")  # 帧类型, 内容类型, 文件名长度, 序号, 数据大小, CRC32
+FRAME_ACK = struct.Struct("!IB")         # 序号, 状态码
+
+FRAME_BYE = 0   # 结束会话
+FRAME_FILE = 1  # 图片文件
+FRAME_PING = 2  # 心跳（保活），仅回复确认
+
+STATUS_OK = 0
+STATUS_BAD_CHECKSUM = 1  # CRC32校验失败，文件未保存
+STATUS_BAD_FRAME = 2     # 未知帧类型，服务端随后关闭连接
+STATUS_ERROR = 3         # 服务端保存失败
+STATUS_TOO_LARGE = 4     # 图片或文件名超过上限，服务端随后关闭连接
+STATUS_BUSY = 5          # 服务端繁忙（正在接收的数据量超限），服务端随后关闭连接，客户端可稍后重试
+
+# 内容类型编码 -> 文件扩展名（文件名缺少扩展名时补全）
+CONTENT_TYPES = {0: "", 1: ".png", 2: ".jpg", 3: ".bmp", 4: ".webp"}
+
+_UNSAFE_NAME_CHARS = re.compile(r'[\x00-\x1f\x7f<>:"/\\|?*]')
+_WINDOWS_RESERVED_NAMES = {"CON", "PRN", "AUX", "NUL"} | {f"{p}{i}" for p in ("COM", "LPT") for i in range(1, 10)}
+
+
+def sanitize_filename(name: str) -> str:
+    """客户端文件名只保留最后一段，替换路径分隔符和控制字符，去掉开头的点，过长时截断（保留扩展名）"""
+    name = name.replace("\\", "/").rsplit("/", 1)[-1]
+    name = _UNSAFE_NAME_CHARS.sub("_", name).strip().lstrip(".").rstrip(". ")
+    stem, ext = os.path.splitext(name)
+    if len(name) > MAX_SAVED_NAME_CHARS:
+        ext = ext[:16]
+        name = stem[:MAX_SAVED_NAME_CHARS - len(ext)] + ext
+    if stem.upper() in _WINDOWS_RESERVED_NAMES:
+        name = "_" + name
+    return name or f"upload-{int(time.time() * 1000)}"
+
+
+class ByteBudget:
+    """所有连接共享的在途字节数预算，超限时新图片最多等待 timeout 秒"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size: int, timeout: float) -> bool:
+        if not self.limit:
+            return True
+        with self._cond:
+            # 没有其他在途数据时总是放行（单张图片不超过大小上限即可）
+            if not self._cond.wait_for(lambda: self.used == 0 or self.used + size <= self.limit, timeout):
+                return False
+            self.used += size
+            return True
+
+    def release(self, size: int) -> None:
+        if not self.limit:
+            return
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+
+class RateLimiter:
+    """按客户端IP的令牌桶限速：delay() 返回读取这些字节后需要暂停的秒数"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or rate  # 默认允许1秒的突发量
+        self._buckets = {}  # 客户端IP -> [剩余令牌, 上次更新时间]
+        self._lock = threading.Lock()
+
+    def delay(self, client: str, size: int) -> float:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                if len(self._buckets) >= RATE_BUCKETS_MAX:
+                    # 令牌已回满的客户端与新客户端等价，可以直接清理
+                    self._buckets = {key: b for key, b in self._buckets.items()
+                                     if b[0] + (now - b[1]) * self.rate < self.burst}
+                bucket = self._buckets[client] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate) - size
+            bucket[0], bucket[1] = tokens, now
+        return -tokens / self.rate if tokens < 0 else 0.0
 
 
 class ImageServer:
-    def __init__(self, save_dir: str = "received_screenshots", port: int = 7893):
+    def __init__(self, save_dir: str = "received_screenshots", port: int = 7893,
+                 max_workers: int = DEFAULT_MAX_WORKERS, read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 backlog: int = DEFAULT_BACKLOG, idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 on_image: Optional[Callable[[str, bytearray, dict], None]] = None, persist: bool = True,
+                 reuse_port: bool = False, store: Optional[ScreenshotStore] = None,
+                 max_image_bytes: int = DEFAULT_MAX_IMAGE_BYTES, max_filename_bytes: int = DEFAULT_MAX_FILENAME_BYTES,
+                 max_inflight_bytes: int = DEFAULT_MAX_INFLIGHT_BYTES, client_rate: float = DEFAULT_CLIENT_RATE):
         self.save_dir = save_dir
         self.port = port
+        self.max_workers = max(1, max_workers)
+        self.max_connections = max(self.max_workers, max_connections)
+        self.read_timeout = read_timeout
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
         self.server_socket = None
         self.is_running = False
+        # 有界连接池：_conn_slots 限制同时保持的连接数，满载时新连接留在内核监听队列中等待；
+        # _slots 为处理槽位，只在准入通过后接收图片数据期间占用：帧间空闲、等待准入和限速暂停时都不占用
+        self._executor = None
+        self._conn_slots = threading.BoundedSemaphore(self.max_connections)
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self._local = threading.local()  # 线程私有的接收缓冲区
+        # 进程内模式：图片接收到内存后直接回调 on_image(文件名, 图片数据, 元信息)，
+        # 落盘（persist=True时）改为后台线程异步完成，不再经过目录监控。
+        # 图片数据即接收缓冲区本身（bytearray，不再复制一份），回调方和落盘线程共用，均不得修改
+        self.on_image = on_image
+        self.persist = persist
+        self._persist_executor = None
+        self.ready = threading.Event()  # 端口监听成功后置位
+        # 多进程模式：各工作进程以SO_REUSEPORT监听同一端口，由内核在进程间分配新连接
+        self.reuse_port = reuse_port
+        self.active_connections = 0
+        # 截图库：按内容哈希命名保存并写入索引（None=沿用客户端文件名直接保存）
+        self.store = store
+        # 准入控制：大小上限、在途字节数预算、按客户端限速
+        self.max_image_bytes = max_image_bytes
+        self.max_filename_bytes = max_filename_bytes
+        self._inflight = ByteBudget(max_inflight_bytes)
+        self._rate_limiter = RateLimiter(client_rate) if client_rate > 0 else None
+        self._active_lock = threading.Lock()
+        self._idle_conns = set()  # 正在等待下一帧的v2长连接，stop()时直接关闭，不必等空闲超时
 
     def _init_save_dir(self) -> str:
         if not os.path.exists(self.save_dir):
             os.makedirs(self.save_dir, exist_ok=True)
-            print(f"[服务端] 已创建保存目录：{os.path.abspath(self.save_dir)}")
+            log.info(f"已创建保存目录：{os.path.abspath(self.save_dir)}")
         else:
-            print(f"[服务端] 已存在保存目录：{os.path.abspath(self.save_dir)}")
+            log.info(f"已存在保存目录：{os.path.abspath(self.save_dir)}")
         return self.save_dir
 
+    def _chunk_buffer(self) -> memoryview:
+        """获取当前线程复用的接收缓冲区（避免每个分块都分配新的bytes对象）"""
+        view = getattr(self._local, "view", None)
+        if view is None:
+            view = memoryview(bytearray(RECV_CHUNK_SIZE))
+            self._local.view = view
+        return view
+
+    def _receive_into(self, conn: socket.socket, view: memoryview) -> int:
+        """用recv_into把数据直接读入预分配缓冲区，返回实际读取的字节数"""
+        received_len = 0
+        total_len = len(view)
+        while received_len < total_len and self.is_running:
+            n = conn.recv_into(view[received_len:], total_len - received_len)
+            if n == 0:
+                break
+            received_len += n
+            self._throttle(n)
+        return received_len
+
+    def _throttle(self, size: int) -> None:
+        """
+        按客户端限速：超出速率时暂停读取，TCP接收窗口填满后发送端自然减速。
+        暂停期间归还处理槽位，被限速的客户端不占用其他连接的接收名额
+        """
+        if self._rate_limiter is not None:
+            delay = self._rate_limiter.delay(getattr(self._local, "client", ""), size)
+            if delay > 0:
+                holding = getattr(self._local, "holding_slot", False)
+                if holding:
+                    self._slots.release()
+                try:
+                    time.sleep(delay)
+                finally:
+                    if holding:
+                        self._slots.acquire()
+
+    @contextmanager
+    def _processing_slot(self):
+        """接收图片数据期间占用一个处理槽位（准入检查通过后才调用，等待准入时不占用）"""
+        self._slots.acquire()
+        self._local.holding_slot = True
+        try:
+            yield
+        finally:
+            self._local.holding_slot = False
+            self._slots.release()
+
     def _receive_data(self, conn: socket.socket, data_len: int) -> bytes:
-        received_data = b""
-        remaining_len = data_len
-        while remaining_len > 0 and self.is_running:
-            chunk = conn.recv(min(1024 * 1024, remaining_len))
-            if not chunk:
-                print("[服务端] 客户端断开连接（数据接收中断）")
-                return b""
-            received_data += chunk
-            remaining_len -= len(chunk)
-        return received_data
+        buffer = bytearray(data_len)
+        if self._receive_into(conn, memoryview(buffer)) != data_len:
+            log.warning("客户端断开连接（数据接收中断）")
+            return b""
+        return bytes(buffer)
+
+    def _receive_to_file(self, conn: socket.socket, full_save_path: str, total_len: int,
+                         expected_crc: Optional[int] = None) -> Tuple[int, bool, float, str]:
+        """
+        把图片数据流式写入保存目录下的临时文件，接收完整后fsync并原子重命名为目标文件，
+        保证目录监控只会看到完整的图片。传入expected_crc时边接收边计算CRC32，不一致则丢弃文件。
+        使用截图库时边接收边计算sha256，目标文件改为按内容哈希命名。
+        返回：(实际接收的字节数, 校验是否通过, 写文件累计耗时, 最终保存路径)
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix=".recv-", suffix=".part", dir=os.path.dirname(full_save_path) or ".")
+        view = self._chunk_buffer()
+        hasher = hashlib.sha256() if self.store is not None else None
+        received_len = 0
+        crc = 0
+        write_time = 0.0
+        next_report = PROGRESS_STEP
+        report_progress = log.isEnabledFor(logging.DEBUG)
+        last_report = time.monotonic()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while received_len < total_len and self.is_running:
+                    n = conn.recv_into(view, min(len(view), total_len - received_len))
+                    if n == 0:
+                        break
+                    self._throttle(n)
+                    write_start = time.perf_counter()
+                    f.write(view[:n])
+                    write_time += time.perf_counter() - write_start
+                    if expected_crc is not None:
+                        crc = zlib.crc32(view[:n], crc)
+                    if hasher is not None:
+                        hasher.update(view[:n])
+                    received_len += n
+                    if report_progress:
+                        progress = received_len / total_len
+                        now = time.monotonic()
+                        if progress >= next_report and now - last_report >= PROGRESS_INTERVAL:
+                            log.debug(f"接收进度：{os.path.basename(full_save_path)} {progress * 100:.0f}%")
+                            next_report = progress + PROGRESS_STEP
+                            last_report = now
+                write_start = time.perf_counter()
+                if received_len == total_len:
+                    f.flush()
+                    os.fsync(f.fileno())
+            checksum_ok = expected_crc is None or crc == expected_crc
+            if received_len == total_len and checksum_ok:
+                if hasher is not None:
+                    full_save_path = self.store.path_for(hasher.hexdigest(), full_save_path)
+                os.chmod(tmp_path, 0o644)  # mkstemp默认仅属主可读写，与普通文件权限保持一致
+                os.replace(tmp_path, full_save_path)
+            write_time += time.perf_counter() - write_start
+            return received_len, checksum_ok, write_time, full_save_path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _receive_image(self, conn: socket.socket, full_save_path: str, total_len: int,
+                       expected_crc: Optional[int] = None, sender: str = "") -> Tuple[int, bool, str]:
+        """
+        接收一张图片：默认流式落盘；设置了on_image时接收到内存并直接交给回调。
+        接收耗时记入追踪：落盘模式的追踪ID由最终文件推导（与目录监控端一致），进程内模式随回调元信息传递。
+        返回：(实际接收的字节数, 校验是否通过, 保存路径)
+        """
+        start_time = time.perf_counter()
+        filename = os.path.basename(full_save_path)
+        if self.on_image is None:
+            received_len, checksum_ok, write_time, full_save_path = self._receive_to_file(
+                conn, full_save_path, total_len, expected_crc)
+            if received_len == total_len and checksum_ok:
+                if self.store is not None:
+                    self.store.add(full_save_path, os.path.splitext(os.path.basename(full_save_path))[0],
+                                   filename, sender, total_len)
+                trace_id = file_trace_id(full_save_path)
+                tracer.record(trace_id, "receive", time.perf_counter() - start_time, bytes=total_len, sender=sender)
+                tracer.record(trace_id, "file_write", write_time)
+            self._count_image(received_len, total_len, checksum_ok)
+            return received_len, checksum_ok, full_save_path
+
+        buffer = bytearray(total_len)
+        received_len = self._receive_into(conn, memoryview(buffer))
+        checksum_ok = expected_crc is None or zlib.crc32(buffer) == expected_crc
+        if received_len == total_len and checksum_ok:
+            image_data = buffer  # 直接交出接收缓冲区，峰值内存只占一份图片大小
+            del buffer
+            digest = None
+            if self.store is not None:
+                digest = hashlib.sha256(image_data).hexdigest()
+                full_save_path = self.store.path_for(digest, filename)
+            trace_id = new_trace_id()
+            tracer.record(trace_id, "receive", time.perf_counter() - start_time, bytes=total_len, sender=sender)
+            self.on_image(filename, image_data, {"sender": sender, "path": full_save_path, "trace_id": trace_id,
+                                                 "sha256": digest})
+            if self._persist_executor:
+                self._persist_executor.submit(self._persist_image, full_save_path, image_data, digest, filename, sender)
+        self._count_image(received_len, total_len, checksum_ok)
+        return received_len, checksum_ok, full_save_path
+
+    @staticmethod
+    def _count_image(received_len: int, total_len: int, checksum_ok: bool) -> None:
+        if received_len != total_len:
+            tracer.count("image_incomplete")
+        elif not checksum_ok:
+            tracer.count("image_bad_checksum")
+        else:
+            tracer.count("image_received")
+            tracer.count("bytes_received", value=total_len)
+
+    def _persist_image(self, full_save_path: str, image_data: bytearray, digest: Optional[str] = None,
+                       filename: str = "", sender: str = "") -> None:
+        """进程内模式下的异步落盘（同样先写临时文件再原子重命名），使用截图库时同时写入索引"""
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix=".recv-", suffix=".part", dir=self.save_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(image_data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, full_save_path)
+            if digest is not None:
+                self.store.add(full_save_path, digest, filename, sender, len(image_data))
+        except (OSError, sqlite3.Error) as e:
+            log.error(f"异步保存{full_save_path}失败：{str(e)}", extra={"event": "save_failed", "file": full_save_path})
 
     def _handle_client(self, conn: socket.socket, client_addr: Tuple[str, int]) -> None:
-        print(f"\n[服务端] 新客户端连接：{client_addr[0]}:{client_addr[1]}")
-        current_save_dir = self._init_save_dir()
+        log.debug(f"新客户端连接：{client_addr[0]}:{client_addr[1]}", extra={"client": client_addr[0]})
 
         try:
-            # 接收文件名
-            filename_len_data = self._receive_data(conn, 4)
-            if len(filename_len_data) != 4:
-                print(f"[服务端] 接收文件名长度失败（来自{client_addr[0]}）")
-                return
-            filename_len = struct.unpack("!I", filename_len_data)[0]
-            filename_bytes = self._receive_data(conn, filename_len)
-            if len(filename_bytes) != filename_len:
-                print(f"[服务端] 接收文件名失败（来自{client_addr[0]}）")
-                return
-            filename = filename_bytes.decode("utf-8")
-            full_save_path = os.path.join(current_save_dir, filename)
-            print(f"[服务端] 准备接收：{filename}（保存路径：{full_save_path}）")
-
-            # 接收图片数据
-            img_len_data = self._receive_data(conn, 4)
-            if len(img_len_data) != 4:
-                print(f"[服务端] 接收图片长度失败（来自{client_addr[0]}）")
+            # 首4字节：v2协议魔数，或旧版协议的文件名长度
+            head = self._receive_data(conn, 4)
+            if len(head) != 4:
+                log.warning(f"接收文件名长度失败（来自{client_addr[0]}）", extra={"client": client_addr[0]})
                 return
-            img_total_len = struct.unpack("!I", img_len_data)[0]
-            print(f"[服务端] 图片大小：{img_total_len / 1024:.1f}KB")
-
-            # 分块接收并显示进度
-            img_data = b""
-            received_len = 0
-            while received_len < img_total_len and self.is_running:
-                chunk = self._receive_data(conn, min(1024 * 1024, img_total_len - received_len))
-                if not chunk:
-                    print(f"[服务端] 图片接收中断（来自{client_addr[0]}）")
-                    return
-                img_data += chunk
-                received_len += len(chunk)
-                progress = (received_len / img_total_len) * 100
-                print(f"[服务端] 接收进度：{progress:.1f}%", end="\r")
-
-            # 保存图片
-            if received_len == img_total_len:
-                with open(full_save_path, "wb") as f:
-                    f.write(img_data)
-                print(f"\n[服务端] 接收完成！文件已保存：{full_save_path}")
+            if head == PROTOCOL_MAGIC:
+                tracer.count("connection", protocol="v2")
+                self._handle_frames(conn, client_addr)
             else:
-                print(f"\n[服务端] 接收不完整（{received_len}/{img_total_len}字节，来自{client_addr[0]}）")
+                tracer.count("connection", protocol="legacy")
+                self._handle_legacy(conn, client_addr, struct.unpack("!I", head)[0])
 
+        except socket.timeout:
+            tracer.count("connection_timeout")
+            log.warning(f"客户端{client_addr[0]}等待数据超时，断开连接", extra={"event": "timeout", "client": client_addr[0]})
         except Exception as e:
-            print(f"\n[服务端] 处理客户端{client_addr[0]}出错：{str(e)}")
+            log.error(f"处理客户端{client_addr[0]}出错：{str(e)}", extra={"event": "client_error", "client": client_addr[0]})
         finally:
             conn.close()
-            print(f"[服务端] 与{client_addr[0]}的连接已关闭")
+            log.debug(f"与{client_addr[0]}的连接已关闭", extra={"client": client_addr[0]})
+
+    def _handle_legacy(self, conn: socket.socket, client_addr: Tuple[str, int], filename_len: int) -> None:
+        """旧版协议：一个连接只传一个文件"""
+        # 接收文件名（先检查长度，不按客户端声明的长度分配内存）
+        if filename_len > self.max_filename_bytes:
+            self._reject(client_addr, "filename_too_long", f"文件名长度{filename_len}字节超过上限")
+            return
+        filename_bytes = self._receive_data(conn, filename_len)
+        if len(filename_bytes) != filename_len:
+            log.warning(f"接收文件名失败（来自{client_addr[0]}）", extra={"client": client_addr[0]})
+            return
+        filename = sanitize_filename(filename_bytes.decode("utf-8", errors="replace"))
+        full_save_path = os.path.join(self.save_dir, filename)
+        log.debug(f"准备接收：{filename}（保存路径：{full_save_path}）", extra={"client": client_addr[0]})
+
+        # 接收图片数据
+        img_len_data = self._receive_data(conn, 4)
+        if len(img_len_data) != 4:
+            log.warning(f"接收图片长度失败（来自{client_addr[0]}）", extra={"client": client_addr[0]})
+            return
+        img_total_len = struct.unpack("!I", img_len_data)[0]
+        if img_total_len > self.max_image_bytes:
+            self._reject(client_addr, "too_large", f"图片大小{img_total_len}字节超过上限", filename)
+            return
+        if not self._inflight.acquire(img_total_len, ADMISSION_WAIT):
+            self._reject(client_addr, "busy", "正在接收的数据量超过上限", filename)
+            return
+
+        # 流式接收到临时文件，完成后原子重命名
+        try:
+            with self._processing_slot():
+                received_len, _, full_save_path = self._receive_image(conn, full_save_path, img_total_len,
+                                                                      sender=client_addr[0])
+        finally:
+            self._inflight.release(img_total_len)
+        if received_len == img_total_len:
+            log.info(f"接收完成！文件已保存：{full_save_path}（{img_total_len / 1024:.1f}KB）",
+                     extra={"event": "saved", "client": client_addr[0], "file": filename, "bytes": img_total_len})
+        else:
+            log.warning(f"接收不完整（{received_len}/{img_total_len}字节，来自{client_addr[0]}）",
+                        extra={"event": "incomplete", "client": client_addr[0], "file": filename})
+
+    def _handle_frames(self, conn: socket.socket, client_addr: Tuple[str, int]) -> None:
+        """v2协议：握手后在同一连接上循环接收多帧，每帧回复确认"""
+        version_data = self._receive_data(conn, 1)
+        if len(version_data) != 1:
+            return
+        version = version_data[0]
+        if version not in SUPPORTED_VERSIONS:
+            conn.sendall(PROTOCOL_MAGIC + bytes([0]))
+            log.warning(f"不支持的协议版本：{version}（来自{client_addr[0]}）", extra={"client": client_addr[0]})
+            return
+        conn.sendall(PROTOCOL_MAGIC + bytes([version]))
+
+        header_buffer = bytearray(FRAME_HEADER.size)
+        frame_count = 0
+        while self.is_running:
+            if not self._wait_frame(conn, header_buffer):
+                break  # 客户端在帧边界关闭连接或服务正在停止，属于正常结束
+            conn.settimeout(self.read_timeout)
+            frame_type, content_type, filename_len, seq, data_len, crc = FRAME_HEADER.unpack(header_buffer)
+
+            if frame_type == FRAME_BYE:
+                break
+            if frame_type == FRAME_PING:
+                conn.sendall(FRAME_ACK.pack(seq, STATUS_OK))
+                continue
+            if frame_type != FRAME_FILE:
+                conn.sendall(FRAME_ACK.pack(seq, STATUS_BAD_FRAME))
+                log.warning(f"未知帧类型：{frame_type}（来自{client_addr[0]}）", extra={"client": client_addr[0]})
+                break
+
+            # 准入检查：超限的帧不再读取数据，回复错误码后结束会话
+            if filename_len > self.max_filename_bytes or data_len > self.max_image_bytes:
+                conn.sendall(FRAME_ACK.pack(seq, STATUS_TOO_LARGE))
+                self._reject(client_addr, "too_large", f"帧超过上限（文件名{filename_len}字节，图片{data_len}字节）")
+                break
+            filename_bytes = self._receive_data(conn, filename_len)
+            if len(filename_bytes) != filename_len:
+                break
+            filename = self._frame_filename(sanitize_filename(filename_bytes.decode("utf-8", errors="replace")),
+                                            content_type)
+            full_save_path = os.path.join(self.save_dir, filename)
+            if not self._inflight.acquire(data_len, ADMISSION_WAIT):
+                conn.sendall(FRAME_ACK.pack(seq, STATUS_BUSY))
+                self._reject(client_addr, "busy", "正在接收的数据量超过上限", filename)
+                break
+            try:
+                with self._processing_slot():  # 准入通过后才占用处理槽位，接收完本帧即归还
+                    received_len, checksum_ok, full_save_path = self._receive_image(conn, full_save_path, data_len,
+                                                                                    crc, client_addr[0])
+            except (OSError, sqlite3.Error) as e:
+                # 保存失败时数据已无法继续对齐，回复错误后结束会话
+                conn.sendall(FRAME_ACK.pack(seq, STATUS_ERROR))
+                log.error(f"保存{filename}失败：{str(e)}", extra={"event": "save_failed", "client": client_addr[0], "file": filename})
+                break
+            finally:
+                self._inflight.release(data_len)
+            if received_len != data_len:
+                log.warning(f"接收不完整（{received_len}/{data_len}字节，来自{client_addr[0]}）",
+                            extra={"event": "incomplete", "client": client_addr[0], "file": filename})
+                break
+            if checksum_ok:
+                frame_count += 1
+                log.info(f"接收完成！文件已保存：{full_save_path}（第{frame_count}帧，{data_len / 1024:.1f}KB）",
+                         extra={"event": "saved", "client": client_addr[0], "file": filename, "bytes": data_len})
+                conn.sendall(FRAME_ACK.pack(seq, STATUS_OK))
+            else:
+                log.warning(f"{filename}校验失败，已丢弃（来自{client_addr[0]}）",
+                            extra={"event": "bad_checksum", "client": client_addr[0], "file": filename})
+                conn.sendall(FRAME_ACK.pack(seq, STATUS_BAD_CHECKSUM))
+
+    def _wait_frame(self, conn: socket.socket, header_buffer: bytearray) -> bool:
+        """等待下一帧的帧头：帧间使用较长的空闲超时，等待期间登记为空闲连接，stop()时会被直接关闭"""
+        conn.settimeout(self.idle_timeout)
+        with self._active_lock:
+            self._idle_conns.add(conn)
+        try:
+            # 登记后再检查一次：stop()在登记之前已遍历过空闲连接时，这里直接结束
+            if not self.is_running:
+                return False
+            return self._receive_into(conn, memoryview(header_buffer)) == FRAME_HEADER.size
+        finally:
+            with self._active_lock:
+                self._idle_conns.discard(conn)
+
+    @staticmethod
+    def _reject(client_addr: Tuple[str, int], reason: str, message: str, filename: str = "") -> None:
+        tracer.count("rejected", reason=reason)
+        extra = {"event": "rejected", "client": client_addr[0]}
+        if filename:
+            extra["file"] = filename
+        log.warning(f"拒绝来自{client_addr[0]}的上传：{message}", extra=extra)
+
+    @staticmethod
+    def _frame_filename(filename: str, content_type: int) -> str:
+        """文件名缺少扩展名时按内容类型补全"""
+        ext = CONTENT_TYPES.get(content_type, "")
+        if ext and not os.path.splitext(filename)[1]:
+            return filename + ext
+        return filename
+
+    def _serve_client(self, conn: socket.socket, client_addr: Tuple[str, int]) -> None:
+        """连接池中的任务入口：设置读超时，结束后归还连接槽位"""
+        with self._active_lock:
+            self.active_connections += 1
+        self._local.client = client_addr[0]
+        try:
+            conn.settimeout(self.read_timeout)
+            self._handle_client(conn, client_addr)
+        finally:
+            with self._active_lock:
+                self.active_connections -= 1
+            self._conn_slots.release()
+
+    def stats(self) -> dict:
+        """运行统计（工作进程定期上报给监管进程）：在途连接、累计连接/图片/字节数和异常数"""
+        counters, _ = tracer.metrics.snapshot()
+        totals = {}
+        for (event, _labels), value in counters.items():
+            totals[event] = totals.get(event, 0) + value
+        return {
+            "active": self.active_connections,
+            "connections": int(totals.get("connection", 0)),
+            "images": int(totals.get("image_received", 0)),
+            "bytes": int(totals.get("bytes_received", 0)),
+            "errors": int(totals.get("image_incomplete", 0) + totals.get("image_bad_checksum", 0) +
+                          totals.get("connection_timeout", 0)),
+            "rejected": int(totals.get("rejected", 0)),
+        }
 
     def start(self) -> None:
         try:
+            self._init_save_dir()
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server_socket.bind(("", self.port))
-            self.server_socket.listen(5)
+            self.server_socket.listen(self.backlog)
+            self._executor = ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix="image-client")
+            if self.on_image is not None and self.persist:
+                self._persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-persist")
 
             self.is_running = True
-            print("=" * 50)
-            print(f"[服务端] 启动成功！")
-            print(f"[服务端] 监听端口：{self.port}")
-            print(f"[服务端] 保存目录：{os.path.abspath(self.save_dir)}")
-            print(f"[服务端] 等待客户端连接（按Ctrl+C停止）")
-            print("=" * 50)
+            self.ready.set()
+            # event=ready 供界面进程判断端口已监听成功
+            log.info(f"启动成功！监听端口：{self.port}，保存目录：{os.path.abspath(self.save_dir)}，"
+                     f"连接数上限：{self.max_connections}，同时接收上限：{self.max_workers}（读超时{self.read_timeout}秒），"
+                     f"等待客户端连接（按Ctrl+C停止）",
+                     extra={"event": "ready"})
 
             while self.is_running:
                 try:
-                    client_conn, client_addr = self.server_socket.accept()
-                    self._handle_client(client_conn, client_addr)
+                    # 先占用连接槽位再accept，保证同时保持的连接数不超过上限
+                    self._conn_slots.acquire()
+                    try:
+                        client_conn, client_addr = self.server_socket.accept()
+                    except BaseException:
+                        self._conn_slots.release()
+                        raise
+                    self._executor.submit(self._serve_client, client_conn, client_addr)
                 except KeyboardInterrupt:
                     self.is_running = False
                 except Exception as e:
-                    print(f"[服务端] 等待连接时出错：{str(e)}")
+                    if self.is_running:
+                        log.error(f"等待连接时出错：{str(e)}")
 
         except Exception as e:
-            print(f"[服务端] 启动失败：{str(e)}")
+            log.critical(f"启动失败：{str(e)}", extra={"event": "start_failed"})
         finally:
+            self.is_running = False
             if self.server_socket:
                 self.server_socket.close()
-            print("\n[服务端] 已停止运行")
+            if self._executor:
+                self._executor.shutdown(wait=True)
+            if self._persist_executor:
+                self._persist_executor.shutdown(wait=True)
+            log.info("已停止运行", extra={"event": "stopped"})
+
+    def stop(self) -> None:
+        """
+        从其他线程停止服务：关闭监听socket以唤醒阻塞中的accept，并关闭等待下一帧的v2长连接
+        （否则处理池关闭时要等到空闲超时）；其余连接的处理线程在下一次读取后检查到停止即退出
+        """
+        self.is_running = False
+        if self.server_socket:
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
+        with self._active_lock:
+            idle_conns = list(self._idle_conns)
+        for conn in idle_conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def log_store_maintenance(result: dict) -> None:
+    """记录截图库一轮维护的结果（没有变化时不记录）"""
+    if result.get("error"):
+        log.error(f"截图库维护失败：{result['error']}", extra={"event": "store_error"})
+    elif result["removed"] or result["recompressed"]:
+        log.info(f"截图库维护：淘汰{result['removed']}张（释放{result['freed'] / 1024 / 1024:.1f}MB），"
+                 f"重新压缩{result['recompressed']}张", extra={"event": "store_maintenance"})
 
 
 if __name__ == "__main__":
@@ -124,8 +654,79 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="截图接收服务端")
     parser.add_argument("--port", type=int, default=7893, help="监听端口（默认7893）")
     parser.add_argument("--save-dir", type=str, default="received_screenshots", help="截图保存目录（默认received_screenshots）")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_MAX_WORKERS, help=f"同时接收数据的连接数上限（默认{DEFAULT_MAX_WORKERS}）")
+    parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help=f"同时保持的连接数上限，含帧间空闲的v2长连接（默认{DEFAULT_MAX_CONNECTIONS}）")
+    parser.add_argument("--read-timeout", type=float, default=DEFAULT_READ_TIMEOUT, help=f"单连接读超时秒数（默认{DEFAULT_READ_TIMEOUT}）")
+    parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT, help=f"v2长连接帧间空闲超时秒数（默认{DEFAULT_IDLE_TIMEOUT}）")
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG, help=f"监听队列长度（默认{DEFAULT_BACKLOG}）")
+    parser.add_argument("--max-image-bytes", type=int, default=DEFAULT_MAX_IMAGE_BYTES, help=f"单张图片大小上限（字节，默认{DEFAULT_MAX_IMAGE_BYTES}）")
+    parser.add_argument("--max-inflight-bytes", type=int, default=DEFAULT_MAX_INFLIGHT_BYTES, help=f"所有连接正在接收的数据总量上限（字节，默认{DEFAULT_MAX_INFLIGHT_BYTES}，0=不限）")
+    parser.add_argument("--client-rate", type=float, default=DEFAULT_CLIENT_RATE, help="单个客户端上传速率上限（字节/秒，默认0=不限）")
+    parser.add_argument("--trace-dir", type=str, default="", help="分阶段耗时追踪文件目录（默认不写追踪文件）")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Prometheus格式指标接口端口（默认0=关闭）")
+    parser.add_argument("--log-format", choices=("text", "json"), default="text", help="日志格式（json=每行一条JSON，供界面进程解析）")
+    parser.add_argument("--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="INFO", help="日志级别（默认INFO）")
+    parser.add_argument("--processes", type=int, default=0, help="监管模式：启动的工作进程数，以SO_REUSEPORT共享端口（默认0=单进程）")
+    parser.add_argument("--store", action="store_true", help="使用截图库：按内容哈希命名分目录保存，建立索引并定期淘汰")
+    parser.add_argument("--store-max-bytes", type=int, default=0, help="截图库容量上限（字节，超出按最近访问时间淘汰，默认0=不限）")
+    parser.add_argument("--store-max-age", type=float, default=0, help="截图保留时间（秒，默认0=不限）")
+    parser.add_argument("--recompress-age", type=float, default=0, help="PNG/BMP截图超过该时间（秒）后重新压缩为无损WebP（默认0=不压缩）")
+    parser.add_argument("--maintenance-interval", type=float, default=DEFAULT_MAINTENANCE_INTERVAL,
+                        help=f"截图库淘汰/重新压缩的执行间隔（秒，默认{DEFAULT_MAINTENANCE_INTERVAL:g}）")
+    parser.add_argument("--worker-id", type=int, default=0, help=argparse.SUPPRESS)  # 由监管进程传入，编号从1开始
+    parser.add_argument("--reuse-port", action="store_true", help=argparse.SUPPRESS)
     args = parser.parse_args()
+
+    setup_receiver_logging(args.log_format, args.log_level)
+
+    def start_store_maintenance():
+        """截图库的淘汰和重新压缩只在一个进程中执行（监管模式下为监管进程）"""
+        store = ScreenshotStore(args.save_dir, args.store_max_bytes, args.store_max_age, args.recompress_age)
+        store.start_maintenance(args.maintenance_interval, log_store_maintenance)
+
+    if args.processes > 0 and not args.worker_id:
+        # 监管模式：本进程只负责启动、监管工作进程并汇总日志，不监听端口
+        from supervisor_handler import ReceiverSupervisor
+
+        def build_worker_cmd(worker_id):
+            cmd = [sys.executable, os.path.abspath(__file__),
+                   "--port", str(args.port), "--save-dir", args.save_dir,
+                   "--max-workers", str(args.max_workers), "--max-connections", str(args.max_connections),
+                   "--read-timeout", str(args.read_timeout),
+                   "--idle-timeout", str(args.idle_timeout), "--backlog", str(args.backlog),
+                   "--max-image-bytes", str(args.max_image_bytes), "--max-inflight-bytes", str(args.max_inflight_bytes),
+                   "--client-rate", str(args.client_rate),
+                   "--log-format", "json", "--log-level", args.log_level, "--worker-id", str(worker_id)]
+            if args.processes > 1:
+                cmd.append("--reuse-port")
+            if args.store:
+                cmd.append("--store")
+            if args.trace_dir:
+                cmd += ["--trace-dir", args.trace_dir]
+            if args.metrics_port:
+                cmd += ["--metrics-port", str(args.metrics_port + worker_id - 1)]  # 每个工作进程一个指标端口
+            return cmd
+
+        if args.store:
+            start_store_maintenance()
+        sys.exit(ReceiverSupervisor(build_worker_cmd, args.processes, args.port).run())
+
+    # 追踪与指标（工作进程各自写 trace-receiver-<编号>.jsonl）
+    tracer.configure(f"receiver-{args.worker_id}" if args.worker_id else "receiver", args.trace_dir)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
     
     # 启动服务
-    server = ImageServer(save_dir=args.save_dir, port=args.port)
-    server.start()
\ No newline at end of file
+    store = ScreenshotStore(args.save_dir) if args.store else None
+    if store is not None and not args.worker_id:
+        start_store_maintenance()
+    server = ImageServer(save_dir=args.save_dir, port=args.port, max_workers=args.max_workers,
+                         max_connections=args.max_connections,
+                         read_timeout=args.read_timeout, backlog=args.backlog, idle_timeout=args.idle_timeout,
+                         reuse_port=args.reuse_port, store=store, max_image_bytes=args.max_image_bytes,
+                         max_inflight_bytes=args.max_inflight_bytes, client_rate=args.client_rate)
+    if args.worker_id:
+        from supervisor_handler import attach_worker
+        attach_worker(server)
+    server.start()
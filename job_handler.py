@@ -0,0 +1,170 @@
+# job_handler.py：分析任务调度（有界队列 + 并发AI线程池）
+import time
+import itertools
+from collections import deque
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+import config  # 导入全局配置
+from ai_handler import ImageAnalyzer
+from monitor_handler import lookup_sender
+from trace_handler import tracer, new_trace_id
+
+
+# -------------------------- AI调用线程 --------------------------
+class ApiThread(QThread):
+    """独立线程调用AI接口（ai_handler.ImageAnalyzer），避免阻塞UI"""
+    result_signal = pyqtSignal(str, str)  # 信号：(推理过程, 回答内容)
+    reasoning_delta_signal = pyqtSignal(str)  # 流式输出：推理过程增量
+    answer_delta_signal = pyqtSignal(str)     # 流式输出：回答内容增量（原始文本）
+    answer_html_signal = pyqtSignal(str, str) # 流式输出：回答增量渲染结果（新提交的HTML, 末尾块HTML）
+
+    def __init__(self, asset, question, trace_id=None, image_path=None, sender=None):
+        super().__init__()
+        self.asset = asset            # 图片资源（image_handler.ImageAsset，Base64编码在线程中完成，不占用界面线程）
+        self.question = question      # 用户问题
+        self.trace_id = trace_id      # 追踪ID
+        self.image_path = image_path  # 自动分析的截图路径（变化区域提取据此查找发送端，手动发送为None）
+        self.sender = sender          # 发送端（进程内接收模式直接传入）
+        self.result = None            # 分析结果字典（含各阶段耗时）
+
+    def diff_key(self):
+        """变化区域提取按发送端区分上一张截图；后台接收模式在当前线程查询截图库索引，查不到时归为同一组"""
+        if not (config.DIFF_ENABLED and self.image_path):
+            return None
+        return self.sender or lookup_sender(self.image_path) or ""
+
+    def run(self):
+        analyzer = ImageAnalyzer(
+            self.asset, self.question,
+            on_reasoning=self.reasoning_delta_signal.emit,
+            on_answer=self.answer_delta_signal.emit,
+            on_answer_html=self.answer_html_signal.emit,
+            trace_id=self.trace_id,
+            diff_key=self.diff_key()
+        )
+        self.result = analyzer.run()
+        self.result_signal.emit(self.result["reasoning"], self.result["answer"])
+
+
+# -------------------------- 任务状态 --------------------------
+class JobState:
+    QUEUED = "排队中"
+    RUNNING = "分析中"
+    DONE = "已完成"
+    FAILED = "失败"
+    DROPPED = "已丢弃"
+
+    # 允许的状态流转
+    TRANSITIONS = {
+        QUEUED: (RUNNING, DROPPED),
+        RUNNING: (DONE, FAILED),
+        DONE: (),
+        FAILED: (),
+        DROPPED: (),
+    }
+
+
+class AnalysisJob:
+    """一次截图分析任务"""
+    _ids = itertools.count(1)
+
+    def __init__(self, image_path, asset, question, auto=True, trace_id=None, sender=None):
+        self.id = next(self._ids)
+        self.image_path = image_path  # 图片路径（仅用于显示）
+        self.asset = asset            # 图片资源（原始数据、哈希、Base64编码、缩略图）
+        self.question = question
+        self.auto = auto              # True=自动分析的新截图，False=手动发送
+        self.sender = sender          # 发送端（未知时为None）
+        self.trace_id = trace_id or new_trace_id()  # 追踪ID（接收服务/目录监控传入，手动任务新生成）
+        self.created_at = time.perf_counter()
+        self.state = JobState.QUEUED
+        self.thread = None
+        self.stream_section = None    # 流式输出当前区块（由界面维护）
+        self.stream_frame = None
+        self.tail_frame = None        # 流式回答末尾未完成块所在的文本框架
+        self.stream_generation = None  # 创建文本框架时对话区的清屏代数，与当前代数不同说明框架已随清屏删除
+
+    def set_state(self, state):
+        if state not in JobState.TRANSITIONS[self.state]:
+            raise ValueError(f"任务#{self.id}状态不能从「{self.state}」变为「{state}」")
+        self.state = state
+
+
+# -------------------------- 任务调度器 --------------------------
+class JobScheduler(QObject):
+    """
+    有界任务队列：最多同时运行 max_concurrent 个AI线程，排队任务超过 max_queued 时丢弃最早排队的任务。
+    暂停（冷却等待）期间只排队不派发，正在运行的任务不受影响。
+    """
+    job_started = pyqtSignal(object)                # 任务开始分析
+    job_reasoning_delta = pyqtSignal(object, str)   # 任务推理过程增量
+    job_answer_html = pyqtSignal(object, str, str)  # 任务回答增量渲染：(任务, 新提交的HTML, 末尾块HTML)
+    job_finished = pyqtSignal(object, str, str)     # 任务完成：(任务, 推理过程, 回答内容)
+    job_dropped = pyqtSignal(object)                # 队列已满，任务被丢弃
+    queue_changed = pyqtSignal(int, int)            # 队列变化：(排队数, 进行中数)
+    idle = pyqtSignal()                             # 所有任务处理完毕
+
+    def __init__(self, max_concurrent=3, max_queued=10):
+        super().__init__()
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queued = max(1, max_queued)
+        self.queue = deque()
+        self.running = set()
+        self.paused = False
+        self._threads = set()  # 持有线程引用直到线程真正结束
+
+    @property
+    def busy(self):
+        return bool(self.running)
+
+    def submit(self, job):
+        """加入队列并尝试派发，返回任务"""
+        if len(self.queue) >= self.max_queued:
+            dropped = self.queue.popleft()
+            dropped.set_state(JobState.DROPPED)
+            tracer.count("job_dropped")
+            self.job_dropped.emit(dropped)
+        self.queue.append(job)
+        self._dispatch()
+        return job
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.queue and not self.paused and len(self.running) < self.max_concurrent:
+            job = self.queue.popleft()
+            job.set_state(JobState.RUNNING)
+            tracer.record(job.trace_id, "queue_wait", time.perf_counter() - job.created_at)
+            job.thread = ApiThread(job.asset, job.question, job.trace_id,
+                                   image_path=job.image_path if job.auto else None, sender=job.sender)
+            job.thread.reasoning_delta_signal.connect(lambda text, j=job: self.job_reasoning_delta.emit(j, text))
+            job.thread.answer_html_signal.connect(
+                lambda committed, tail, j=job: self.job_answer_html.emit(j, committed, tail))
+            job.thread.result_signal.connect(lambda reasoning, answer, j=job: self._on_result(j, reasoning, answer))
+            job.thread.finished.connect(lambda t=job.thread: self._threads.discard(t))
+            self._threads.add(job.thread)
+            self.running.add(job)
+            self.job_started.emit(job)
+            job.thread.start()
+        self.queue_changed.emit(len(self.queue), len(self.running))
+
+    def _on_result(self, job, reasoning, answer):
+        job.set_state(JobState.DONE if answer else JobState.FAILED)
+        self.running.discard(job)
+        job.asset = None  # 释放图片数据
+        job.thread = None
+        self.job_finished.emit(job, reasoning, answer)
+        # 先通知空闲（界面可借此暂停派发进入冷却），再派发排队任务
+        if not self.running:
+            self.idle.emit()
+        self._dispatch()
+
+    def shutdown(self):
+        """关闭时清空队列并等待运行中的线程结束"""
+        self.queue.clear()
+        for thread in list(self._threads):
+            thread.wait()
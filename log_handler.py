@@ -0,0 +1,188 @@
+# log_handler.py：截图接收服务的结构化日志（分级、JSON行输出、界面端环形缓冲）
+"""
+接收服务使用名为 "image_server" 的logger输出分级日志：
+  - 独立运行时默认输出为可读文本；由界面以后台进程启动时使用 --log-format json，每行一条JSON；
+  - 界面进程中的读取线程用 parse_log_line 解析每一行，存入 LogBuffer（固定容量的环形缓冲）；
+  - 进程内接收模式下直接给logger挂 BufferHandler，日志进入同一个缓冲区。
+界面据此显示最近的接收日志和服务健康状况。只依赖标准库，image_server.py 独立运行时也可使用。
+"""
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque
+
+LOGGER_NAME = "image_server"
+DEFAULT_BUFFER_SIZE = 500
+# 除级别和消息外写入JSON的附加字段（通过 logger.info(..., extra={...}) 传入）
+EXTRA_FIELDS = ("event", "client", "file", "bytes", "worker", "stats")
+# 控制事件：不受日志级别限制始终输出（界面据此判断就绪、汇总工作进程状态）
+CONTROL_EVENTS = ("ready", "stats", "worker_stats")
+
+
+def get_logger() -> logging.Logger:
+    return logging.getLogger(LOGGER_NAME)
+
+
+# -------------------------- 输出格式 --------------------------
+class JsonLineFormatter(logging.Formatter):
+    """每条日志输出为一行JSON：{ts, level, msg, 附加字段...}"""
+
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "msg": record.getMessage()}
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """可读文本格式，与原有的 [服务端] 前缀保持一致，警告以上标出级别"""
+
+    def format(self, record):
+        level = f"[{record.levelname}]" if record.levelno >= logging.WARNING else ""
+        worker = getattr(record, "worker", None)
+        source = f"服务端#{worker}" if worker is not None else "服务端"
+        text = f"[{source}]{level} {record.getMessage()}"
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+class LevelFilter(logging.Filter):
+    """按级别过滤，CONTROL_EVENTS 中的事件始终放行"""
+
+    def __init__(self, level: str):
+        super().__init__()
+        self.levelno = logging.getLevelName(level.upper())
+
+    def filter(self, record):
+        return record.levelno >= self.levelno or getattr(record, "event", None) in CONTROL_EVENTS
+
+
+def setup_receiver_logging(log_format: str = "text", level: str = "INFO") -> logging.Logger:
+    """独立运行的接收服务：日志输出到标准输出（json格式供界面进程解析）"""
+    logger = get_logger()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonLineFormatter() if log_format == "json" else TextFormatter())
+    handler.addFilter(LevelFilter(level))
+    logger.handlers[:] = [handler]
+    # logger本身至少放行INFO，控制事件由处理器上的过滤器决定是否输出
+    logger.setLevel(min(logging.getLevelName(level.upper()), logging.INFO))
+    logger.propagate = False
+    return logger
+
+
+# -------------------------- 界面端缓冲 --------------------------
+def parse_log_line(line: str, default_level: str = "INFO") -> dict:
+    """解析接收服务输出的一行：JSON日志直接解析，其他内容（如标准错误中的异常堆栈）按原文记为 default_level"""
+    line = line.rstrip("\n")
+    if line.startswith("{"):
+        try:
+            entry = json.loads(line)
+            if isinstance(entry, dict) and "msg" in entry:
+                entry.setdefault("level", "INFO")
+                entry.setdefault("ts", time.time())
+                return entry
+        except ValueError:
+            pass
+    return {"ts": time.time(), "level": default_level, "msg": line}
+
+
+class LogBuffer:
+    """线程安全的环形日志缓冲，同时统计各级别条数、最近一次错误和最后活动时间"""
+
+    def __init__(self, max_entries: int = DEFAULT_BUFFER_SIZE):
+        self._entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+        self.level_counts = {}
+        self.event_counts = {}
+        self.last_error = None  # 最近一条 WARNING 以上的日志
+        self.last_ts = None
+        self.workers = []  # 多进程接收服务最近一次上报的各工作进程状态（worker_stats事件）
+
+    def append(self, entry: dict) -> None:
+        with self._lock:
+            self._entries.append(entry)
+            level = entry.get("level", "INFO")
+            self.level_counts[level] = self.level_counts.get(level, 0) + 1
+            event = entry.get("event")
+            if event:
+                self.event_counts[event] = self.event_counts.get(event, 0) + 1
+            if level in ("WARNING", "ERROR", "CRITICAL"):
+                self.last_error = entry
+            self.last_ts = entry.get("ts")
+
+    def update_workers(self, workers: list) -> None:
+        with self._lock:
+            self.workers = list(workers)
+
+    def recent(self, limit: int = None) -> list:
+        with self._lock:
+            entries = list(self._entries)
+        return entries[-limit:] if limit else entries
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "levels": dict(self.level_counts),
+                "events": dict(self.event_counts),
+                "last_error": self.last_error,
+                "last_ts": self.last_ts,
+                "workers": list(self.workers),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class BufferHandler(logging.Handler):
+    """把logger的日志直接写入LogBuffer（进程内接收模式使用）"""
+
+    def __init__(self, buffer: LogBuffer):
+        super().__init__()
+        self.buffer = buffer
+        self._formatter = JsonLineFormatter()
+
+    def emit(self, record):
+        try:
+            self.buffer.append(json.loads(self._formatter.format(record)))
+        except Exception:
+            self.handleError(record)
+
+
+def attach_buffer(buffer: LogBuffer, level: str = "INFO") -> logging.Logger:
+    """进程内运行接收服务：日志写入缓冲区，警告以上同时输出到标准错误"""
+    logger = get_logger()
+    console = logging.StreamHandler()
+    console.setLevel(logging.WARNING)
+    console.setFormatter(TextFormatter())
+    logger.handlers[:] = [BufferHandler(buffer), console]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    return logger
+
+
+def format_entry(entry: dict) -> str:
+    """日志条目显示为一行文本"""
+    ts = time.strftime("%H:%M:%S", time.localtime(entry.get("ts", 0)))
+    text = f"{ts} [{entry.get('level', 'INFO')}] {entry.get('msg', '')}"
+    if entry.get("exc"):
+        text += "\n" + entry["exc"]
+    return text
+
+
+def format_worker(worker: dict) -> str:
+    """工作进程状态显示为一行文本"""
+    if not worker.get("alive"):
+        return f"#{worker.get('worker')} 已退出（退出码{worker.get('exit_code')}），等待重启　重启：{worker.get('restarts', 0)}次"
+    uptime = int(time.time() - worker.get("started", time.time()))
+    return (f"#{worker.get('worker')} pid {worker.get('pid')}　运行{uptime}秒　"
+            f"在途连接：{worker.get('active', 0)}　累计连接：{worker.get('connections', 0)}　"
+            f"图片：{worker.get('images', 0)}张（{worker.get('bytes', 0) / 1024 / 1024:.1f}MB）　"
+            f"异常：{worker.get('errors', 0)}　拒绝：{worker.get('rejected', 0)}　重启：{worker.get('restarts', 0)}次")
@@ -1,21 +1,16 @@
 # main.py：程序入口（整合所有模块）
 import sys
-from PyQt5.QtWidgets import QApplication
+import threading
+from importlib.util import find_spec
 import config  # 导入全局配置
-from ui_components import InitConfigDialog, ImageChatMainWindow
-from ai_handler import init_ai_client
-from monitor_handler import start_image_server_in_background
 
 
 def check_dependency():
-    """检查必要依赖库是否安装"""
-    required_libs = ["markdown", "watchdog", "PyQt5", "openai", "pybase64"]
-    missing_libs = []
-    for lib in required_libs:
-        try:
-            __import__(lib)
-        except ImportError:
-            missing_libs.append(lib)
+    """检查必要依赖库是否安装（只查找模块，不实际导入，避免拖慢启动）"""
+    # 模块名 -> pip包名
+    required_libs = {"markdown": "markdown", "watchdog": "watchdog", "PyQt5": "PyQt5",
+                     "openai": "openai", "pybase64": "pybase64", "PIL": "pillow"}
+    missing_libs = [package for module, package in required_libs.items() if find_spec(module) is None]
     if missing_libs:
         print(f"❌ 请先安装缺失的依赖库：")
         print(f"pip install {' '.join(missing_libs)}")
@@ -27,6 +22,13 @@ if __name__ == "__main__":
     # 1. 检查依赖库
     if not check_dependency():
         sys.exit(1)
+
+    # 依赖检查通过后再导入界面等模块（openai等较慢的库由各模块推迟到实际使用时导入）
+    from PyQt5.QtWidgets import QApplication
+    from ui_components import InitConfigDialog, ImageChatMainWindow
+    from ai_handler import init_ai_client
+    from monitor_handler import launch_image_server, wait_image_server_ready
+    from trace_handler import tracer, start_metrics_server
     
     # 2. 初始化Qt应用
     app = QApplication(sys.argv)
@@ -37,16 +39,31 @@ if __name__ == "__main__":
         # 用户取消配置，退出程序
         sys.exit(0)
     
-    # 4. 初始化AI客户端（使用配置的API Key）
-    init_ai_client(config.api_key)
-    
-    # 5. 后台启动截图接收服务
-    if not start_image_server_in_background():
+    # 4. 后台启动截图接收服务（inprocess模式由主窗口在进程内启动），不等待就绪
+    use_subprocess = config.RECEIVER_MODE != "inprocess"
+    if use_subprocess and not launch_image_server():
         sys.exit(1)
-    
-    # 6. 启动主窗口
+
+    # 5. 后台线程初始化AI客户端（使用配置的API Key），与接收服务启动、窗口创建并行
+    client_thread = threading.Thread(target=init_ai_client, args=(config.api_key,), name="init-ai-client")
+    client_thread.start()
+
+    # 6. 分阶段耗时追踪与指标接口
+    tracer.configure("gui", config.TRACE_DIR if config.TRACE_ENABLED else "",
+                     config.TRACE_MAX_BYTES, config.TRACE_BACKUP_COUNT)
+    if config.METRICS_PORT:
+        start_metrics_server(config.METRICS_PORT)
+
+    # 7. 创建主窗口，然后等待接收服务就绪和AI客户端创建完成
     main_window = ImageChatMainWindow()
+    client_thread.join()
+    if config.client is None:
+        print("❌ AI客户端初始化失败，请检查依赖库和API Key配置")
+        sys.exit(1)
+    if use_subprocess and not wait_image_server_ready():
+        sys.exit(1)
+    main_window.update_status_bar()
     main_window.show()
     
-    # 7. 运行应用
-    sys.exit(app.exec_())
\ No newline at end of file
+    # 8. 运行应用
+    sys.exit(app.exec_())
@@ -1,67 +1,346 @@
 # monitor_handler.py：监控逻辑（目录监控、后台服务启动）
 import sys
 import os
+import queue
 import subprocess
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5.QtCore import QThread, pyqtSignal
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from PyQt5.QtWidgets import QMessageBox
 import config  # 导入全局变量
+from image_server import ImageServer, log_store_maintenance
+from log_handler import LogBuffer, attach_buffer, parse_log_line, format_entry
+from image_handler import ImageAsset
+from store_handler import ScreenshotStore, is_archived, STATUS_ANALYZED, STATUS_FAILED
+from trace_handler import tracer, file_trace_id
+
+
+# -------------------------- 目录监控 --------------------------
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+STABLE_POLL_INTERVAL = 0.05  # 只收到创建事件时，轮询文件大小判断写入完成的间隔（秒）
+STABLE_TIMEOUT = 10.0        # 文件持续写入超过该时间仍未稳定则放弃
+DEDUP_TTL = 600.0            # 去重记录保留时间（秒）
+DEDUP_MAX_ENTRIES = 1024     # 去重记录条数上限
+
+
+class RecentKeys:
+    """有界、按时间过期的去重集合（按加入顺序淘汰）"""
+
+    def __init__(self, max_entries=DEDUP_MAX_ENTRIES, ttl=DEDUP_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items = OrderedDict()  # 键 -> 加入时间
+
+    def add(self, key):
+        """加入键，已存在（未过期）时返回False"""
+        now = time.monotonic()
+        while self._items:
+            oldest_key, added = next(iter(self._items.items()))
+            if now - added < self.ttl:
+                break
+            del self._items[oldest_key]
+        if key in self._items:
+            return False
+        self._items[key] = now
+        if len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+        return True
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ImageFileHandler(FileSystemEventHandler):
+    """
+    目录事件处理器：发现写入完成的新图片时调用 callback(图片路径)（不依赖Qt，基准测试也直接复用）。
+    - 关闭写入（Linux）/重命名（接收服务写临时文件后原子重命名）事件：文件已完整，立即处理；
+    - 只有创建事件时（直接写入目标文件的客户端）：轮询文件大小，连续两次不变即视为写入完成。
+    watchdog的事件线程只负责把事件放入队列，判断和回调都在独立的检测线程中完成，不阻塞后续事件。
+    同一文件（路径+大小+修改时间相同）的重复事件只处理一次，去重记录有数量上限并按时间过期。
+    """
+
+    def __init__(self, callback, poll_interval=STABLE_POLL_INTERVAL, stable_timeout=STABLE_TIMEOUT, root=None):
+        self.callback = callback
+        self.root = root  # 监控根目录：其下截图库归档目录中的文件（重新压缩的旧截图）不再处理
+        self.poll_interval = poll_interval
+        self.stable_timeout = stable_timeout
+        self._events = queue.Queue()
+        self._pending = {}  # 等待写入完成的路径 -> [上次大小, 首次发现时间]
+        self._recent = RecentKeys()
+        self._thread = threading.Thread(target=self._run, name="image-detect", daemon=True)
+        self._thread.start()
+
+    def _is_image(self, path):
+        # 只处理图片文件，排除隐藏文件（如接收服务的临时文件）和截图库归档目录
+        return (path.lower().endswith(IMAGE_EXTENSIONS) and not os.path.basename(path).startswith(".")
+                and not (self.root and is_archived(path, self.root)))
+
+    def on_created(self, event):
+        if not event.is_directory and self._is_image(event.src_path):
+            self._events.put(("created", event.src_path))
+
+    def on_closed(self, event):
+        # 写入后关闭（inotify IN_CLOSE_WRITE），文件内容已完整
+        if not event.is_directory and self._is_image(event.src_path):
+            self._events.put(("ready", event.src_path))
+
+    def on_moved(self, event):
+        # 接收服务先写临时文件再原子重命名，重命名完成即代表文件已完整写入
+        if not event.is_directory and self._is_image(event.dest_path):
+            self._events.put(("ready", event.dest_path))
+
+    def stop(self):
+        self._events.put(None)
+        self._thread.join()
+
+    def _run(self):
+        next_poll = 0.0
+        while True:
+            timeout = max(0.0, next_poll - time.monotonic()) if self._pending else None
+            try:
+                item = self._events.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                kind, path = item
+                if kind == "ready":
+                    self._pending.pop(path, None)
+                    self._dispatch(path)
+                elif path not in self._pending:
+                    self._pending[path] = [-1, time.monotonic()]
+            if self._pending and time.monotonic() >= next_poll:
+                self._poll_pending()
+                next_poll = time.monotonic() + self.poll_interval
+
+    def _poll_pending(self):
+        """检查只收到创建事件的文件：大小连续两次相同即写入完成"""
+        now = time.monotonic()
+        for path, state in list(self._pending.items()):
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                del self._pending[path]  # 文件已被删除或改名（改名会另有事件）
+                continue
+            if size > 0 and size == state[0]:
+                del self._pending[path]
+                self._dispatch(path)
+            elif now - state[1] > self.stable_timeout:
+                del self._pending[path]
+                print(f"[监控] {os.path.basename(path)}写入超过{self.stable_timeout:.0f}秒仍未完成，已跳过")
+            else:
+                state[0] = size
+
+    def _dispatch(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if not self._recent.add((path, st.st_size, st.st_mtime_ns)):
+            return
+        try:
+            self.callback(path)
+        except Exception as e:
+            print(f"[监控] 处理新截图{os.path.basename(path)}出错：{str(e)}")
+
+
+# -------------------------- 图片资源（读取文件、生成缩略图） --------------------------
+# 单个线程按到达顺序处理，界面线程只接收已准备好的图片资源（不读文件、不解码、不缩放）
+_asset_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-asset")
+_thumbnail_size = (400, 220)  # 缩略图尺寸上限，界面在图片显示区大小变化时更新
+
+
+def set_thumbnail_size(width, height):
+    global _thumbnail_size
+    _thumbnail_size = (max(1, width), max(1, height))
+
+
+def load_asset(path="", data=None, sha256=None, trace_id=None):
+    """读取图片（已有数据时不再读文件）并按当前显示尺寸生成缩略图"""
+    start = time.perf_counter()
+    asset = ImageAsset.from_file(path) if data is None else ImageAsset(data, path, sha256)
+    if trace_id and data is None:
+        tracer.record(trace_id, "read", time.perf_counter() - start)
+    start = time.perf_counter()
+    asset.make_thumbnail(*_thumbnail_size)
+    if trace_id:
+        tracer.record(trace_id, "thumbnail", time.perf_counter() - start)
+    return asset
+
+
+def submit_asset(callback, path="", data=None, sha256=None, trace_id=None):
+    """
+    在图片资源线程中执行 load_asset，完成后在该线程调用 callback(图片资源)；读取或解码失败时为None
+    （损坏、截断的图片除OSError外还可能抛出ValueError/SyntaxError等，一律记录后跳过该文件）
+    """
+
+    def task():
+        try:
+            asset = load_asset(path, data, sha256, trace_id)
+        except Exception as e:
+            print(f"[图片] 读取失败，已跳过：{path}（{type(e).__name__}：{str(e)}）")
+            asset = None
+        callback(asset)
+
+    _asset_executor.submit(task)
 
 
-# -------------------------- 目录监控线程 --------------------------
 class MonitorThread(QThread):
-    """监控截图目录，发现新图片时发送信号"""
-    new_image_signal = pyqtSignal(str)  # 信号：新图片路径
+    """监控截图目录，发现新图片时在图片资源线程中读取并生成缩略图，完成后发送信号"""
+    new_image_signal = pyqtSignal(str, str, object)  # 信号：(新图片路径, 追踪ID, 图片资源)
 
     def __init__(self):
         super().__init__()
         self.observer = None
 
-    def run(self):
-        # 自定义文件事件处理器
-        class ImageFileHandler(FileSystemEventHandler):
-            def __init__(self, signal):
-                self.signal = signal
-                self.processed_files = set()  # 避免重复处理同一文件
-
-            def on_created(self, event):
-                # 只处理图片文件，排除目录
-                if not event.is_directory and event.src_path.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
-                    time.sleep(1)  # 等待文件写入完成
-                    if event.src_path not in self.processed_files:
-                        self.processed_files.add(event.src_path)
-                        self.signal.emit(event.src_path)
+    def _on_new_image(self, path):
+        # 追踪ID由文件推导，与接收服务进程记录的ID一致；发现耗时=文件写完到被监控发现
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        trace_id = file_trace_id(path, st)
+        tracer.record(trace_id, "detect", max(0.0, time.time() - st.st_mtime))
+        tracer.count("image_detected")
+        submit_asset(lambda asset: asset and self.new_image_signal.emit(path, trace_id, asset),
+                     path=path, trace_id=trace_id)
 
+    def run(self):
         # 启动监控（使用全局配置的监控目录）
-        event_handler = ImageFileHandler(self.new_image_signal)
+        event_handler = ImageFileHandler(self._on_new_image, root=config.MONITOR_DIR)
         self.observer = Observer()
-        self.observer.schedule(event_handler, path=config.MONITOR_DIR, recursive=False)
+        # 截图库按哈希分子目录保存，需要递归监控
+        self.observer.schedule(event_handler, path=config.MONITOR_DIR, recursive=config.STORE_ENABLED)
         self.observer.start()
         
         # 保持线程运行
         try:
             while not self.isInterruptionRequested():
-                time.sleep(1)
+                time.sleep(0.2)
         finally:
             self.observer.stop()
             self.observer.join()
+            event_handler.stop()
 
 
-# -------------------# -------------------------- 后台启动截图接收服务 --------------------------
-def start_image_server_in_background():
+# -------------------------- 截图库 --------------------------
+_store = None
+_store_executor = None  # 分析状态写入索引在后台线程完成，不阻塞界面
+
+
+def get_store():
+    """按当前配置的监控目录打开截图库（未启用时返回None）"""
+    global _store
+    if _store is None and config.STORE_ENABLED:
+        _store = ScreenshotStore(config.MONITOR_DIR, config.STORE_MAX_BYTES, config.STORE_MAX_AGE,
+                                 config.STORE_RECOMPRESS_AGE)
+    return _store
+
+
+def record_analysis(image_path, ok):
+    """在截图库索引中记录分析结果（手动选择的库外图片会被忽略）"""
+    global _store_executor
+    store = get_store()
+    if store is None or not image_path:
+        return
+    if _store_executor is None:
+        _store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store-status")
+    future = _store_executor.submit(store.set_status, image_path, STATUS_ANALYZED if ok else STATUS_FAILED)
+    future.add_done_callback(lambda f: f.exception() and print(f"[截图库] 记录分析状态失败：{f.exception()}"))
+
+
+def lookup_sender(image_path):
+    """从截图库索引查找截图的发送端（未启用截图库或不在库中时返回None）"""
+    store = get_store()
+    if store is None or not image_path:
+        return None
+    try:
+        return store.sender_of(image_path)
+    except Exception:
+        return None
+
+
+# -------------------------- 进程内截图接收线程 --------------------------
+class ReceiverThread(QThread):
+    """在GUI进程内运行截图接收服务，收到的图片数据直接通过信号交给分析流程（不经过磁盘和目录监控）"""
+    new_image_data_signal = pyqtSignal(str, str, object, str)  # 信号：(图片保存路径, 追踪ID, 图片资源, 发送端)
+
+    def __init__(self):
+        super().__init__()
+        attach_buffer(receiver_logs, config.RECEIVER_LOG_LEVEL)
+        self.server = ImageServer(
+            save_dir=config.MONITOR_DIR,
+            port=config.SERVER_PORT,
+            max_workers=config.RECEIVER_MAX_WORKERS,
+            max_connections=config.RECEIVER_MAX_CONNECTIONS,
+            read_timeout=config.RECEIVER_READ_TIMEOUT,
+            max_image_bytes=config.RECEIVER_MAX_IMAGE_BYTES,
+            max_inflight_bytes=config.RECEIVER_MAX_INFLIGHT_BYTES,
+            client_rate=config.RECEIVER_CLIENT_RATE,
+            on_image=self._on_image,
+            persist=config.RECEIVER_PERSIST,
+            store=get_store()
+        )
+        if self.server.store is not None and config.RECEIVER_PERSIST:
+            self.server.store.start_maintenance(config.STORE_MAINTENANCE_INTERVAL, log_store_maintenance)
+
+    def _on_image(self, filename, image_data, meta):
+        # 在接收服务的处理线程中调用：缩略图交给图片资源线程生成（不推迟给客户端的确认），信号会排队到GUI线程
+        submit_asset(lambda asset: asset and self.new_image_data_signal.emit(meta["path"], meta["trace_id"], asset,
+                                                                           meta["sender"]),
+                     path=meta["path"], data=image_data, sha256=meta.get("sha256"), trace_id=meta["trace_id"])
+
+    def run(self):
+        self.server.start()
+
+    def wait_ready(self, timeout=3):
+        """等待端口监听成功，返回是否就绪"""
+        return self.server.ready.wait(timeout) and self.server.is_running
+
+    def is_serving(self):
+        return self.isRunning() and self.server.is_running
+
+    def stop(self):
+        self.server.stop()
+        self.wait()
+
+
+# -------------------------- 后台启动截图接收服务 --------------------------
+receiver_logs = LogBuffer(config.RECEIVER_LOG_BUFFER)  # 接收服务最近的日志（两种接收模式共用）
+_server_ready = threading.Event()  # 后台接收服务输出就绪日志（event=ready）后置位
+_drain_threads = []  # 读取接收服务输出的线程
+
+
+def _drain_server_output(stream, default_level):
     """
-    后台启动image_server.py（截图接收服务）
-    返回：True=启动成功，False=启动失败
+    持续读取接收服务的输出（JSON行日志）存入环形缓冲：识别就绪事件，警告以上同时打印到控制台。
+    读取线程不断消费管道，接收服务不会因管道写满而阻塞在日志输出上。
     """
-    import sys
-    import os
-    import subprocess
-    import time
-    from PyQt5.QtWidgets import QMessageBox
-    import config  # 确保已导入全局配置
+    for line in stream:
+        if not line.strip():
+            continue
+        entry = parse_log_line(line, default_level)
+        if entry.get("event") == "worker_stats":
+            # 工作进程状态只保留最新一份，不进入日志列表
+            receiver_logs.update_workers((entry.get("stats") or {}).get("workers", []))
+            continue
+        if entry.get("event") == "ready":
+            _server_ready.set()
+        receiver_logs.append(entry)
+        if entry.get("level") in ("WARNING", "ERROR", "CRITICAL"):
+            sys.stdout.write(f"[接收服务] {format_entry(entry)}\n")
+
 
+def launch_image_server():
+    """
+    后台启动image_server.py（截图接收服务），不等待其就绪，以便与其他初始化并行
+    返回：True=进程已启动，False=启动失败
+    """
     # 关键：根据运行环境动态获取 image_server.py 路径
     if getattr(sys, 'frozen', False):
         # 打包后环境（exe运行时）：获取exe所在目录，image_server.py与exe同级
@@ -90,37 +369,57 @@ def start_image_server_in_background():
             sys.executable,  # 当前Python解释器路径（开发环境）或打包后的内置解释器（exe环境）
             image_server_path,
             "--port", str(config.SERVER_PORT),
-            "--save-dir", config.MONITOR_DIR
+            "--save-dir", config.MONITOR_DIR,
+            "--max-workers", str(config.RECEIVER_MAX_WORKERS),
+            "--max-connections", str(config.RECEIVER_MAX_CONNECTIONS),
+            "--read-timeout", str(config.RECEIVER_READ_TIMEOUT),
+            "--max-image-bytes", str(config.RECEIVER_MAX_IMAGE_BYTES),
+            "--max-inflight-bytes", str(config.RECEIVER_MAX_INFLIGHT_BYTES),
+            "--client-rate", str(config.RECEIVER_CLIENT_RATE),
+            "--log-format", "json",
+            "--log-level", config.RECEIVER_LOG_LEVEL
         ]
+        if config.STORE_ENABLED:
+            cmd += ["--store", "--store-max-bytes", str(config.STORE_MAX_BYTES),
+                    "--store-max-age", str(config.STORE_MAX_AGE),
+                    "--recompress-age", str(config.STORE_RECOMPRESS_AGE),
+                    "--maintenance-interval", str(config.STORE_MAINTENANCE_INTERVAL)]
+        if config.RECEIVER_PROCESSES > 0:
+            cmd += ["--processes", str(config.RECEIVER_PROCESSES)]
+        if config.TRACE_ENABLED:
+            cmd += ["--trace-dir", config.TRACE_DIR]
+        if config.METRICS_PORT:
+            cmd += ["--metrics-port", str(config.METRICS_PORT + 1)]
 
-        # Windows系统隐藏命令行窗口，其他系统默认显示
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        # Windows系统隐藏命令行窗口（STARTUPINFO仅Windows可用）
+        popen_kwargs = {}
+        if os.name == "nt":
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            popen_kwargs["startupinfo"] = startupinfo
 
         # 启动后台进程，赋值给全局变量
+        _server_ready.clear()
         config.image_server_process = subprocess.Popen(
             cmd,
-            startupinfo=startupinfo,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            env=dict(os.environ, PYTHONUNBUFFERED="1", PYTHONIOENCODING="utf-8"),  # 日志实时送达
+            **popen_kwargs
         )
-
-        # 延迟1秒检查启动状态
-        time.sleep(1)
-        if config.image_server_process.poll() is None:
-            # poll()返回None表示进程正在运行
-            print(f"[服务整合] 截图接收服务已在后台启动（端口：{config.SERVER_PORT}，目录：{config.MONITOR_DIR}）")
-            return True
-        else:
-            # 进程已退出，获取错误信息
-            error = config.image_server_process.stderr.read()
-            QMessageBox.critical(
-                None, 
-                "启动失败", 
-                f"截图接收服务启动失败：\n{error}"
-            )
-            return False
+        process = config.image_server_process
+        _drain_threads[:] = [
+            threading.Thread(target=_drain_server_output, args=(process.stdout, "INFO"),
+                             name="image-server-stdout", daemon=True),
+            threading.Thread(target=_drain_server_output, args=(process.stderr, "ERROR"),
+                             name="image-server-stderr", daemon=True),
+        ]
+        for thread in _drain_threads:
+            thread.start()
+        return True
 
     except Exception as e:
         QMessageBox.critical(
@@ -128,4 +427,46 @@ def start_image_server_in_background():
             "启动异常", 
             f"启动截图接收服务时出错：\n{str(e)}"
         )
-        return False
\ No newline at end of file
+        return False
+
+
+def wait_image_server_ready(timeout=None):
+    """
+    等待后台接收服务输出就绪日志（端口监听成功），进程提前退出时立即返回
+    返回：True=已就绪，False=启动失败
+    """
+    process = config.image_server_process
+    if process is None:
+        return False
+    if timeout is None:
+        timeout = config.SERVER_READY_TIMEOUT
+    deadline = time.monotonic() + timeout
+    while not _server_ready.wait(0.02):
+        if process.poll() is not None or time.monotonic() >= deadline:
+            break
+    if _server_ready.is_set() and process.poll() is None:
+        print(f"[服务整合] 截图接收服务已在后台启动（端口：{config.SERVER_PORT}，目录：{config.MONITOR_DIR}）")
+        return True
+
+    # 启动失败：进程已退出则读取错误信息，超时未就绪则结束进程
+    if process.poll() is None:
+        process.terminate()
+        error = f"等待{timeout:g}秒仍未就绪"
+    else:
+        for thread in _drain_threads:
+            thread.join(1)  # 等输出读取线程取完最后的日志
+        error = "\n".join(format_entry(entry) for entry in receiver_logs.recent(10)) or "进程已退出"
+    QMessageBox.critical(
+        None, 
+        "启动失败", 
+        f"截图接收服务启动失败：\n{error}"
+    )
+    return False
+
+
+def start_image_server_in_background():
+    """
+    后台启动image_server.py（截图接收服务）并等待其就绪
+    返回：True=启动成功，False=启动失败
+    """
+    return launch_image_server() and wait_image_server_ready()
@@ -0,0 +1,256 @@
+# router_handler.py：模型路由（多模型/多接口、单路由超时、对冲请求、快速模型优先），不依赖PyQt
+"""
+每次模型调用按以下顺序进行：
+  1. 配置了快速模型（FAST_MODEL_ROUTE）时先请求快速模型，在其timeout内（流式模式下为首字时间）没有结果则放弃；
+  2. 请求主路由（MODEL_ROUTES第一项）。超过主路由近期耗时的P95仍未返回时，向下一个路由（只有一个路由时为
+     同一路由）再发一次对冲请求，先返回的请求胜出：落败的流式请求直接关闭连接，非流式请求无法中途取消，
+     在后台执行完毕后丢弃结果；
+     正在进行的请求全部失败时依次改用后面的路由。
+耗时样本：流式模式为首字时间，非流式模式为完整响应时间，每个路由单独统计最近 HEDGE_WINDOW 次。
+"""
+import time
+import queue
+import threading
+from collections import deque
+import config  # 导入全局变量（使用全局client）
+from trace_handler import tracer
+
+
+class LatencyWindow:
+    """最近若干次耗时的滑动窗口，线程安全，用于计算分位数"""
+
+    def __init__(self, size=200):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._values.append(seconds)
+
+    def percentile(self, p):
+        with self._lock:
+            values = sorted(self._values)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._values)
+
+
+class Route:
+    """一个模型路由：模型名 + 接口地址/API Key（省略时使用全局客户端的设置）+ 单次请求超时"""
+
+    def __init__(self, name, model, base_url=None, api_key=None, timeout=None):
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.latency = LatencyWindow(config.HEDGE_WINDOW)
+        self._client = None  # (全局客户端, 派生客户端)：全局客户端重新初始化后重新派生
+
+    @classmethod
+    def from_config(cls, item):
+        return cls(item.get("name") or item["model"], item["model"], item.get("base_url"),
+                   item.get("api_key"), item.get("timeout"))
+
+    def client(self):
+        """返回该路由使用的客户端：与全局客户端共享连接池，只替换接口地址和API Key"""
+        base = config.client
+        if not (self.base_url or self.api_key):
+            return base
+        if self._client is None or self._client[0] is not base:
+            options = {key: value for key, value in (("base_url", self.base_url), ("api_key", self.api_key)) if value}
+            self._client = (base, base.with_options(**options))
+        return self._client[1]
+
+    def create(self, messages, **kwargs):
+        if self.timeout:
+            kwargs["timeout"] = self.timeout
+        return self.client().chat.completions.create(model=self.model, messages=messages, **kwargs)
+
+
+class _Race:
+    """一次对冲调用中各请求共享的状态：结果队列、已打开的流式连接、是否已结束"""
+
+    def __init__(self):
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.done = False
+        self.streams = []
+
+    def track(self, stream):
+        """登记已打开的流式连接；调用已结束（其他请求胜出）时直接关闭"""
+        with self.lock:
+            if not self.done:
+                self.streams.append(stream)
+                return
+        stream.close()
+
+    def finish(self, winner_stream=None):
+        """结束调用：关闭胜出者以外的全部流式连接（阻塞在读取中的请求线程随之退出）"""
+        with self.lock:
+            self.done = True
+            losers = [stream for stream in self.streams if stream is not winner_stream]
+        for stream in losers:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+
+class ModelRouter:
+    def __init__(self, routes, fast_route=None):
+        self.routes = routes
+        self.fast_route = fast_route
+
+    @classmethod
+    def from_config(cls):
+        routes = [Route.from_config(item) for item in config.MODEL_ROUTES]
+        if not routes:
+            routes = [Route(config.MODEL_NAME, config.MODEL_NAME)]
+        fast = Route.from_config(config.FAST_MODEL_ROUTE) if config.FAST_MODEL_ROUTE else None
+        if fast is not None and not fast.timeout:
+            # 快速模型没有超时就无法及时改用主模型：未设置timeout时按初始对冲等待时间处理
+            fast.timeout = config.HEDGE_INITIAL_DELAY
+            print(f"[AI] 快速模型{fast.model}未设置timeout，使用{fast.timeout}秒")
+        return cls(routes, fast)
+
+    @property
+    def primary(self):
+        return self.routes[0]
+
+    def hedge_delay(self):
+        """对冲请求的发出时间：主路由近期耗时的P95（样本不足时使用初始值），限制在上下限之间"""
+        if not config.HEDGE_ENABLED:
+            return None
+        latency = self.primary.latency
+        if len(latency) < config.HEDGE_MIN_SAMPLES:
+            return config.HEDGE_INITIAL_DELAY
+        delay = latency.percentile(config.HEDGE_PERCENTILE)
+        return min(max(delay, config.HEDGE_MIN_DELAY), config.HEDGE_MAX_DELAY)
+
+    # -------------------------- 对外接口 --------------------------
+    def complete(self, messages):
+        """非流式调用，返回 (路由, completion)"""
+        route, (completion, _) = self._call(lambda route, race: (route.create(messages), None))
+        return route, completion
+
+    def open_stream(self, messages):
+        """
+        流式调用：首个带内容的数据块到达后才确定胜出的请求。
+        返回 (路由, 流对象, 已读取的数据块列表, 后续数据块迭代器)
+        """
+
+        def opener(route, race):
+            stream = route.create(messages, stream=True)
+            race.track(stream)
+            chunks = iter(stream)
+            first = []
+            for chunk in chunks:
+                first.append(chunk)
+                if chunk.choices and (getattr(chunk.choices[0].delta, "reasoning_content", None) or
+                                      chunk.choices[0].delta.content):
+                    break
+            return stream, (first, chunks)
+
+        route, (stream, (first, chunks)) = self._call(opener)
+        return route, stream, first, chunks
+
+    # -------------------------- 调度 --------------------------
+    def _call(self, opener):
+        """先试快速模型（如有），失败或超时后使用主路由（带对冲和故障切换）"""
+        if self.fast_route is not None:
+            try:
+                return self._race([self.fast_route], opener, None, deadline=self.fast_route.timeout)
+            except Exception as e:
+                tracer.count("model_fallback", route=self.fast_route.name)
+                print(f"[AI] 快速模型{self.fast_route.model}未能及时返回（{str(e) or type(e).__name__}），改用主模型")
+        sequence = list(self.routes)
+        if len(sequence) == 1 and config.HEDGE_ENABLED:
+            sequence.append(self.primary)  # 只有一个路由时对冲请求发往同一路由
+        return self._race(sequence, opener, self.hedge_delay(), failover=len(self.routes))
+
+    def _attempt(self, route, opener, race):
+        """
+        请求线程：记录耗时样本，调用已结束则丢弃结果。落败的请求同样记录，统计不会偏低：
+        非流式请求执行完后记录完整耗时；流式请求在读取中被关闭而出错，记录到被关闭时的耗时（实际耗时不低于该值）
+        """
+        start = time.perf_counter()
+        try:
+            value, error = opener(route, race), None
+            route.latency.add(time.perf_counter() - start)
+        except Exception as e:
+            value, error = None, e
+            with race.lock:
+                cancelled = race.done
+            if cancelled:
+                route.latency.add(time.perf_counter() - start)
+        with race.lock:
+            if not race.done:
+                race.results.put((route, value, error))
+                return
+        if error is None:
+            tracer.count("model_attempt", route=route.name, outcome="lost")
+            if value[0] is not None and hasattr(value[0], "close"):
+                value[0].close()
+
+    def _race(self, sequence, opener, hedge_delay, failover=None, deadline=None):
+        """
+        按顺序发出请求：最近一次发出请求后hedge_delay秒仍无结果时发出一个对冲请求；进行中的请求全部失败时
+        切换到下一个路由（只在前failover个路由之间切换）；deadline秒内没有结果则超时。
+        返回 (胜出的路由, opener的返回值)
+        """
+        failover = len(sequence) if failover is None else failover
+        race = _Race()
+        start = time.monotonic()
+        launched = pending = 0
+        last_launch = start
+        hedged = False
+        winner_stream = None
+
+        def launch():
+            nonlocal launched, pending, last_launch
+            last_launch = time.monotonic()  # 对冲等待从最近一次发出请求算起（故障切换后重新计时）
+            route = sequence[launched]
+            launched += 1
+            pending += 1
+            threading.Thread(target=self._attempt, args=(route, opener, race),
+                             name=f"model-{route.name}", daemon=True).start()
+
+        launch()
+        try:
+            while True:
+                waits = []
+                if not hedged and hedge_delay is not None and launched < len(sequence):
+                    waits.append(last_launch + hedge_delay - time.monotonic())
+                if deadline is not None:
+                    waits.append(start + deadline - time.monotonic())
+                try:
+                    route, value, error = race.results.get(timeout=max(0.0, min(waits)) if waits else None)
+                except queue.Empty:
+                    if deadline is not None and time.monotonic() - start >= deadline:
+                        raise TimeoutError(f"{deadline:g}秒内未返回")
+                    hedged = True
+                    tracer.count("model_hedge", route=sequence[launched].name)
+                    print(f"[AI] {hedge_delay:.1f}秒未返回，向{sequence[launched].name}发出对冲请求")
+                    launch()
+                    continue
+                pending -= 1
+                if error is None:
+                    tracer.count("model_attempt", route=route.name, outcome="won")
+                    winner_stream = value[0]
+                    return route, value
+                tracer.count("model_attempt", route=route.name, outcome="error")
+                if pending == 0:
+                    if launched >= min(failover, len(sequence)):
+                        raise error
+                    print(f"[AI] {route.name}调用失败（{str(error)}），改用{sequence[launched].name}")
+                    launch()
+        finally:
+            race.finish(winner_stream)
+
+
+model_router = ModelRouter.from_config()
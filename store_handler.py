@@ -0,0 +1,231 @@
+# store_handler.py：截图库（按内容哈希命名、分目录存放、SQLite索引、容量/时间上限淘汰、旧图重新压缩）
+"""
+截图保存目录按以下结构管理：
+  <根目录>/<哈希前2位>/<sha256前32位>.<扩展名>   新收到的截图（256个子目录，避免单个目录文件过多）
+  <根目录>/archive/<哈希前2位>/<...>.webp         重新压缩后的旧截图（目录监控忽略该目录）
+  <根目录>/.store-index.sqlite3                   索引：接收时间、大小、发送端、原文件名、哈希、分析状态
+同名不同内容的截图不再互相覆盖，内容完全相同的截图落到同一个文件。
+接收服务（可能有多个工作进程）写入索引，界面进程更新分析状态，SQLite WAL模式支持多进程同时访问。
+淘汰和重新压缩由 maintain() 定期执行（start_maintenance 启动后台线程）。
+只依赖标准库（重新压缩需要Pillow，未安装时跳过），image_server.py 独立运行时也可使用。
+"""
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+from typing import Optional
+
+INDEX_NAME = ".store-index.sqlite3"
+ARCHIVE_DIR = "archive"
+HASH_LENGTH = 32                          # 文件名使用的sha256十六进制位数
+RECOMPRESS_EXTENSIONS = (".png", ".bmp")  # 需要重新压缩的无损大图格式
+RECOMPRESS_BATCH = 50                     # 每轮维护最多重新压缩的文件数
+
+STATUS_RECEIVED = "received"
+STATUS_ANALYZED = "analyzed"
+STATUS_FAILED = "failed"
+
+
+def is_archived(path: str, root: str) -> bool:
+    """路径是否位于截图库的归档目录（目录监控据此忽略重新压缩产生的文件）"""
+    try:
+        rel = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    except ValueError:  # Windows下不在同一盘符
+        return False
+    return rel.split(os.sep, 1)[0] == ARCHIVE_DIR
+
+
+class ScreenshotStore:
+    """
+    截图库：path_for() 给出按内容哈希命名的保存路径，add() 写入索引，set_status() 记录分析结果；
+    maintain() 删除超过 max_age 的截图、按最近访问时间淘汰超出 max_bytes 的截图，
+    并把超过 recompress_age 的PNG/BMP重新压缩为无损WebP（0表示不启用对应功能）。
+    """
+
+    def __init__(self, root: str, max_bytes: int = 0, max_age: float = 0, recompress_age: float = 0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.recompress_age = recompress_age
+        self.db_path = os.path.join(root, INDEX_NAME)
+        self._local = threading.local()
+        # 预先建好全部分片目录：目录监控不会错过新建子目录后立即写入的文件
+        for i in range(256):
+            os.makedirs(os.path.join(root, f"{i:02x}"), exist_ok=True)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "hash TEXT PRIMARY KEY, path TEXT, name TEXT, sender TEXT, size INTEGER, "
+                "received_at REAL, last_access REAL, status TEXT, analyzed_at REAL, recompressed INTEGER DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_images_path ON images(path)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_images_last_access ON images(last_access)")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def _rel(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+
+    def path_for(self, digest: str, filename: str = "") -> str:
+        """内容哈希对应的保存路径，扩展名沿用客户端文件名（小写）"""
+        ext = os.path.splitext(filename)[1].lower()
+        if not (1 < len(ext) <= 6 and ext[1:].isalnum()):
+            ext = ""
+        digest = digest[:HASH_LENGTH]
+        return os.path.join(self.root, digest[:2], digest + ext)
+
+    def add(self, path: str, digest: str, name: str = "", sender: str = "", size: int = 0) -> None:
+        """记录一张已保存的截图（内容相同的截图只保留一条，更新接收时间和发送端）"""
+        now = time.time()
+        conn = self._conn()
+        old = conn.execute("SELECT path FROM images WHERE hash=?", (digest[:HASH_LENGTH],)).fetchone()
+        if old and old[0] != self._rel(path):
+            # 同样内容之前已归档为重新压缩的文件，以新收到的原文件为准
+            try:
+                os.remove(os.path.join(self.root, old[0]))
+            except OSError:
+                pass
+        conn.execute(
+            "INSERT INTO images (hash, path, name, sender, size, received_at, last_access, status) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(hash) DO UPDATE SET "
+            "path=excluded.path, name=excluded.name, sender=excluded.sender, size=excluded.size, "
+            "received_at=excluded.received_at, last_access=excluded.last_access, status=excluded.status, "
+            "recompressed=0",
+            (digest[:HASH_LENGTH], self._rel(path), name, sender, size, now, now, STATUS_RECEIVED)
+        )
+        conn.commit()
+
+    def set_status(self, path: str, status: str) -> bool:
+        """更新截图的分析状态（同时刷新最近访问时间），路径不在库中时返回False"""
+        now = time.time()
+        conn = self._conn()
+        cursor = conn.execute("UPDATE images SET status=?, analyzed_at=?, last_access=? WHERE path=?",
+                              (status, now, now, self._rel(path)))
+        conn.commit()
+        return cursor.rowcount > 0
+
+    def sender_of(self, path: str) -> Optional[str]:
+        """截图的发送端（路径不在库中时返回None）"""
+        row = self._conn().execute("SELECT sender FROM images WHERE path=?", (self._rel(path),)).fetchone()
+        return row[0] if row else None
+
+    def _remove(self, conn: sqlite3.Connection, rows) -> int:
+        """删除文件和索引记录，返回释放的字节数"""
+        freed = 0
+        for digest, rel_path, size in rows:
+            try:
+                os.remove(os.path.join(self.root, rel_path))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue  # 文件被占用（如正在分析），下轮再试
+            conn.execute("DELETE FROM images WHERE hash=?", (digest,))
+            freed += size or 0
+        conn.commit()
+        return freed
+
+    def evict(self):
+        """删除过期截图，再按最近访问时间淘汰超出容量上限的截图；返回 (删除文件数, 释放字节数)"""
+        conn = self._conn()
+        rows = []
+        if self.max_age:
+            rows += conn.execute("SELECT hash, path, size FROM images WHERE received_at < ?",
+                                 (time.time() - self.max_age,)).fetchall()
+        if self.max_bytes:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+            total -= sum(size or 0 for _, _, size in rows)
+            expired = {row[0] for row in rows}
+            if total > self.max_bytes:
+                for row in conn.execute("SELECT hash, path, size FROM images ORDER BY last_access"):
+                    if total <= self.max_bytes:
+                        break
+                    if row[0] not in expired:
+                        rows.append(row)
+                        total -= row[2] or 0
+        return len(rows), self._remove(conn, rows)
+
+    def recompress(self, limit: int = RECOMPRESS_BATCH) -> int:
+        """把超过 recompress_age 的PNG/BMP重新压缩为无损WebP并移入归档目录，返回处理的文件数"""
+        if not self.recompress_age:
+            return 0
+        try:
+            from PIL import Image
+        except ImportError:
+            return 0
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT hash, path, size FROM images WHERE recompressed=0 AND received_at < ? ORDER BY received_at LIMIT ?",
+            (time.time() - self.recompress_age, limit)
+        ).fetchall()
+        done = 0
+        for digest, rel_path, size in rows:
+            src = os.path.join(self.root, rel_path)
+            new_rel = rel_path
+            if rel_path.lower().endswith(RECOMPRESS_EXTENSIONS):
+                new_rel = self._recompress_file(Image, src, digest) or rel_path
+            if new_rel != rel_path:
+                new_size = os.path.getsize(os.path.join(self.root, new_rel))
+                conn.execute("UPDATE images SET path=?, size=?, recompressed=1 WHERE hash=?", (new_rel, new_size, digest))
+            else:
+                conn.execute("UPDATE images SET recompressed=1 WHERE hash=?", (digest,))
+            conn.commit()  # 逐个提交，不长时间占用写锁（接收服务同时在写索引）
+            done += 1
+        return done
+
+    def _recompress_file(self, image_module, src: str, digest: str) -> Optional[str]:
+        """压缩后更小才替换原文件，返回新的相对路径；失败或没有变小返回None"""
+        archive_dir = os.path.join(self.root, ARCHIVE_DIR, digest[:2])
+        os.makedirs(archive_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".recompress-", suffix=".part", dir=archive_dir)
+        try:
+            with os.fdopen(fd, "wb") as f, image_module.open(src) as img:
+                img.save(f, "WEBP", lossless=True, method=4)
+            if os.path.getsize(tmp_path) >= os.path.getsize(src):
+                return None
+            dest = os.path.join(archive_dir, digest + ".webp")
+            os.replace(tmp_path, dest)
+            os.remove(src)
+            return self._rel(dest)
+        except (OSError, ValueError):
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def maintain(self) -> dict:
+        """执行一轮淘汰和重新压缩"""
+        removed, freed = self.evict()
+        return {"removed": removed, "freed": freed, "recompressed": self.recompress()}
+
+    def start_maintenance(self, interval: float, on_result=None) -> threading.Thread:
+        """后台线程每隔 interval 秒执行一次 maintain()，结果交给 on_result(结果字典)"""
+
+        def loop():
+            while True:
+                try:
+                    result = self.maintain()
+                    if on_result:
+                        on_result(result)
+                except Exception as e:
+                    if on_result:
+                        on_result({"error": str(e)})
+                time.sleep(interval)
+
+        thread = threading.Thread(target=loop, name="store-maintenance", daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> dict:
+        """截图数量、总大小和各分析状态的数量"""
+        conn = self._conn()
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images").fetchone()
+        statuses = dict(conn.execute("SELECT status, COUNT(*) FROM images GROUP BY status").fetchall())
+        return {"files": count, "bytes": total, "statuses": statuses}
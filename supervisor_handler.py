@@ -0,0 +1,239 @@
+# supervisor_handler.py：多进程截图接收服务（监管进程 + 同端口工作进程）
+"""
+image_server.py --processes N 时由监管进程接管：
+  - 预先启动N个工作进程（image_server.py --worker-id i），各自以SO_REUSEPORT监听同一端口，
+    由内核在进程间分配新连接，解析和写盘分摊到多个CPU核；
+  - 读取各工作进程的JSON行日志：普通日志加上工作进程编号后转发，stats事件作为心跳和运行统计；
+  - 工作进程退出或心跳超时（卡死）时按指数退避重启；
+  - 工作进程状态有变化时输出一条 worker_stats 事件，界面据此显示各工作进程状态。
+工作进程的标准输入连接到监管进程，监管进程退出（包括被强制结束）时管道关闭，工作进程随之停止，不会残留。
+不支持SO_REUSEPORT的平台（如Windows）只启动1个工作进程，仍保留自动重启。只依赖标准库。
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import threading
+import subprocess
+from typing import Callable, List
+from log_handler import get_logger, parse_log_line
+
+log = get_logger()
+
+# -------------------------- 监管参数 --------------------------
+STATS_INTERVAL = 2.0        # 工作进程上报运行统计（兼作心跳）的间隔（秒）
+HEARTBEAT_TIMEOUT = 15.0    # 超过该时间没有心跳视为卡死，结束后重启
+CHECK_INTERVAL = 0.5        # 监管进程检查工作进程状态的间隔（秒）
+RESTART_BASE_DELAY = 0.5    # 重启退避基准时间（秒，连续失败时按2的指数增长）
+RESTART_MAX_DELAY = 30.0    # 单次重启最长等待（秒）
+STABLE_UPTIME = 60.0        # 工作进程连续运行超过该时间后，重启退避重新计算
+STOP_TIMEOUT = 5.0          # 停止时等待工作进程处理完在途连接的时间（秒），超时强制结束
+
+FORWARD_FIELDS = ("client", "file", "bytes")  # 转发工作进程日志时保留的附加字段
+
+
+def reuse_port_supported() -> bool:
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+# -------------------------- 工作进程端 --------------------------
+def attach_worker(server, interval: float = STATS_INTERVAL) -> None:
+    """工作进程：定期输出运行统计（心跳）；标准输入关闭（监管进程已退出）时停止服务"""
+
+    def report_stats():
+        server.ready.wait()
+        while server.is_running:
+            log.info("运行统计", extra={"event": "stats", "stats": server.stats()})
+            time.sleep(interval)
+
+    def watch_supervisor():
+        for _ in sys.stdin:
+            pass
+        server.ready.wait()  # 启动失败时主线程结束，进程直接退出
+        log.info("与监管进程的连接已关闭，停止服务", extra={"event": "detached"})
+        server.stop()
+
+    threading.Thread(target=report_stats, name="worker-stats", daemon=True).start()
+    threading.Thread(target=watch_supervisor, name="worker-watch", daemon=True).start()
+
+
+# -------------------------- 监管进程端 --------------------------
+class WorkerProcess:
+    """监管进程记录的单个工作进程状态"""
+
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.process = None
+        self.started_at = 0.0
+        self.started_ts = 0.0  # 启动时的系统时间（界面据此计算运行时长）
+        self.last_heartbeat = 0.0
+        self.ready = False
+        self.restarts = 0
+        self.failures = 0      # 连续异常退出次数（决定重启退避）
+        self.next_start = 0.0  # 已退出、等待重启的时间点
+        self.exit_code = None
+        self.stats = {}
+
+    def snapshot(self) -> dict:
+        alive = self.process is not None and self.process.poll() is None
+        return dict(self.stats, worker=self.worker_id, pid=self.process.pid if alive else None,
+                    alive=alive, ready=self.ready and alive, restarts=self.restarts,
+                    exit_code=self.exit_code, started=round(self.started_ts, 3))
+
+
+class ReceiverSupervisor:
+    """
+    启动并监管多个接收服务工作进程
+    build_cmd(worker_id) 返回启动第 worker_id 个工作进程的命令行（编号从1开始）
+    """
+
+    def __init__(self, build_cmd: Callable[[int], List[str]], processes: int, port: int):
+        if processes > 1 and not reuse_port_supported():
+            log.warning(f"当前平台不支持SO_REUSEPORT，只启动1个工作进程（配置为{processes}个）")
+            processes = 1
+        self.build_cmd = build_cmd
+        self.port = port
+        self.workers = [WorkerProcess(i) for i in range(1, max(1, processes) + 1)]
+        self.started = False  # 全部工作进程首次就绪后置位，此后的退出一律重启
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._last_report = None
+
+    def _spawn(self, worker: WorkerProcess) -> None:
+        process = subprocess.Popen(
+            self.build_cmd(worker.worker_id),
+            stdin=subprocess.PIPE,   # 监管进程退出时管道关闭，工作进程据此停止
+            stdout=subprocess.PIPE,  # JSON行日志；标准错误直接继承
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            env=dict(os.environ, PYTHONUNBUFFERED="1", PYTHONIOENCODING="utf-8"),
+        )
+        with self._lock:
+            worker.process = process
+            worker.started_at = worker.last_heartbeat = time.monotonic()
+            worker.started_ts = time.time()
+            worker.ready = False
+            worker.stats = {}
+        threading.Thread(target=self._read_output, args=(worker, process),
+                         name=f"worker-{worker.worker_id}-output", daemon=True).start()
+
+    def _read_output(self, worker: WorkerProcess, process: subprocess.Popen) -> None:
+        """转发工作进程日志；stats作为心跳记录，ready改记为worker_ready（整体就绪由监管进程判断）"""
+        for line in process.stdout:
+            if not line.strip():
+                continue
+            entry = parse_log_line(line)
+            event = entry.get("event")
+            if event == "stats":
+                with self._lock:
+                    worker.stats = entry.get("stats") or {}
+                    worker.last_heartbeat = time.monotonic()
+                continue
+            if event == "ready":
+                with self._lock:
+                    worker.ready = True
+                    worker.last_heartbeat = time.monotonic()
+                    all_ready = not self.started and all(w.ready for w in self.workers)
+                    if all_ready:
+                        self.started = True
+                event = "worker_ready"
+                if all_ready:
+                    # event=ready 供界面进程判断端口已监听成功
+                    log.info(f"启动成功！{len(self.workers)}个工作进程监听端口：{self.port}"
+                             f"{'（SO_REUSEPORT）' if len(self.workers) > 1 else ''}，按Ctrl+C停止",
+                             extra={"event": "ready"})
+            message = entry.get("msg", "")
+            if entry.get("exc"):
+                message += "\n" + entry["exc"]
+            extra = {field: entry[field] for field in FORWARD_FIELDS if field in entry}
+            extra.update(event=event, worker=worker.worker_id)
+            levelno = logging.getLevelName(entry.get("level", "INFO"))
+            log.log(levelno if isinstance(levelno, int) else logging.INFO, message, extra=extra)
+
+    def _check_worker(self, worker: WorkerProcess, now: float) -> bool:
+        """检查一个工作进程：等待重启的到点启动，卡死的结束，退出的安排重启；启动阶段失败返回False"""
+        process = worker.process
+        if process is None:
+            if now >= worker.next_start:
+                log.info(f"重启工作进程#{worker.worker_id}（第{worker.restarts + 1}次）",
+                         extra={"event": "worker_restart", "worker": worker.worker_id})
+                worker.restarts += 1
+                self._spawn(worker)
+            return True
+
+        code = process.poll()
+        if code is None:
+            if not (worker.ready and now - worker.last_heartbeat > HEARTBEAT_TIMEOUT):
+                return True
+            log.error(f"工作进程#{worker.worker_id}（pid {process.pid}）{HEARTBEAT_TIMEOUT:g}秒无心跳，强制结束",
+                      extra={"event": "worker_hung", "worker": worker.worker_id})
+            process.kill()
+            code = process.wait()
+
+        if not self.started:
+            log.critical(f"工作进程#{worker.worker_id}启动失败（退出码{code}）",
+                         extra={"event": "start_failed", "worker": worker.worker_id})
+            return False
+
+        worker.failures = 0 if now - worker.started_at >= STABLE_UPTIME else worker.failures + 1
+        delay = min(RESTART_MAX_DELAY, RESTART_BASE_DELAY * 2 ** (worker.failures - 1)) if worker.failures else 0
+        log.warning(f"工作进程#{worker.worker_id}（pid {process.pid}）已退出（退出码{code}），{delay:g}秒后重启",
+                    extra={"event": "worker_exited", "worker": worker.worker_id})
+        with self._lock:
+            worker.process = None
+            worker.ready = False
+            worker.exit_code = code
+            worker.next_start = now + delay
+        return True
+
+    def _report(self) -> None:
+        """工作进程状态有变化时输出worker_stats事件（空闲时不重复输出）"""
+        with self._lock:
+            workers = [worker.snapshot() for worker in self.workers]
+        if workers == self._last_report:
+            return
+        self._last_report = workers
+        alive = sum(1 for w in workers if w["ready"])
+        log.info(f"工作进程状态：{alive}/{len(workers)}个运行中",
+                 extra={"event": "worker_stats", "stats": {"workers": workers}})
+
+    def _stop_workers(self) -> None:
+        """关闭各工作进程的标准输入让其正常停止（处理完在途连接），超时后强制结束"""
+        processes = [w.process for w in self.workers if w.process is not None and w.process.poll() is None]
+        for process in processes:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in processes:
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def stop(self, *_args) -> None:
+        self._stopping.set()
+
+    def run(self) -> int:
+        """启动全部工作进程并持续监管，直到收到停止信号；返回进程退出码"""
+        signal.signal(signal.SIGTERM, self.stop)
+        for worker in self.workers:
+            self._spawn(worker)
+        try:
+            while not self._stopping.wait(CHECK_INTERVAL):
+                now = time.monotonic()
+                for worker in self.workers:
+                    if not self._check_worker(worker, now):
+                        return 1
+                self._report()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop_workers()
+            log.info("监管进程已停止", extra={"event": "stopped"})
+        return 0
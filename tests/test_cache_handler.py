@@ -0,0 +1,52 @@
+# test_cache_handler.py：近似截图去重缓存测试
+import io
+import os
+import sys
+
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cache_handler import PerceptualCache, fingerprint  # noqa: E402
+
+
+def render_screenshot(question, fmt="PNG"):
+    """渲染一张1920x1080的题目截图：相同的标题栏，只有题目文字不同"""
+    img = Image.new("RGB", (1920, 1080), "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, 1920, 80), fill=(40, 90, 160))
+    draw.text((40, 20), "Online Exam - Section A", fill="white", font=ImageFont.load_default(size=36))
+    draw.text((80, 200), question, fill="black", font=ImageFont.load_default(size=28))
+    buffer = io.BytesIO()
+    img.save(buffer, fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+def test_same_layout_different_text_misses():
+    cache = PerceptualCache()
+    first = fingerprint(render_screenshot("Question 1: What is 2+2?  A. 3  B. 4  C. 5"))
+    second = fingerprint(render_screenshot("Question 2: Capital of France?  A. Rome  B. Paris  C. Oslo"))
+    cache.store(*first, "q", "", "B. 4")
+    assert cache.lookup(*second, "q") is None
+
+
+def test_single_character_change_misses():
+    cache = PerceptualCache()
+    first = fingerprint(render_screenshot("Question 1: What is 2+2?"))
+    second = fingerprint(render_screenshot("Question 1: What is 2+3?"))
+    cache.store(*first, "q", "", "4")
+    assert cache.lookup(*second, "q") is None
+
+
+def test_identical_screenshot_hits():
+    cache = PerceptualCache()
+    data = render_screenshot("Question 1: What is 2+2?")
+    cache.store(*fingerprint(data), "q", "推理", "4")
+    assert cache.lookup(*fingerprint(data), "q") == ("推理", "4", 0)
+    assert cache.lookup(*fingerprint(data), "另一个问题") is None
+
+
+def test_reencoded_screenshot_hits():
+    cache = PerceptualCache()
+    question = "Question 1: What is 2+2?"
+    cache.store(*fingerprint(render_screenshot(question)), "q", "", "4")
+    assert cache.lookup(*fingerprint(render_screenshot(question, "JPEG")), "q") is not None
@@ -0,0 +1,171 @@
+# trace_handler.py：分阶段耗时追踪与指标导出（滚动JSONL追踪文件 + Prometheus文本格式接口）
+"""
+每张截图有一个追踪ID，各阶段耗时以 tracer.record(追踪ID, 阶段, 秒) 记录：
+  - 写入滚动JSONL追踪文件（每个进程一个文件：trace-receiver.jsonl / trace-gui.jsonl）
+  - 汇总到 metrics（阶段耗时直方图 + 事件计数），由 start_metrics_server 以Prometheus文本格式导出
+
+追踪ID的传递：
+  - 进程内接收模式：ImageServer在收到图片时生成ID，随回调元信息传给界面；
+  - 后台进程模式：两个进程都用 file_trace_id(文件路径) 从最终文件（路径+大小+修改时间）推导出相同的ID，
+    不需要额外的进程间通信。
+只依赖标准库，image_server.py 独立运行时也可使用。
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from logging.handlers import RotatingFileHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 阶段耗时直方图的分桶上限（秒）
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def file_trace_id(path: str, st: os.stat_result = None):
+    """由文件路径、大小和修改时间推导追踪ID（可传入已获取的stat结果；文件不存在时返回None）"""
+    if st is None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+    key = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+# -------------------------- 指标汇总 --------------------------
+class Metrics:
+    """线程安全的计数器和阶段耗时直方图，render() 输出Prometheus文本格式"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}    # (事件, 标签) -> 次数
+        self._histograms = {}  # 阶段 -> [各分桶计数..., 总次数, 总耗时]
+
+    def inc(self, event: str, value: float = 1, **labels) -> None:
+        key = (event, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            hist = self._histograms.get(stage)
+            if hist is None:
+                hist = self._histograms[stage] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += 1
+            hist[-1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters), {stage: list(hist) for stage, hist in self._histograms.items()}
+
+    def render(self, process: str = "") -> str:
+        counters, histograms = self.snapshot()
+        base = f'process="{process}"' if process else ""
+        lines = []
+        if counters:
+            lines.append("# HELP screenshot_events_total 截图处理各类事件的次数")
+            lines.append("# TYPE screenshot_events_total counter")
+            for (event, labels), value in sorted(counters.items()):
+                label_text = ",".join([base] * bool(base) + [f'event="{event}"'] +
+                                      [f'{k}="{v}"' for k, v in labels])
+                lines.append(f"screenshot_events_total{{{label_text}}} {value:g}")
+        if histograms:
+            lines.append("# HELP screenshot_stage_seconds 截图处理各阶段耗时（秒）")
+            lines.append("# TYPE screenshot_stage_seconds histogram")
+            for stage, hist in sorted(histograms.items()):
+                labels = ",".join([base] * bool(base) + [f'stage="{stage}"'])
+                for bound, count in zip(self.buckets, hist):
+                    lines.append(f'screenshot_stage_seconds_bucket{{{labels},le="{bound:g}"}} {count}')
+                lines.append(f'screenshot_stage_seconds_bucket{{{labels},le="+Inf"}} {hist[-2]}')
+                lines.append(f"screenshot_stage_seconds_count{{{labels}}} {hist[-2]}")
+                lines.append(f"screenshot_stage_seconds_sum{{{labels}}} {hist[-1]:.6f}")
+        return "\n".join(lines) + "\n"
+
+
+# -------------------------- 追踪记录 --------------------------
+class Tracer:
+    """记录阶段耗时：始终汇总到指标；调用 configure() 后同时写入滚动JSONL追踪文件"""
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.process = ""
+        self._logger = None
+
+    def configure(self, process: str, trace_dir: str = "", max_bytes: int = 10 * 1024 * 1024,
+                  backup_count: int = 3) -> None:
+        """设置进程名；trace_dir 非空时写入 trace_dir/trace-<进程名>.jsonl（超过max_bytes滚动）"""
+        self.process = process
+        if not trace_dir:
+            return
+        os.makedirs(trace_dir, exist_ok=True)
+        logger = logging.getLogger(f"screenshot.trace.{process}")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        handler = RotatingFileHandler(os.path.join(trace_dir, f"trace-{process}.jsonl"),
+                                      maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.handlers[:] = [handler]
+        self._logger = logger
+
+    def record(self, trace_id, stage: str, seconds: float, **attrs) -> None:
+        """记录一个阶段的耗时（秒）"""
+        if seconds is None:
+            return
+        self.metrics.observe(stage, seconds)
+        if self._logger is not None:
+            entry = {"ts": round(time.time(), 6), "trace_id": trace_id, "process": self.process,
+                     "stage": stage, "ms": round(seconds * 1000, 3)}
+            entry.update(attrs)
+            self._logger.info(json.dumps(entry, ensure_ascii=False))
+
+    def record_many(self, trace_id, latencies: dict, **attrs) -> None:
+        for stage, seconds in latencies.items():
+            self.record(trace_id, stage, seconds, **attrs)
+
+    def count(self, event: str, value: float = 1, **labels) -> None:
+        self.metrics.inc(event, value, **labels)
+
+
+metrics = Metrics()
+tracer = Tracer(metrics)
+
+
+# -------------------------- 指标接口 --------------------------
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = metrics.render(tracer.process).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1"):
+    """在后台线程启动 http://host:port/metrics，端口被占用等失败时打印提示并返回None"""
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        print(f"[指标] 指标接口启动失败（端口{port}）：{str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"[指标] 指标接口已启动：http://{host}:{port}/metrics")
+    return server
@@ -1,18 +1,23 @@
 # ui_components.py：UI组件（配置窗口、主窗口）
 import os
-import base64
+import time
 from datetime import datetime
 from PyQt5.QtWidgets import (QMainWindow, QPushButton, QLabel, QTextEdit, 
                              QVBoxLayout, QHBoxLayout, QWidget, QFileDialog, 
-                             QLineEdit, QDialog, QMessageBox, QApplication)
-from PyQt5.QtGui import QPixmap, QFont, QTextCursor
-from PyQt5.QtCore import Qt, QTimer
+                             QLineEdit, QDialog, QMessageBox, QApplication, QPlainTextEdit)
+from PyQt5.QtGui import QPixmap, QFont, QTextCursor, QTextFrameFormat
+from PyQt5.QtCore import Qt, QTimer, QEvent, pyqtSignal
 from config import (MARKDOWN_CSS, WAIT_SECONDS_AFTER_ANALYSIS,
                     DEFAULT_API_KEY, DEFAULT_SERVER_PORT, DEFAULT_MONITOR_DIR, DEFAULT_CLEAR_INTERVAL)
 import config  # 导入全局变量
-from ai_handler import format_markdown_with_code, ApiThread
-from monitor_handler import MonitorThread
+from ai_handler import format_markdown_with_code, render_markdown
+from monitor_handler import (MonitorThread, ReceiverThread, receiver_logs, record_analysis,
+                             set_thumbnail_size, submit_asset)
+from log_handler import format_entry, format_worker
+from job_handler import JobScheduler, AnalysisJob, JobState
+from trace_handler import tracer
 
+MESSAGE_START = 1  # 对话区中每条消息首个文本块的userState标记，超出上限时按整条消息删除最早的历史
 
 # -------------------------- 初始化配置窗口 --------------------------
 class InitConfigDialog(QDialog):
@@ -126,17 +131,88 @@ class InitConfigDialog(QDialog):
         self.accept()
 
 
+# -------------------------- 接收服务日志窗口 --------------------------
+class ReceiverLogDialog(QDialog):
+    """显示截图接收服务最近的日志和健康状况（非模态，打开期间每秒刷新）"""
+
+    def __init__(self, parent, status_func):
+        super().__init__(parent)
+        self.status_func = status_func  # 返回接收服务运行状态文字
+        self.last_ts = None
+        self.setWindowTitle("截图接收服务日志")
+        self.setGeometry(250, 250, 760, 460)
+
+        layout = QVBoxLayout()
+        self.health_label = QLabel()
+        self.health_label.setWordWrap(True)
+        self.log_view = QPlainTextEdit()
+        self.log_view.setReadOnly(True)
+        self.log_view.setMaximumBlockCount(config.RECEIVER_LOG_BUFFER)
+        self.log_view.setFont(QFont("Consolas", 9))
+        layout.addWidget(self.health_label)
+        layout.addWidget(self.log_view)
+        self.setLayout(layout)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(1000)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.refresh_timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.refresh_timer.stop()
+        super().hideEvent(event)
+
+    def refresh(self):
+        stats = receiver_logs.stats()
+        levels, events = stats["levels"], stats["events"]
+        last_active = datetime.fromtimestamp(stats["last_ts"]).strftime("%H:%M:%S") if stats["last_ts"] else "无"
+        health = (f"状态：{self.status_func()}　已接收：{events.get('saved', 0)}张　"
+                  f"警告：{levels.get('WARNING', 0)}　错误：{levels.get('ERROR', 0) + levels.get('CRITICAL', 0)}　"
+                  f"最后活动：{last_active}")
+        for worker in stats["workers"]:
+            health += f"\n工作进程{format_worker(worker)}"
+        if stats["last_error"]:
+            health += f"\n最近问题：{format_entry(stats['last_error'])}"
+        self.health_label.setText(health)
+        # 有新日志时才重新填充
+        if stats["last_ts"] != self.last_ts:
+            self.last_ts = stats["last_ts"]
+            self.log_view.setPlainText("\n".join(format_entry(entry) for entry in receiver_logs.recent()))
+            scroll_bar = self.log_view.verticalScrollBar()
+            scroll_bar.setValue(scroll_bar.maximum())
+
+
 # -------------------------- 主窗口 --------------------------
 class ImageChatMainWindow(QMainWindow):
+    image_loaded_signal = pyqtSignal(str, object)  # 手动选择的图片已在后台读取：(图片路径, 图片资源或None)
+
     def __init__(self):
         super().__init__()
-        self.base64_image = None
+        self.image_asset = None  # 当前显示的图片资源（手动发送时使用）
+        self.selected_image_path = ""
         self.monitor_thread = None
-        self.is_ai_busy = False
+        self.receiver_thread = None
+        self.log_dialog = None
         self.remaining_wait = 0
         self.wait_timer = QTimer()
-        self.pending_image = None
         self.clear_timer = QTimer()
+        # 对话区清屏代数：清屏或删除最早的历史时递增。文本框架被文档删除后sip未必能察觉（isdeleted不可靠），
+        # 任务记录创建框架时的代数，代数不一致即视为框架已不存在，不再访问
+        self.history_generation = 0
+        # 分析任务调度：有界队列 + 多个AI线程并发
+        self.scheduler = JobScheduler(config.MAX_CONCURRENT_JOBS, config.JOB_QUEUE_SIZE)
+        self.scheduler.job_started.connect(self.on_job_started)
+        self.scheduler.job_reasoning_delta.connect(self.show_reasoning_delta)
+        self.scheduler.job_answer_html.connect(self.show_answer_html)
+        self.scheduler.job_finished.connect(self.show_ai_result)
+        self.scheduler.job_dropped.connect(self.on_job_dropped)
+        self.scheduler.queue_changed.connect(self.update_queue_status)
+        self.scheduler.idle.connect(self.start_cooldown)
+        self.image_loaded_signal.connect(self.on_image_loaded)
         self.init_ui()
         self.start_monitoring()
         self.init_timers()
@@ -158,6 +234,7 @@ class ImageChatMainWindow(QMainWindow):
         self.image_label.setAlignment(Qt.AlignCenter)
         self.image_label.setMinimumHeight(220)
         self.image_label.setStyleSheet("border: 1px solid #ccc; border-radius: 4px;")
+        self.image_label.installEventFilter(self)  # 尺寸变化时更新缩略图尺寸（缩略图在后台线程按此尺寸生成）
         image_layout.addWidget(self.select_btn)
         image_layout.addWidget(self.image_label, stretch=1)
         main_layout.addLayout(image_layout)
@@ -167,6 +244,11 @@ class ImageChatMainWindow(QMainWindow):
         self.history_area.setReadOnly(True)
         self.history_area.setAcceptRichText(True)
         self.history_area.setPlaceholderText("对话历史将显示在这里...")
+        # 默认样式表，使增量插入的HTML片段也能应用样式
+        self.history_area.document().setDefaultStyleSheet(MARKDOWN_CSS.replace("<style>", "").replace("</style>", ""))
+        # 关闭只读区域无用的撤销记录；文档大小由 trim_history 控制（文档含文本框架和表格时，
+        # Qt的setMaximumBlockCount行为未定义，可能删掉正在流式输出的框架）
+        self.history_area.setUndoRedoEnabled(False)
         global_font = QFont("SimHei", 10)
         self.history_area.setFont(global_font)
         main_layout.addWidget(self.history_area)
@@ -200,10 +282,25 @@ class ImageChatMainWindow(QMainWindow):
         central_widget.setLayout(main_layout)
         self.setCentralWidget(central_widget)
 
+        # 4. 状态栏：接收服务状态、冷却倒计时、任务队列（每秒刷新，不改动对话历史）
+        self.server_label = QLabel()
+        self.cooldown_label = QLabel()
+        self.queue_label = QLabel()
+        self.statusBar().addPermanentWidget(self.server_label)
+        self.statusBar().addPermanentWidget(self.cooldown_label)
+        self.statusBar().addPermanentWidget(self.queue_label)
+        self.log_btn = QPushButton("接收日志")
+        self.log_btn.setFlat(True)
+        self.log_btn.clicked.connect(self.show_receiver_logs)
+        self.statusBar().addPermanentWidget(self.log_btn)
+        self.update_queue_status(0, 0)
+
     def init_timers(self):
         # 等待定时器（分析后冷却）
         self.wait_timer.setInterval(1000)
         self.wait_timer.timeout.connect(self.update_wait_time)
+        self.wait_timer.start()
+        self.update_status_bar()
         # 清屏定时器
         self.clear_timer.setInterval(config.CLEAR_INTERVAL * 1000)
         self.clear_timer.timeout.connect(self.auto_clear_history)
@@ -211,22 +308,35 @@ class ImageChatMainWindow(QMainWindow):
 
     def show_current_config(self):
         # 显示全局配置和服务状态
-        server_status = "✅ 运行中" if (config.image_server_process and config.image_server_process.poll() is None) else "❌ 已停止"
+        server_status = self.server_status_text()
         config_text = f"""
 <div class='config-info'>📋 当前服务端配置：</div>
 - 服务端端口：{config.SERVER_PORT}（客户端需填写相同端口）
 - 截图监控目录：{os.path.abspath(config.MONITOR_DIR)}
 - 自动清屏间隔：{config.CLEAR_INTERVAL // 60}分钟（{config.CLEAR_INTERVAL}秒）
-- API Key：已配置（显示前10位：{config.client.api_key[:10]}...）
+- API Key：已配置（显示前10位：{config.api_key[:10]}...）
 <div class='server-status'>🔌 截图接收服务状态：{server_status}</div>
 """
         self.append_markdown(config_text)
         self.append_markdown(f"<div class='clear-tip'>🗑️ 自动清屏已开启，每{config.CLEAR_INTERVAL//60}分钟清屏一次</div>\n")
 
+    def server_status_text(self):
+        # 截图接收服务状态（进程内模式看接收线程，后台模式看子进程）
+        if self.receiver_thread is not None:
+            running = self.receiver_thread.is_serving()
+        else:
+            running = config.image_server_process is not None and config.image_server_process.poll() is None
+            workers = receiver_logs.stats()["workers"] if running else []
+            if workers:
+                ready = sum(1 for worker in workers if worker.get("ready"))
+                icon = "✅" if ready == len(workers) else "⚠️"
+                return f"{icon} 运行中（{ready}/{len(workers)}个工作进程）"
+        return "✅ 运行中" if running else "❌ 已停止"
+
     def auto_clear_history(self):
         # 自动清屏（保留配置信息）
         clear_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        server_status = "✅ 运行中" if (config.image_server_process and config.image_server_process.poll() is None) else "❌ 已停止"
+        server_status = self.server_status_text()
         base_info = f"""
 <div class='clear-tip'>📅 历史记录已清屏（清屏时间：{clear_time}）</div>
 <div class='config-info'>📋 当前配置：端口{config.SERVER_PORT} | 监控目录{os.path.abspath(config.MONITOR_DIR)} | 清屏{config.CLEAR_INTERVAL//60}分钟</div>
@@ -234,14 +344,12 @@ class ImageChatMainWindow(QMainWindow):
 <div class='auto-monitor'>🔍 目录监控正常，等待新截图...</div>
 <div class='clear-tip'>🗑️ 下次自动清屏：{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</div>
 """
-        full_html = f"<html><head>{MARKDOWN_CSS}</head><body>{format_markdown_with_code(base_info)}</body></html>"
-        self.history_area.setHtml(full_html)
-        self.scroll_to_bottom()
+        self.clear_history(base_info)
 
     def manual_clear_history(self):
         # 手动清屏
         clear_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        server_status = "✅ 运行中" if (config.image_server_process and config.image_server_process.poll() is None) else "❌ 已停止"
+        server_status = self.server_status_text()
         base_info = f"""
 <div class='clear-tip'>📅 手动清屏完成（清屏时间：{clear_time}）</div>
 <div class='config-info'>📋 当前配置：端口{config.SERVER_PORT} | 监控目录{os.path.abspath(config.MONITOR_DIR)} | 清屏{config.CLEAR_INTERVAL//60}分钟</div>
@@ -249,107 +357,209 @@ class ImageChatMainWindow(QMainWindow):
 <div class='auto-monitor'>🔍 目录监控正常，等待新截图...</div>
 <div class='clear-tip'>🗑️ 下次自动清屏：{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</div>
 """
-        full_html = f"<html><head>{MARKDOWN_CSS}</head><body>{format_markdown_with_code(base_info)}</body></html>"
-        self.history_area.setHtml(full_html)
-        self.scroll_to_bottom()
+        self.clear_history(base_info)
+
+    def clear_history(self, base_info):
+        # 清空对话区（流式输出中的文本框架随之删除，递增代数使其失效）并显示基本信息
+        self.history_generation += 1
+        self.history_area.clear()
+        self.append_markdown(base_info)
 
     def scroll_to_bottom(self):
         # 滚动到对话底部
-        cursor = self.history_area.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        self.history_area.setTextCursor(cursor)
-        self.history_area.ensureCursorVisible()
+        scroll_bar = self.history_area.verticalScrollBar()
+        scroll_bar.setValue(scroll_bar.maximum())
 
     def start_monitoring(self):
-        # 启动目录监控线程（调用monitor_handler模块）
-        self.monitor_thread = MonitorThread()
-        self.monitor_thread.new_image_signal.connect(self.handle_new_image)
-        self.monitor_thread.start()
-        self.append_markdown(f"<div class='auto-monitor'>🔍 已启动监控：{os.path.abspath(config.MONITOR_DIR)}</div>")
+        if config.RECEIVER_MODE == "inprocess":
+            # 进程内接收：图片数据直接交给分析流程，无需目录监控
+            self.receiver_thread = ReceiverThread()
+            self.receiver_thread.new_image_data_signal.connect(self.handle_new_image)
+            self.receiver_thread.start()
+            if self.receiver_thread.wait_ready():
+                self.append_markdown(f"<div class='auto-monitor'>🔍 已在进程内启动截图接收（端口：{config.SERVER_PORT}）</div>")
+            else:
+                self.append_markdown(f"<div class='status'>⚠️ 截图接收服务启动失败（端口：{config.SERVER_PORT}），请检查端口是否被占用</div>")
+        else:
+            # 启动目录监控线程（调用monitor_handler模块）
+            self.monitor_thread = MonitorThread()
+            self.monitor_thread.new_image_signal.connect(self.handle_new_image)
+            self.monitor_thread.start()
+            self.append_markdown(f"<div class='auto-monitor'>🔍 已启动监控：{os.path.abspath(config.MONITOR_DIR)}</div>")
         self.append_markdown(f"<div class='auto-monitor'>📌 上轮分析完成后，将等待{WAIT_SECONDS_AFTER_ANALYSIS}秒再处理新截图</div>\n")
 
-    def handle_new_image(self, image_path):
-        # 处理新截图（自动分析）
-        if self.is_ai_busy:
-            self.pending_image = image_path
-            self.append_markdown(f"<div class='auto-monitor'>📥 发现新截图（{os.path.basename(image_path)}），等待上轮分析完成...</div>")
-        elif self.remaining_wait > 0:
-            self.pending_image = image_path
-            self.append_markdown(f"<div class='auto-monitor'>📥 发现新截图（{os.path.basename(image_path)}），等待{self.remaining_wait}秒后处理...</div>")
+    def handle_new_image(self, image_path, trace_id, asset, sender=None):
+        # 处理新截图（自动分析）：图片已在后台读取并生成缩略图，直接加入任务队列；进程内模式会带上发送端
+        question = self.question_edit.toPlainText().strip() or "请分析这张截图的内容。"
+        job = self.scheduler.submit(AnalysisJob(image_path, asset, question, auto=True, trace_id=trace_id,
+                                                 sender=sender))
+        if job.state == JobState.QUEUED:
+            if self.scheduler.paused:
+                tip = f"等待{self.remaining_wait}秒后处理"
+            else:
+                tip = f"已加入队列，前面还有{len(self.scheduler.queue) - 1}张"
+            self.append_markdown(f"<div class='auto-monitor'>📥 发现新截图（{os.path.basename(image_path)}），{tip}...</div>")
+
+    def on_job_started(self, job):
+        # 任务开始分析：显示截图和提问
+        self.skip_wait_btn.setEnabled(False)
+        if job.auto:
+            self.append_markdown(f"<div class='auto-monitor'>📥 开始处理新截图：{os.path.basename(job.image_path)}</div>")
+            self.image_asset = job.asset
+            self.show_thumbnail(job.asset)
+            self.append_markdown(f"<div class='user-tag'>👤 自动提问：</div>{job.question}\n")
+            self.append_markdown("<div class='status'>🤖 AI：正在分析新截图...</div>\n")
+        else:
+            self.append_markdown(f"<div class='user-tag'>👤 你：</div>{job.question}\n")
+            self.append_markdown("<div class='status'>🤖 AI：正在分析...</div>\n")
+
+    def on_job_dropped(self, job):
+        self.append_markdown(f"<div class='status'>⚠️ 等待队列已满，已丢弃最早的截图：{os.path.basename(job.image_path)}</div>")
+
+    def update_queue_status(self, queued, running):
+        self.queue_label.setText(f"任务队列：排队 {queued} | 分析中 {running}/{self.scheduler.max_concurrent}")
+
+    def job_title(self, job):
+        # 多任务并发时在标题中标明对应的截图
+        if self.scheduler.max_concurrent > 1 and job.image_path:
+            return f"（{os.path.basename(job.image_path)}）"
+        return ""
+
+    def frame_alive(self, job):
+        # 任务的文本框架是否仍在对话区中（创建后未清屏）
+        return job.stream_frame is not None and job.stream_generation == self.history_generation
+
+    def stream_cursor(self, job, section, tag_html):
+        # 获取任务流式区块末尾的光标；切换区块（推理→回答）或框架已随清屏删除时先写标题并新建文本框架
+        if job.stream_section != section or not self.frame_alive(job):
+            cursor = self.message_cursor()  # 标题另起一行
+            cursor.insertHtml(tag_html)
+            job.stream_frame = cursor.insertFrame(QTextFrameFormat())
+            if section == "answer":
+                # 回答区块后紧跟一个框架，存放末尾未完成块的渲染结果
+                cursor = QTextCursor(self.history_area.document())
+                cursor.movePosition(QTextCursor.End)
+                job.tail_frame = cursor.insertFrame(QTextFrameFormat())
+            job.stream_section = section
+            job.stream_generation = self.history_generation
+            self.trim_history()
+        return job.stream_frame.lastCursorPosition()
+
+    def replace_frame(self, job, frame, html):
+        # 替换任务文本框架中的全部内容（框架已随清屏删除时跳过）
+        if frame is None or not self.frame_alive(job):
+            return
+        cursor = QTextCursor(self.history_area.document())
+        cursor.setPosition(frame.firstPosition())
+        cursor.setPosition(frame.lastPosition(), QTextCursor.KeepAnchor)
+        if html:
+            cursor.insertHtml(html)
         else:
-            self.auto_send_new_image(image_path)
+            cursor.removeSelectedText()
 
-    def auto_send_new_image(self, image_path):
-        # 自动发送截图到AI分析
-        self.is_ai_busy = True
-        self.skip_wait_btn.setEnabled(False)
-        self.append_markdown(f"<div class='auto-monitor'>📥 开始处理新截图：{os.path.basename(image_path)}</div>")
-        
-        # 图片转Base64
-        self.base64_image = self.image_to_base64(image_path)
-        pixmap = QPixmap(image_path)
-        scaled_pixmap = pixmap.scaled(
-            self.image_label.width(), self.image_label.height(),
-            Qt.KeepAspectRatio, Qt.SmoothTransformation
-        )
-        self.image_label.setPixmap(scaled_pixmap)
-        
-        # 调用AI分析（调用ai_handler模块）
-        question = self.question_edit.toPlainText().strip() or "请分析这张截图的内容。"
-        self.append_markdown(f"<div class='user-tag'>👤 自动提问：</div>{question}\n")
-        self.append_markdown(f"<div class='status'>🤖 AI：正在分析新截图...</div>\n")
-        
-        self.ai_thread = ApiThread(self.base64_image, question)
-        self.ai_thread.result_signal.connect(self.show_ai_result)
-        self.ai_thread.start()
+    def show_reasoning_delta(self, job, text):
+        # 流式显示推理过程增量
+        self.stream_cursor(job, "reasoning", f"<div class='reasoning-tag'>📝 AI推理{self.job_title(job)}：</div>").insertText(text)
+        self.scroll_to_bottom()
+
+    def show_answer_html(self, job, committed_html, tail_html):
+        # 流式显示回答：已完成的块追加到回答框架，只替换末尾未完成块（HTML已在AI线程渲染好）
+        cursor = self.stream_cursor(job, "answer", f"<div class='ai-tag'>💡 AI回答{self.job_title(job)}：</div>")
+        if committed_html:
+            cursor.insertHtml(committed_html)
+        self.replace_frame(job, job.tail_frame, tail_html)
+        self.scroll_to_bottom()
 
-    def show_ai_result(self, reasoning, answer):
+    def finish_stream(self, job, reasoning, answer):
+        # 流式输出结束：回答区块替换为完整渲染的内容（已在AI线程渲染并缓存），出错时追加错误信息
+        if answer and job.stream_section == "answer":
+            answer_html = render_markdown(answer)
+            if not self.frame_alive(job):
+                # 输出期间对话区被清屏，重新完整追加回答
+                self.append_html(f"<div class='ai-tag'>💡 AI回答{self.job_title(job)}：</div>{answer_html}")
+            else:
+                self.replace_frame(job, job.stream_frame, answer_html)
+                self.replace_frame(job, job.tail_frame, "")
+        elif not answer:
+            self.append_markdown(f"<div class='status'>⚠️ {reasoning}</div>\n")
+        job.stream_section = None
+        job.stream_frame = None
+        job.tail_frame = None
+        job.stream_generation = None
+
+    def show_ai_result(self, job, reasoning, answer):
         # 显示AI分析结果
-        self.is_ai_busy = False
-        self.append_markdown(f"<div class='reasoning-tag'>📝 AI推理：</div>{reasoning}\n")
-        formatted_answer = format_markdown_with_code(answer)
-        self.append_markdown(f"<div class='ai-tag'>💡 AI回答：</div>{formatted_answer}\n")
-        
-        # 启动冷却等待
+        render_start = time.perf_counter()
+        if job.stream_section is not None:
+            self.finish_stream(job, reasoning, answer)
+        else:
+            self.append_markdown(f"<div class='reasoning-tag'>📝 AI推理{self.job_title(job)}：</div>{reasoning}\n")
+            self.append_html(f"<div class='ai-tag'>💡 AI回答{self.job_title(job)}：</div>{render_markdown(answer)}")
+        now = time.perf_counter()
+        tracer.record(job.trace_id, "ui_render", now - render_start)
+        tracer.record(job.trace_id, "end_to_end", now - job.created_at)
+        tracer.count("job_done" if answer else "job_failed")
+        record_analysis(job.image_path, bool(answer))
+
+    def start_cooldown(self):
+        # 所有任务完成后启动冷却等待：期间新截图只排队不分析
+        if WAIT_SECONDS_AFTER_ANALYSIS <= 0:
+            return
+        self.scheduler.pause()
         self.remaining_wait = WAIT_SECONDS_AFTER_ANALYSIS
-        self.append_markdown(f"<div class='wait-tip'>⌛ 上轮分析完成，{self.remaining_wait}秒后可处理新截图（可点击「跳过等待」立即处理）</div>\n")
-        self.wait_timer.start()
+        self.append_markdown(f"<div class='wait-tip'>⌛ 上轮分析完成，{self.remaining_wait}秒后可处理新截图（倒计时见底部状态栏，可点击「跳过等待」立即处理）</div>\n")
         self.skip_wait_btn.setEnabled(True)
+        self.update_status_bar()
         
         # 处理等待中的截图
-        if self.pending_image:
-            self.append_markdown(f"<div class='auto-monitor'>⏳ 等待期间有暂存截图，将在{self.remaining_wait}秒后自动处理</div>")
+        if self.scheduler.queue:
+            self.append_markdown(f"<div class='auto-monitor'>⏳ 等待期间有{len(self.scheduler.queue)}张暂存截图，将在{self.remaining_wait}秒后自动处理</div>")
+
+    def update_status_bar(self):
+        # 刷新状态栏（只更新标签文字，开销与对话历史长度无关）
+        server_text = f"接收服务：{self.server_status_text()}"
+        stats = receiver_logs.stats()
+        problems = sum(stats["levels"].get(level, 0) for level in ("WARNING", "ERROR", "CRITICAL"))
+        if problems:
+            server_text += f"（⚠️ {problems}）"
+            self.server_label.setToolTip(f"最近问题：{format_entry(stats['last_error'])}")
+        self.server_label.setText(server_text)
+        if self.remaining_wait > 0:
+            self.cooldown_label.setText(f"⌛ 冷却中：{self.remaining_wait}秒")
+        else:
+            self.cooldown_label.setText("冷却：无")
 
     def update_wait_time(self):
-        # 更新冷却倒计时
+        # 每秒触发：更新冷却倒计时和状态栏
+        if self.remaining_wait <= 0:
+            self.update_status_bar()
+            return
         self.remaining_wait -= 1
-        current_html = self.history_area.toHtml()
-        wait_pattern = r"<div class='wait-tip'>⌛ 上轮分析完成，\d+秒后可处理新截图（可点击「跳过等待」立即处理）</div>"
-        new_wait_tip = f"<div class='wait-tip'>⌛ 上轮分析完成，{self.remaining_wait}秒后可处理新截图（可点击「跳过等待」立即处理）</div>"
-        import re
-        current_html = re.sub(wait_pattern, new_wait_tip, current_html)
-        self.history_area.setHtml(current_html)
-        self.scroll_to_bottom()
+        self.update_status_bar()
         
         if self.remaining_wait <= 0:
-            self.wait_timer.stop()
             self.skip_wait_btn.setEnabled(False)
             self.append_markdown(f"<div class='wait-tip'>✅ 等待结束，可正常处理新截图</div>\n")
-            if self.pending_image:
-                self.append_markdown(f"<div class='auto-monitor'>📤 开始处理等待中的截图：{os.path.basename(self.pending_image)}</div>")
-                self.auto_send_new_image(self.pending_image)
-                self.pending_image = None
+            if self.scheduler.queue:
+                self.append_markdown(f"<div class='auto-monitor'>📤 开始处理等待中的{len(self.scheduler.queue)}张截图</div>")
+            self.scheduler.resume()
 
     def skip_wait(self):
         # 跳过冷却等待
-        self.wait_timer.stop()
         self.remaining_wait = 0
         self.skip_wait_btn.setEnabled(False)
+        self.update_status_bar()
         self.append_markdown(f"<div class='wait-tip'>🚀 已跳过等待，可立即处理新截图</div>")
-        if self.pending_image:
-            self.append_markdown(f"<div class='auto-monitor'>📤 立即处理等待中的截图：{os.path.basename(self.pending_image)}</div>")
-            self.auto_send_new_image(self.pending_image)
-            self.pending_image = None
+        if self.scheduler.queue:
+            self.append_markdown(f"<div class='auto-monitor'>📤 立即处理等待中的{len(self.scheduler.queue)}张截图</div>")
+        self.scheduler.resume()
+
+    def show_receiver_logs(self):
+        # 打开接收服务日志窗口
+        if self.log_dialog is None:
+            self.log_dialog = ReceiverLogDialog(self, self.server_status_text)
+        self.log_dialog.show()
+        self.log_dialog.raise_()
 
     def select_image(self):
         # 手动选择本地图片
@@ -357,60 +567,101 @@ class ImageChatMainWindow(QMainWindow):
             self, "选择图片", "", "图片文件 (*.png *.jpg *.jpeg *.bmp)"
         )
         if file_path:
-            self.base64_image = self.image_to_base64(file_path)
-            pixmap = QPixmap(file_path)
-            scaled_pixmap = pixmap.scaled(
-                self.image_label.width(), self.image_label.height(),
-                Qt.KeepAspectRatio, Qt.SmoothTransformation
-            )
-            self.image_label.setPixmap(scaled_pixmap)
-            self.append_markdown(f"<div class='image-selected'>✅ 已选择图片：{os.path.basename(file_path)}</div>\n")
-            self.send_btn.setEnabled(True)
-
-    def image_to_base64(self, image_path):
-        # 图片转Base64（工具函数）
-        with open(image_path, "rb") as f:
-            return base64.b64encode(f.read()).decode("utf-8")
+            # 读取和生成缩略图在图片资源线程完成，结果通过信号回到界面线程
+            submit_asset(lambda asset: self.image_loaded_signal.emit(file_path, asset), path=file_path)
 
-    def send_question(self):
-        # 手动发送AI请求
-        if self.is_ai_busy:
-            self.append_markdown(f"<div class='status'>⚠️ AI正在分析其他截图，请稍后再手动发送</div>\n")
+    def on_image_loaded(self, file_path, asset):
+        if asset is None:
+            self.append_markdown(f"<div class='status'>⚠️ 无法读取图片：{os.path.basename(file_path)}</div>\n")
+            return
+        self.image_asset = asset
+        self.selected_image_path = file_path
+        self.show_thumbnail(asset)
+        self.append_markdown(f"<div class='image-selected'>✅ 已选择图片：{os.path.basename(file_path)}</div>\n")
+        self.send_btn.setEnabled(True)
+
+    def show_thumbnail(self, asset):
+        # 显示后台生成的缩略图；只有缩略图生成后窗口又变小时才在界面线程缩放
+        if asset.thumbnail is None:
+            self.image_label.setText("无法预览图片")
             return
+        pixmap = QPixmap.fromImage(asset.thumbnail)
+        if pixmap.width() > self.image_label.width() or pixmap.height() > self.image_label.height():
+            pixmap = pixmap.scaled(self.image_label.width(), self.image_label.height(),
+                                   Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        self.image_label.setPixmap(pixmap)
+
+    def eventFilter(self, obj, event):
+        if obj is self.image_label and event.type() == QEvent.Resize:
+            set_thumbnail_size(event.size().width(), event.size().height())
+        return super().eventFilter(obj, event)
+
+    def send_question(self):
+        # 手动发送AI请求（加入任务队列，AI忙碌时排队等待）
         question = self.question_edit.toPlainText().strip()
-        if not question or not self.base64_image:
+        if not question or not self.image_asset:
             return
-        self.is_ai_busy = True
-        self.append_markdown(f"<div class='user-tag'>👤 你：</div>{question}\n")
-        self.append_markdown(f"<div class='status'>🤖 AI：正在分析...</div>\n")
-        
-        self.ai_thread = ApiThread(self.base64_image, question)
-        self.ai_thread.result_signal.connect(self.show_ai_result)
-        self.ai_thread.start()
+        job = self.scheduler.submit(AnalysisJob(self.selected_image_path, self.image_asset, question, auto=False))
+        if job.state == JobState.QUEUED:
+            self.append_markdown("<div class='status'>⏳ AI正在分析其他截图，手动请求已加入队列</div>\n")
 
     def append_markdown(self, md_text):
-        # 渲染Markdown并添加到对话区（调用ai_handler模块）
-        processed_md = format_markdown_with_code(md_text)
-        html = format_markdown_with_code(processed_md)  # 复用Markdown处理函数
-        current_html = self.history_area.toHtml()
-        
-        if "body></html>" in current_html:
-            new_html = current_html.replace("</body></html>", f"{html}</body></html>")
-        else:
-            new_html = f"<html><head>{MARKDOWN_CSS}</head><body>{html}</body></html>"
-        
-        self.history_area.setHtml(new_html)
+        # 渲染Markdown并添加到对话区（调用ai_handler模块，每条消息只渲染一次）
+        self.append_html(format_markdown_with_code(md_text))
+
+    def append_html(self, html):
+        # 在文档末尾插入，不重建整个文档（耗时与历史长度无关，流式输出中的文本框架得以保留）
+        self.message_cursor().insertHtml(html)
+        self.trim_history()
         self.scroll_to_bottom()
 
+    def message_cursor(self):
+        # 文档末尾新消息的光标：另起一块，并把该块标记为消息开头
+        cursor = QTextCursor(self.history_area.document())
+        cursor.movePosition(QTextCursor.End)
+        if cursor.block().length() > 1:
+            cursor.insertBlock()
+        cursor.block().setUserState(MESSAGE_START)
+        return cursor
+
+    def trim_history(self):
+        # 文本块数超过 HISTORY_MAX_BLOCKS 时从开头删除最早的整条消息，不删除正在流式输出的消息
+        document = self.history_area.document()
+        excess = document.blockCount() - config.HISTORY_MAX_BLOCKS
+        if excess <= 0:
+            return
+        streaming = [job for job in self.scheduler.running if self.frame_alive(job)]
+        limit = min((job.stream_frame.firstPosition() for job in streaming), default=document.characterCount())
+        cut = 0
+        block = document.begin()
+        while block.isValid() and block.position() < limit:
+            if block.userState() == MESSAGE_START and block.position() > 0:
+                cut = block.position()
+                if block.blockNumber() >= excess:
+                    break
+            block = block.next()
+        if cut == 0:
+            return
+        cursor = QTextCursor(document)
+        cursor.setPosition(cut, QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+        # 删除范围内的文本框架已不存在：递增代数，仍在文档中的流式框架记为当前代数
+        self.history_generation += 1
+        for job in streaming:
+            job.stream_generation = self.history_generation
+
     def closeEvent(self, event):
         # 关闭窗口时清理资源
         if self.monitor_thread and self.monitor_thread.isRunning():
             self.monitor_thread.requestInterruption()
             self.monitor_thread.wait()
+        if self.receiver_thread and self.receiver_thread.isRunning():
+            self.receiver_thread.stop()
         # 终止后台截图接收服务
         if config.image_server_process and config.image_server_process.poll() is None:
             config.image_server_process.terminate()
             print("[服务整合] 已停止后台截图接收服务")
         self.wait_timer.stop()
         self.clear_timer.stop()
+        self.scheduler.shutdown()
         event.accept()
\ No newline at end of file
@@ -25,6 +25,14 @@ a = Analysis(
         'monitor_handler',
         'ui_components',
         'image_server',
+        'cache_handler',
+        'image_handler',
+        'job_handler',
+        'log_handler',
+        'router_handler',
+        'store_handler',
+        'supervisor_handler',
+        'trace_handler',
     ],
     hookspath=[],
     hooksconfig={},